@@ -106,7 +106,7 @@ class EntitySerializer(serializers.ModelSerializer):
 
 class ImageSerializer(serializers.ModelSerializer):
     entity = serializers.PrimaryKeyRelatedField(read_only=True)
-    original = HyperlinkedFileURL()
+    original = HyperlinkedImageURL(source='get_url',read_only=True)
 
     class Meta:
         model = Image
@@ -116,10 +116,10 @@ class ImageSerializer(serializers.ModelSerializer):
 class ImageMarkupSerializer(serializers.ModelSerializer):
     image = serializers.PrimaryKeyRelatedField(read_only=True)
     base = HyperlinkedImageURL()
-    overlay = HyperlinkedImageURL()
+    overlay = HyperlinkedImageURL(source='get_overlay_url',read_only=True)
 
     class Meta:
-        model = Image
+        model = ImageMarkup
         fields = ('id','image','modify_date','creator','base','overlay','transformation')
 
 
@@ -143,6 +143,7 @@ class ImageAnnotationSerializer(serializers.ModelSerializer):
 
 class TextSerializer(serializers.ModelSerializer):
     entity = serializers.PrimaryKeyRelatedField(read_only=True)
+    original = serializers.CharField(source='get_original',read_only=True)
 
     class Meta:
         model = Text
@@ -49,7 +49,8 @@ from docfish.apps.main.models import (
     TextAnnotation,
     TextDescription,
     TextMarkup,
-    Text
+    Text,
+    select_storage
 )
 
 from rest_framework import (
@@ -154,11 +155,11 @@ class AnnotationViewSet(viewsets.ReadOnlyModelViewSet):
     serializer_class = AnnotationSerializer
 
 class ImageViewSet(viewsets.ReadOnlyModelViewSet):
-    queryset = Image.objects.filter(entity__collection__private=False)
+    queryset = select_storage(Image.objects.filter(entity__collection__private=False))
     serializer_class = ImageSerializer
 
 class TextViewSet(viewsets.ReadOnlyModelViewSet):
-    queryset = Text.objects.filter(entity__collection__private=False)
+    queryset = select_storage(Text.objects.filter(entity__collection__private=False))
     serializer_class = TextSerializer
 
 class TextAnnotationViewSet(viewsets.ReadOnlyModelViewSet):
@@ -0,0 +1,140 @@
+'''
+
+Copyright (c) 2017 Vanessa Sochat
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+'''
+
+from docfish.settings import (
+    REQUEST_CAPTURE_ENABLED,
+    REQUEST_CAPTURE_MAX_BYTES,
+    REQUEST_CAPTURE_SAMPLE_RATE,
+    REQUEST_CAPTURE_SIZE
+)
+
+from django_redis import get_redis_connection
+import json
+import queue
+import random
+import threading
+import time
+
+# Request capture keeps recent request payloads (e.g., submitted annotations) for debugging. 
+# It is off unless REQUEST_CAPTURE_ENABLED is set, and then a sample of calls to capture
+# (REQUEST_CAPTURE_SAMPLE_RATE) is serialized (and cut to REQUEST_CAPTURE_MAX_BYTES, so a 
+# process never holds more than the queue of small records) and handed to a background thread,
+# which writes them to a ring buffer (a list of the last REQUEST_CAPTURE_SIZE captures) in redis. 
+# The request never waits on the write, and captures are dropped (not queued) when the thread 
+# falls behind.
+
+CAPTURE_KEY = "request-captures"
+CAPTURE_EXCLUDE = ["csrfmiddlewaretoken"]
+
+_captures = queue.Queue(maxsize=REQUEST_CAPTURE_SIZE)
+_writer = None
+_writer_lock = threading.Lock()
+
+
+#############################################################################################
+# Capture
+#############################################################################################
+
+def capture(name,payload):
+    '''capture hands a payload to the background writer, if capture is enabled and the 
+    call is sampled, and returns True if it was taken
+    :param name: the name of the capture point (e.g., update_annotations)
+    :param payload: the json serializable payload
+    '''
+    if not REQUEST_CAPTURE_ENABLED:
+        return False
+    if random.random() >= REQUEST_CAPTURE_SAMPLE_RATE:
+        return False
+    start_writer()
+    try:
+        _captures.put_nowait(format_capture(name,time.time(),payload))
+    except queue.Full:
+        return False
+    return True
+
+
+def start_writer():
+    '''start_writer starts the background writer thread of the process, once'''
+    global _writer
+    if _writer is None:
+        with _writer_lock:
+            if _writer is None:
+                writer = threading.Thread(target=write_captures,name="request-capture")
+                writer.daemon = True
+                writer.start()
+                _writer = writer
+
+
+def format_capture(name,when,payload):
+    '''format_capture returns the json record for a capture, without the fields in
+    CAPTURE_EXCLUDE (e.g., the csrf token of a form), and with the payload replaced by 
+    its size if it is larger than REQUEST_CAPTURE_MAX_BYTES
+    '''
+    if isinstance(payload,dict):
+        payload = dict([(k,v) for k,v in payload.items() if k not in CAPTURE_EXCLUDE])
+    record = json.dumps({"name":name,"time":when,"payload":payload},default=str)
+    if len(record) > REQUEST_CAPTURE_MAX_BYTES:
+        record = json.dumps({"name":name,"time":when,"truncated":len(record)})
+    return record
+
+
+def write_captures():
+    '''write_captures is the loop of the background writer, pushing each capture to the
+    ring buffer, and trimming it to REQUEST_CAPTURE_SIZE
+    '''
+    while True:
+        record = _captures.get()
+        try:
+            write_capture(record)
+        except Exception:
+            pass
+
+
+def write_capture(record):
+    '''write_capture pushes a (formatted) capture to the ring buffer, and trims it to
+    REQUEST_CAPTURE_SIZE
+    '''
+    pipeline = get_redis_connection('default').pipeline()
+    pipeline.lpush(CAPTURE_KEY,record)
+    pipeline.ltrim(CAPTURE_KEY,0,REQUEST_CAPTURE_SIZE - 1)
+    pipeline.execute()
+
+
+#############################################################################################
+# Reading
+#############################################################################################
+
+def get_captures(count=None):
+    '''get_captures returns the most recent captures (newest first)
+    :param count: the number to return (default all in the buffer)
+    '''
+    if count is None:
+        count = REQUEST_CAPTURE_SIZE
+    connection = get_redis_connection('default')
+    return [json.loads(x.decode('utf-8')) for x in connection.lrange(CAPTURE_KEY,0,count - 1)]
+
+
+def clear_captures():
+    '''clear_captures empties the ring buffer'''
+    get_redis_connection('default').delete(CAPTURE_KEY)
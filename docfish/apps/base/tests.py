@@ -0,0 +1,108 @@
+'''
+
+Copyright (c) 2017 Vanessa Sochat
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+'''
+
+from django.test import SimpleTestCase
+
+from docfish.apps.base import capture
+
+from unittest import (
+    mock,
+    skipIf
+)
+import json
+import queue
+import uuid
+
+
+def get_redis():
+    '''get_redis returns a connection to the redis of the default cache, or None'''
+    try:
+        connection = capture.get_redis_connection('default')
+        connection.ping()
+    except Exception:
+        return None
+    return connection
+
+
+class CaptureTest(SimpleTestCase):
+
+    def setUp(self):
+        self.captures = queue.Queue(maxsize=2)
+        patches = [mock.patch.object(capture,'REQUEST_CAPTURE_ENABLED',True),
+                   mock.patch.object(capture,'REQUEST_CAPTURE_SAMPLE_RATE',0.1),
+                   mock.patch.object(capture,'REQUEST_CAPTURE_MAX_BYTES',1024),
+                   mock.patch.object(capture,'_captures',self.captures),
+                   mock.patch.object(capture,'start_writer')]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def test_sampling(self):
+        '''only the sampled calls are captured, and none when capture is off'''
+        with mock.patch.object(capture.random,'random',return_value=0.5):
+            self.assertFalse(capture.capture('update_annotations',{'tid':None}))
+        with mock.patch.object(capture.random,'random',return_value=0.05):
+            self.assertTrue(capture.capture('update_annotations',{'tid':None}))
+            with mock.patch.object(capture,'REQUEST_CAPTURE_ENABLED',False):
+                self.assertFalse(capture.capture('update_annotations',{'tid':None}))
+        self.assertEqual(self.captures.qsize(),1)
+
+    def test_format(self):
+        '''captures are queued as records, without the csrf token, and large ones by size only'''
+        with mock.patch.object(capture.random,'random',return_value=0.0):
+            capture.capture('update_text_markup',{'csrfmiddlewaretoken':['token'],'text':['fish']})
+            capture.capture('update_text_markup',{'text':['fish' * 1000]})
+        small = json.loads(self.captures.get_nowait())
+        self.assertEqual(small['payload'],{'text':['fish']})
+        large = self.captures.get_nowait()
+        self.assertTrue(len(large) <= 1024)
+        self.assertNotIn('payload',json.loads(large))
+        self.assertTrue(json.loads(large)['truncated'] > 4000)
+
+    def test_full(self):
+        '''captures are dropped when the writer falls behind'''
+        with mock.patch.object(capture.random,'random',return_value=0.0):
+            results = [capture.capture('update_annotations',{'tid':None}) for x in range(3)]
+        self.assertEqual(results,[True,True,False])
+
+
+@skipIf(get_redis() is None,"redis is not available")
+class CaptureBufferTest(SimpleTestCase):
+
+    def setUp(self):
+        key = "request-captures-%s" %uuid.uuid4().hex
+        patches = [mock.patch.object(capture,'CAPTURE_KEY',key),
+                   mock.patch.object(capture,'REQUEST_CAPTURE_SIZE',3)]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.addCleanup(get_redis().delete,key)
+
+    def test_ring(self):
+        '''the buffer keeps the most recent captures, newest first'''
+        for number in range(5):
+            capture.write_capture(capture.format_capture('update_annotations',number,{'number':number}))
+        self.assertEqual([x['payload']['number'] for x in capture.get_captures()],[4,3,2])
+        capture.clear_captures()
+        self.assertEqual(capture.get_captures(),[])
@@ -27,16 +27,23 @@ SOFTWARE.
 from django.core.files.base import ContentFile
 from notifications.signals import notify
 
+from docfish.apps.base.capture import capture
 from docfish.apps.users.utils import get_team
 from docfish.apps.main.models import *
+from docfish.apps.main.schema import get_collection_schema
 from docfish.apps.main.utils import (
     get_collection,
     get_entity,
     get_image,
     get_text
 )
+from docfish.apps.main.writes import (
+    queue_annotations,
+    queue_text_markup
+)
 
 from docfish.settings import (
+    ANNOTATION_WRITE_BEHIND,
     BASE_DIR, 
     MEDIA_ROOT
 )
@@ -58,12 +65,12 @@ from django.shortcuts import (
     redirect
 )
 
+from django.db import transaction
 from django.utils import timezone
 from django.urls import reverse
 
 import json
 import os
-import pickle
 import re
 
 media_dir = os.path.join(BASE_DIR,MEDIA_ROOT)
@@ -122,6 +129,34 @@ def collection_update_instruction(request,cid):
     return JsonResponse({"Unicorn poop cookies...": "I will never understand the allure."})
  
 
+@login_required
+def collection_update_redundancy(request,cid):
+    '''update the redundancy target (number of annotators wanted per item) for
+    a particular annotation or markup task. An empty value removes the target.
+    '''
+    collection = get_collection(cid)
+
+    if request.user == collection.owner:
+
+        if request.method == 'POST':
+            redundancy = request.POST.get("redundancy",None)
+            fieldtype = request.POST.get("fieldtype",None)
+            if fieldtype in collection.status:
+                if redundancy in ["",None]:
+                    redundancy = None
+                elif redundancy.isdigit() and int(redundancy) > 0:
+                    redundancy = int(redundancy)
+                else:
+                    return JsonResponse({"error": "redundancy must be a positive number"})
+                collection.status[fieldtype]['redundancy'] = redundancy
+                collection.save()
+                response_data = {'result':'Redundancy updated',
+                                 'status': redundancy }
+                return JsonResponse(response_data)
+
+    return JsonResponse({"Unicorn poop cookies...": "I will never understand the allure."})
+ 
+
 def serve_image_metadata(request,uid):
     '''return image metadata as json
     '''
@@ -129,6 +164,21 @@ def serve_image_metadata(request,uid):
     return JsonResponse(image.metadata)
 
 
+def serve_image_derivatives(request,uid):
+    '''return the urls of the image thumbnail, display image, and deep zoom tiles
+    (served directly by the web server) as json
+    '''
+    image = get_image(uid)
+    if not hasattr(image,'imagefile'):
+        return JsonResponse({"error":"Image %s has no derivatives." %(uid)},status=404)
+    image = image.imagefile
+    return JsonResponse({"width": image.width,
+                         "height": image.height,
+                         "thumbnail": image.get_thumbnail_url(),
+                         "display": image.get_display_url(),
+                         "tiles": image.get_tile_source()})
+
+
 def serve_text_metadata(request,uid):
     '''return text metadata as json
     '''
@@ -148,104 +198,80 @@ def serve_text(request,uid):
 # Annotations #################################################################################
 ###############################################################################################
 
-def update_annotation(user,allowed_annotation,instance,cid,tid=None):
-    '''update_annotation will take a user, and an annotation, some instance
-    (text or image) and call the appropriate function to update it.
-    :param user: the user object or user id
-    :param allowed_annotation: the allowed annotation object or id
-    :param instance: the Image or text instance
-    '''
-    if not isinstance(user,User):
-        user = User.objects.get(id=user)
-    if not isinstance(allowed_annotation,Annotation):
-        allowed_annotation = Annotation.objects.get(id=allowed_annotation)
-    if isinstance(instance,Image):
-        return update_image_annotation(user,allowed_annotation,instance,tid=tid,cid=cid)
-    elif isinstance(instance,Text):
-        return update_text_annotation(user,allowed_annotation,instance,tid=tid,cid=cid)
-
-
-def update_image_annotation(user,allowed_annotation,image,cid,tid=None):
-    '''update_image_annotation is called from update_annotation given that the
-    user has provided an image
+def bulk_update_annotations(user,instance,labels,cid,tid=None):
+    '''bulk_update_annotations sets the annotations of a user (or team) for an image or text, 
+    replacing previous annotations with the same names, in one transaction. Labels are 
+    looked up in the collection schema, the replaced annotations are deleted together, and new ones
+    are inserted together, and a dictionary of the result for each label is returned 
+    (created, unchanged, replaced if a later label has the same name, as one option is kept 
+    for a name, or not allowed, if it isn't in the collection schema).
+    :param user: the user
+    :param instance: the Image or Text instance
+    :param labels: a list of labels, each "name||label"
     '''
-    if not isinstance(image,Image):
-        image = Image.objects.get(id=image)
-    collection = get_collection(cid)
-    team = get_team(tid)
-
-    # Remove annotations done previously by the user for the image
-    if tid is not None:
-        previous_annotations = ImageAnnotation.objects.filter(team=team,
-                                                              image=image,
-                                                              annotation__name=allowed_annotation.name)
-        [x.delete() for x in previous_annotations]
-        annotation = ImageAnnotation.objects.create(team=team,
-                                                    collection=collection,
-                                                    image=image,
-                                                    annotation=allowed_annotation)
+    results = dict()
+    annotations = dict()
+    names = dict()
+    schema = get_collection_schema(cid)
+    for label in labels:
+        if label in schema.ids:
+            name = label.split('||',1)[0]
+            if name in names:
+                del annotations[names[name]]
+                results[names[name]] = "replaced"
+            names[name] = label
+            annotations[label] = schema.ids[label]
+        else:
+            results[label] = "not allowed"
 
+    if isinstance(instance,Image):
+        model = ImageAnnotation
+        work = model.objects.filter(image=instance)
+        new = {'image':instance}
     else:
-        previous_annotations = ImageAnnotation.objects.filter(creator=user,
-                                                              collection=collection,
-                                                              image=image,
-                                                              annotation__name=allowed_annotation.name)
-        [x.delete() for x in previous_annotations]
-        annotation = ImageAnnotation.objects.create(creator=user,
-                                                    image=image,
-                                                    annotation=allowed_annotation)
-
-    return annotation
-
-
-
-def update_text_annotation(user,allowed_annotation,text,cid,tid=None):
-    '''update_text_annotation is called from update_annotation given that the
-    user has provided text
-    '''
-    if not isinstance(text,Text):
-        text = Text.objects.get(id=text)
-
-    collection = get_collection(cid)
-    team = get_team(tid)
+        model = TextAnnotation
+        work = model.objects.filter(text=instance)
+        new = {'text':instance}
 
+    new['collection_id'] = int(cid)
     if tid is not None:
-        previous_annotations = TextAnnotation.objects.filter(team=team,
-                                                             text=text,
-                                                             collection=collection,
-                                                             annotation__name=allowed_annotation.name)
-        [x.delete() for x in previous_annotations]
-        annotation = TextAnnotation.objects.create(team=team,
-                                                   text=text,
-                                                   collection=collection,
-                                                   annotation=allowed_annotation)
-
+        new['team_id'] = int(tid)
     else:
-        previous_annotations = TextAnnotation.objects.filter(creator=user,
-                                                             text=text,
-                                                             collection=collection,
-                                                             annotation__name=allowed_annotation.name)
-        [x.delete() for x in previous_annotations]
-        annotation = TextAnnotation.objects.create(creator=user,
-                                                   text=text,
-                                                   collection=collection,
-                                                   annotation=allowed_annotation)
-
-    
-    return annotation
-
-
-def finalize_annotation(previous_annotations,annotation):
-    '''finalize_annotation will ensure that an annotation is
-    unique, meaning removing all other options.
-    :param previous_annotations: any previous annotations with the same name
-    :param annotation: the annotation to set/keep
-    '''
-    for previous in previous_annotations:
-        if previous.id != annotation.id:
-            previous.delete()
-
-    return annotation
+        new['creator'] = user
+    work = work.filter(**dict([(k,v) for k,v in new.items() if k not in ['image','text']]))
+
+    if len(annotations) == 0:
+        return results
+
+    with transaction.atomic():
+        previous = list(work.filter(annotation__name__in=list(names.keys())).values_list('id','annotation_id'))
+        present = set([x[1] for x in previous])
+        keep = set(annotations.values())
+        had_work = len(previous) > 0 or work.exists()
+
+        created = []
+        for label,annotation_id in annotations.items():
+            if annotation_id in present:
+                results[label] = "unchanged"
+            else:
+                results[label] = "created"
+                created.append(model(annotation_id=annotation_id,**new))
+        replaced = [x for x in previous if x[1] not in keep]
+
+        # The rows are counted (stats, queues, item counts) once for the batch, not by the signals 
+        # for each row. Text annotations are unique for an annotator, so the (one) row replaced goes first.
+        with batch_task_signals():
+            if model == TextAnnotation:
+                model.objects.filter(id__in=[x[0] for x in replaced]).delete()
+            model.objects.bulk_create(created)
+            if model != TextAnnotation:
+                model.objects.filter(id__in=[x[0] for x in replaced]).delete()
+        count_batch(model,model(**new),
+                    added=[x.annotation_id for x in created],
+                    removed=[x[1] for x in replaced],
+                    had_work=had_work)
+
+    return results
 
 
 def clear_user_annotations(user,instance,cid):
@@ -304,19 +330,24 @@ def update_annotations(request,cid,instance):
             return JsonResponse({"error": "error parsing array!"})
 
         # Update the annotations
-        result = {'annots':new_annotations,'tid':tid}
-        pickle.dump(result,open('tmp.pkl','wb'))
-        for new_annotation in new_annotations:
-            if new_annotation['value'] == "on":
-                aname,alabel = new_annotation['name'].split('||')
-                annotation_object = Annotation.objects.get(name=aname,
-                                                           label=alabel)
-                annot = update_annotation(user=request.user,
-                                          allowed_annotation=annotation_object,
-                                          instance=instance,
-                                          tid=tid,
-                                          cid=cid)
-        response_data = {'result':'Create post successful!'}
+        capture('update_annotations',{'annots':new_annotations,'tid':tid})
+        labels = [x['name'] for x in new_annotations if x['value'] == "on"]
+
+        # In write behind mode, the annotations are saved by the worker
+        if ANNOTATION_WRITE_BEHIND:
+            results = queue_annotations(user=request.user,
+                                        instance=instance,
+                                        labels=labels,
+                                        tid=tid,
+                                        cid=cid)
+        else:
+            results = bulk_update_annotations(user=request.user,
+                                              instance=instance,
+                                              labels=labels,
+                                              tid=tid,
+                                              cid=cid)
+        response_data = {'result':'Create post successful!',
+                         'labels':results}
         return JsonResponse(response_data)
 
     return JsonResponse({"have you ever seen...": "a radiologist ravioli?"})
@@ -361,25 +392,49 @@ def update_text_markup(request,cid,uid):
 
     if request.method == 'POST':
         try:
-            pickle.dump(dict(request.POST),open('tmp.pkl','wb'))
+            capture('update_text_markup',dict(request.POST))
             markups = json.loads(request.POST.get('markup'))
             textstr = request.POST.get('text')
             tid = request.POST.get('team_id',None)
         except:
             return JsonResponse({"error": "error parsing markup!"})
 
+        team = None
         if tid is not None:
             team = get_team(tid)
-            text_markup,created = TextMarkup.objects.get_or_create(team=team,
-                                                                   text=text,
-                                                                   collection=collection)
+        locations = {"text":textstr,"markups":markups}
+
+        # In write behind mode, the markup is saved by the worker
+        if ANNOTATION_WRITE_BEHIND:
+            queue_text_markup(user=request.user,
+                              text=text,
+                              cid=collection.id,
+                              locations=locations,
+                              tid=tid)
         else:
-            text_markup,created = TextMarkup.objects.get_or_create(creator=request.user,
-                                                                   text=text,
-                                                                   collection=collection)
-        text_markup.locations = {"text":textstr,"markups":markups}
-        text_markup.save()
+            save_text_markup(user=request.user,
+                             text=text,
+                             collection=collection,
+                             locations=locations,
+                             team=team)
         response_data = {'result':markups}
         return JsonResponse(response_data)
 
     return JsonResponse({"nope...": "nopenope"})
+
+
+def save_text_markup(user,text,collection,locations,team=None):
+    '''save_text_markup sets the markup of a user (or team) for a text
+    :param locations: the markup locations, a dictionary with the text and markups
+    '''
+    if team is not None:
+        text_markup,created = TextMarkup.objects.get_or_create(team=team,
+                                                               text=text,
+                                                               collection=collection)
+    else:
+        text_markup,created = TextMarkup.objects.get_or_create(creator=user,
+                                                               text=text,
+                                                               collection=collection)
+    text_markup.locations = locations
+    text_markup.save()
+    return text_markup
@@ -0,0 +1,115 @@
+'''
+
+Copyright (c) 2017 Vanessa Sochat
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+'''
+
+from docfish.settings import TEXT_BLOB_ROOT
+
+import errno
+import gzip
+import hashlib
+import io
+import os
+import tempfile
+
+# A blob is a text body stored gzipped under TEXT_BLOB_ROOT, named by the sha256
+# of its (utf-8) content. The same body imported twice (e.g., into two collections)
+# is stored once, and a TextFile keeps only the hash. Blobs are never modified, 
+# so a blob that exists is complete.
+
+#############################################################################################
+# Paths
+#############################################################################################
+
+def get_blob_path(digest,root=None):
+    '''get_blob_path returns the path for a blob, in nested folders named by the first 
+    characters of its hash, so that no folder grows too large
+    :param digest: the sha256 (hex) of the blob content
+    '''
+    if root is None:
+        root = TEXT_BLOB_ROOT
+    return os.path.join(root,digest[:2],digest[2:4],"%s.gz" %digest)
+
+
+def get_digest(content):
+    '''get_digest returns the sha256 (hex) of text (or bytes) content'''
+    if not isinstance(content,bytes):
+        content = content.encode('utf-8')
+    return hashlib.sha256(content).hexdigest()
+
+
+def has_blob(digest):
+    '''has_blob returns True if a blob is stored'''
+    return os.path.exists(get_blob_path(digest))
+
+
+#############################################################################################
+# Reading and Writing
+#############################################################################################
+
+def put_blob(content):
+    '''put_blob stores text content (if it isn't stored already) and returns its hash.
+    The blob is written to a temporary file and moved into place, so a reader never
+    sees a partial blob.
+    :param content: the text (or bytes) to store
+    '''
+    if not isinstance(content,bytes):
+        content = content.encode('utf-8')
+    digest = get_digest(content)
+    path = get_blob_path(digest)
+    if os.path.exists(path):
+        return digest
+
+    folder = os.path.dirname(path)
+    try:
+        os.makedirs(folder)
+    except OSError as exc:
+        if exc.errno != errno.EEXIST:
+            raise
+    handle,tmpfile = tempfile.mkstemp(dir=folder)
+    with os.fdopen(handle,'wb') as filey:
+        with gzip.GzipFile(fileobj=filey,mode='wb') as zipped:
+            zipped.write(content)
+    os.rename(tmpfile,path)
+    return digest
+
+
+def open_blob(digest):
+    '''open_blob returns a text file object for a blob, decompressed as it is read'''
+    return io.TextIOWrapper(gzip.open(get_blob_path(digest),'rb'),encoding='utf-8')
+
+
+def read_blob(digest):
+    '''read_blob returns the full text of a blob'''
+    with open_blob(digest) as filey:
+        return filey.read()
+
+
+def iter_blob(digest,chunk_size=64*1024):
+    '''iter_blob yields the text of a blob in chunks, to stream it (e.g., in
+    a StreamingHttpResponse) without holding it in memory
+    '''
+    with open_blob(digest) as filey:
+        chunk = filey.read(chunk_size)
+        while chunk:
+            yield chunk
+            chunk = filey.read(chunk_size)
@@ -0,0 +1,304 @@
+'''
+
+Copyright (c) 2017 Vanessa Sochat
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+'''
+
+from docfish.settings import (
+    CONTENT_CACHE_ROOT,
+    CONTENT_CACHE_MAX_BYTES,
+    CONTENT_CACHE_MEMORY_ITEMS,
+    CONTENT_CACHE_MAX_AGE,
+    CONTENT_FETCH_TIMEOUT,
+    CONTENT_FETCH_POOL_SIZE
+)
+
+from requests.adapters import HTTPAdapter
+import collections
+import errno
+import hashlib
+import json
+import os
+import requests
+import tempfile
+import threading
+import time
+
+# Remote content (the body of a TextLink) is kept on disk under CONTENT_CACHE_ROOT, 
+# named by the hash of its url, with a .json file of metadata (etag, last modified, 
+# when it was fetched). Recently used bodies are also kept in memory. A body fetched
+# less than CONTENT_CACHE_MAX_AGE seconds ago is served without asking the remote 
+# server; an older one is revalidated with a conditional request.
+
+_lock = threading.RLock()
+_memory = collections.OrderedDict()
+_session = None
+_disk_bytes = None
+
+
+#############################################################################################
+# Session
+#############################################################################################
+
+def get_session():
+    '''get_session returns the http session shared by the process, so connections to
+    remote servers are pooled and reused.
+    '''
+    global _session
+    with _lock:
+        if _session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=CONTENT_FETCH_POOL_SIZE,
+                                  pool_maxsize=CONTENT_FETCH_POOL_SIZE)
+            session.mount('http://',adapter)
+            session.mount('https://',adapter)
+            _session = session
+    return _session
+
+
+#############################################################################################
+# Memory
+#############################################################################################
+
+def memory_get(url):
+    '''memory_get returns the (body,meta) cached in memory for a url, or None,
+    and marks it as most recently used
+    '''
+    with _lock:
+        entry = _memory.get(url)
+        if entry is not None:
+            _memory.pop(url)
+            _memory[url] = entry
+        return entry
+
+
+def memory_set(url,body,meta):
+    '''memory_set caches a body and its meta in memory, dropping the least recently
+    used bodies beyond CONTENT_CACHE_MEMORY_ITEMS
+    '''
+    with _lock:
+        _memory.pop(url,None)
+        _memory[url] = (body,meta)
+        while len(_memory) > CONTENT_CACHE_MEMORY_ITEMS:
+            _memory.popitem(last=False)
+
+
+#############################################################################################
+# Disk
+#############################################################################################
+
+def get_content_path(url,root=None):
+    '''get_content_path returns the path (without extension) for the cached content of
+    a url, in a subfolder named by the first characters of its hash
+    '''
+    if root is None:
+        root = CONTENT_CACHE_ROOT
+    digest = hashlib.sha256(url.encode('utf-8')).hexdigest()
+    return os.path.join(root,digest[:2],digest)
+
+
+def disk_get(url):
+    '''disk_get returns the (body,meta) cached on disk for a url, or None'''
+    path = get_content_path(url)
+    try:
+        with open("%s.json" %path,'r') as filey:
+            meta = json.load(filey)
+        with open("%s.body" %path,'rb') as filey:
+            body = filey.read().decode(meta.get('encoding') or 'utf-8','replace')
+    except (IOError,OSError,ValueError):
+        return None
+    return body,meta
+
+
+def write_atomic(path,content):
+    '''write_atomic writes content (bytes) to a temporary file in the same folder, and 
+    moves it into place, so a reader never sees a partial file
+    '''
+    folder = os.path.dirname(path)
+    try:
+        os.makedirs(folder)
+    except OSError as exc:
+        if exc.errno != errno.EEXIST:
+            raise
+    handle,tmpfile = tempfile.mkstemp(dir=folder)
+    with os.fdopen(handle,'wb') as filey:
+        filey.write(content)
+    os.rename(tmpfile,path)
+
+
+def disk_set(url,body,meta):
+    '''disk_set caches a body and its meta on disk, pruning the cache if it
+    grows over CONTENT_CACHE_MAX_BYTES
+    '''
+    global _disk_bytes
+    path = get_content_path(url)
+    content = body.encode(meta.get('encoding') or 'utf-8','replace')
+    write_atomic("%s.body" %path,content)
+    write_atomic("%s.json" %path,json.dumps(meta).encode('utf-8'))
+
+    with _lock:
+        if _disk_bytes is None:
+            _disk_bytes = get_disk_bytes()
+        else:
+            _disk_bytes += len(content)
+        if _disk_bytes > CONTENT_CACHE_MAX_BYTES:
+            _disk_bytes = prune_content()
+
+
+def touch_meta(url,meta):
+    '''touch_meta rewrites the meta of a cached body, after it was revalidated'''
+    write_atomic("%s.json" %get_content_path(url),json.dumps(meta).encode('utf-8'))
+
+
+def list_content(root=None):
+    '''list_content returns a list of (last used,size,path) for each cached body'''
+    if root is None:
+        root = CONTENT_CACHE_ROOT
+    bodies = []
+    for folder,dirs,files in os.walk(root):
+        for name in files:
+            if name.endswith('.body'):
+                path = os.path.join(folder,name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                bodies.append((max(stat.st_atime,stat.st_mtime),stat.st_size,path))
+    return bodies
+
+
+def get_disk_bytes(root=None):
+    '''get_disk_bytes returns the size of all cached bodies'''
+    return sum([size for used,size,path in list_content(root)])
+
+
+def prune_content(max_bytes=None,root=None):
+    '''prune_content deletes the least recently used bodies (and their meta) until the 
+    cache is under 90% of max_bytes, and returns the size that remains
+    :param max_bytes: the size to prune to (default is CONTENT_CACHE_MAX_BYTES)
+    '''
+    if max_bytes is None:
+        max_bytes = CONTENT_CACHE_MAX_BYTES
+    bodies = sorted(list_content(root))
+    total = sum([size for used,size,path in bodies])
+    for used,size,path in bodies:
+        if total <= max_bytes * 0.9:
+            break
+        for filename in [path,"%s.json" %path[:-len('.body')]]:
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+        total -= size
+    return total
+
+
+#############################################################################################
+# Content
+#############################################################################################
+
+def is_fresh(meta):
+    '''is_fresh returns True if cached content was fetched (or revalidated) recently
+    enough to be served without asking the remote server
+    '''
+    return time.time() - meta.get('fetched_at',0) < CONTENT_CACHE_MAX_AGE
+
+
+def fetch_content(url,cached=None):
+    '''fetch_content gets a url from its remote server, sending a conditional request 
+    if there is a cached copy, and returns the (body,meta) to cache.
+    :param cached: the (body,meta) already cached, if any
+    '''
+    headers = dict()
+    if cached is not None:
+        body,meta = cached
+        if meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        if meta.get('last_modified'):
+            headers['If-Modified-Since'] = meta['last_modified']
+
+    response = get_session().get(url,headers=headers,timeout=CONTENT_FETCH_TIMEOUT)
+
+    # The cached copy is still good
+    if cached is not None and response.status_code == 304:
+        meta = dict(meta)
+        meta['fetched_at'] = time.time()
+        touch_meta(url,meta)
+        return body,meta
+
+    meta = {'url':url,
+            'etag':response.headers.get('ETag'),
+            'last_modified':response.headers.get('Last-Modified'),
+            'encoding':response.encoding,
+            'status':response.status_code,
+            'fetched_at':time.time()}
+
+    # Only successful responses are written to disk
+    if response.status_code == 200:
+        disk_set(url,response.text,meta)
+    return response.text,meta
+
+
+def has_fresh_content(url):
+    '''has_fresh_content returns True if a url is cached (in memory or on disk) and
+    fresh, meaning get_content would not ask the remote server
+    '''
+    cached = memory_get(url)
+    if cached is None:
+        cached = disk_get(url)
+    return cached is not None and is_fresh(cached[1])
+
+
+def get_content(url):
+    '''get_content returns the body of a url, from memory or disk if it is cached 
+    and fresh, otherwise from the remote server (revalidating any cached copy). If 
+    the server cannot be reached, a stale cached copy is returned.
+    :param url: the url of the content, e.g., TextLink.original
+    '''
+    cached = memory_get(url)
+    if cached is None:
+        cached = disk_get(url)
+    if cached is not None and is_fresh(cached[1]):
+        memory_set(url,*cached)
+        return cached[0]
+
+    try:
+        body,meta = fetch_content(url,cached)
+    except requests.exceptions.RequestException:
+        if cached is None:
+            raise
+        return cached[0]
+
+    if meta.get('status') in [200,304]:
+        memory_set(url,body,meta)
+    return body
+
+
+def forget_content(url):
+    '''forget_content removes a url from the memory and disk caches'''
+    with _lock:
+        _memory.pop(url,None)
+    path = get_content_path(url)
+    for filename in ["%s.body" %path,"%s.json" %path]:
+        try:
+            os.remove(filename)
+        except OSError:
+            pass
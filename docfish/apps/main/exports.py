@@ -0,0 +1,292 @@
+'''
+
+Copyright (c) 2017 Vanessa Sochat
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+'''
+
+from docfish.settings import (
+    EXPORT_ROOT,
+    EXPORT_URL,
+    EXPORT_SHARD_BYTES,
+    EXPORT_WORKERS,
+    MEDIA_ROOT
+)
+
+from billiard import Pool
+from django.db.models import (
+    Count,
+    F,
+    Max
+)
+from docfish.apps.main.masks import (
+    decode_mask,
+    decode_png,
+    get_layers
+)
+from PIL import Image as PILImage
+import errno
+import json
+import numpy
+import os
+import shutil
+import tarfile
+import tempfile
+
+# The markups of a collection are exported as one archive (masks.tar.gz) for machine
+# learning, instead of one overlay at a time from the api. Each mask is decoded (in a
+# pool of processes), aligned to the size of its image, and written as uint8 pixels (0 
+# where nothing is drawn, otherwise the number of the color drawn, counted from 1, in the
+# markup palette), in row order, to .npy shards that hold many masks end to end. index.json 
+# lists each markup with its shard, offset, shape, and palette, so a mask is read with:
+#
+#     shard = numpy.load('masks-0000.npy',mmap_mode='r')
+#     mask = shard[offset:offset + height*width].reshape((height,width))
+#
+# Next to the archive, masks.json records the state of the markups it was made from (their
+# count, largest id, and last change), so an export is stale once a markup is added, 
+# changed, or deleted.
+
+#############################################################################################
+# Paths
+#############################################################################################
+
+def get_export_path(cid,root=None):
+    '''get_export_path returns the path of the mask export of a collection'''
+    if root is None:
+        root = EXPORT_ROOT
+    return os.path.join(root,str(cid),'masks.tar.gz')
+
+
+def get_export_url(cid):
+    '''get_export_url returns the (internal, see nginx.conf) url of the mask export'''
+    return "%s%s/masks.tar.gz" %(EXPORT_URL,cid)
+
+
+def get_export_state_path(cid,root=None):
+    '''get_export_state_path returns the path of the markup state of the mask export'''
+    return os.path.join(os.path.dirname(get_export_path(cid,root)),'masks.json')
+
+
+#############################################################################################
+# State
+#############################################################################################
+
+def get_markup_state(collection):
+    '''get_markup_state returns the count, largest id, and last change of the markups of
+    a collection. A deleted markup lowers the count, and a new one raises the largest id,
+    so the state changes for any edit, which a last change alone would miss for a delete.
+    '''
+    state = collection.imagemarkup_set.aggregate(count=Count('id'),
+                                                 last_id=Max('id'),
+                                                 modified=Max('modify_date'))
+    if state['modified'] is not None:
+        state['modified'] = state['modified'].timestamp()
+    return state
+
+
+def is_export_current(collection):
+    '''is_export_current returns True if the mask export of a collection exists, and was
+    made from the markups as they are now
+    '''
+    path = get_export_path(collection.id)
+    if not os.path.exists(path):
+        return False
+    try:
+        with open(get_export_state_path(collection.id),'r') as filey:
+            state = json.load(filey)
+    except (IOError,OSError,ValueError):
+        return False
+    return state == get_markup_state(collection)
+
+
+#############################################################################################
+# Decoding
+#############################################################################################
+
+def get_target_shape(row):
+    '''get_target_shape returns the (height,width) a mask is aligned to: the width and height 
+    in its transformation if given, otherwise the size of its image file, otherwise its own
+    '''
+    transformation = row['transformation'] or {}
+    width = transformation.get('width',row['image_width'])
+    height = transformation.get('height',row['image_height'])
+    if width and height:
+        return int(height),int(width)
+    return None
+
+
+def decode_markup(row):
+    '''decode_markup returns (markup id, mask, palette) for a markup row, the mask a uint8 
+    array of color numbers aligned to its target shape (see get_target_shape). It runs in the 
+    pool, so it is given everything it needs (without the database).
+    '''
+    if row['mask'] is not None:
+        mask,alpha = decode_mask(row['mask'],row['mask_width'],row['mask_height'])
+        palette = [color for color in row['mask_palette'].split(',') if color]
+    else:
+        with open(os.path.join(MEDIA_ROOT,row['overlay']),'rb') as filey:
+            pixels = decode_png(filey)
+        layers = get_layers(pixels)
+
+        # Too many colors to number, so drawn pixels are 1
+        if layers is None:
+            mask,palette = (pixels[:,:,3] > 0).astype(numpy.uint8),[]
+        else:
+            mask,alpha,palette = layers
+    shape = row['target']
+    if shape is not None and shape != mask.shape:
+        aligned = PILImage.fromarray(mask).resize((shape[1],shape[0]),PILImage.NEAREST)
+        mask = numpy.asarray(aligned,dtype=numpy.uint8)
+    return row['id'],mask,palette
+
+
+def iter_markup_rows(collection):
+    '''iter_markup_rows yields the markups of a collection (with a mask or overlay) as
+    dictionaries for decode_markup, reading them from the database in batches
+    '''
+    fields = ['id','image_id','image__uid','creator__username','team_id','transformation',
+              'mask','mask_width','mask_height','mask_palette','overlay']
+    markups = collection.imagemarkup_set.order_by('id')
+    markups = markups.annotate(image_width=F('image__imagefile__width'),
+                               image_height=F('image__imagefile__height'))
+    markups = markups.values(*fields + ['image_width','image_height'])
+    for row in markups.iterator():
+        if row['mask'] is None and not row['overlay']:
+            continue
+        if row['mask'] is not None:
+            row['mask'] = bytes(row['mask'])
+        row['target'] = get_target_shape(row)
+        yield row
+
+
+#############################################################################################
+# Export
+#############################################################################################
+
+class ShardWriter(object):
+    '''ShardWriter appends masks to .npy shards in a folder, starting a new shard when 
+    the current one reaches EXPORT_SHARD_BYTES, so only one shard is held in memory
+    '''
+    def __init__(self,folder,shard_bytes=None):
+        if shard_bytes is None:
+            shard_bytes = EXPORT_SHARD_BYTES
+        self.folder = folder
+        self.shard_bytes = shard_bytes
+        self.shards = []
+        self.masks = []
+        self.offset = 0
+
+    def add(self,mask):
+        '''add a mask, and return its (shard name, offset)'''
+        if self.offset + mask.size > self.shard_bytes and len(self.masks) > 0:
+            self.flush()
+        location = ("masks-%04d.npy" %len(self.shards),self.offset)
+        self.masks.append(mask.ravel())
+        self.offset += mask.size
+        return location
+
+    def flush(self):
+        if len(self.masks) > 0:
+            name = "masks-%04d.npy" %len(self.shards)
+            numpy.save(os.path.join(self.folder,name),numpy.concatenate(self.masks))
+            self.shards.append(name)
+        self.masks = []
+        self.offset = 0
+
+
+def iter_batches(rows,size):
+    '''iter_batches yields lists of (up to) size rows'''
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if len(batch) > 0:
+        yield batch
+
+
+def export_collection_masks(collection,workers=None):
+    '''export_collection_masks writes the mask export (see above) of a collection, and
+    returns its path. The archive is written to a temporary file and moved into place,
+    so a download never sees a partial export.
+    :param collection: the collection to export
+    :param workers: the number of processes decoding masks
+    '''
+    if workers is None:
+        workers = EXPORT_WORKERS
+    path = get_export_path(collection.id)
+    folder = os.path.dirname(path)
+    try:
+        os.makedirs(folder)
+    except OSError as exc:
+        if exc.errno != errno.EEXIST:
+            raise
+
+    # The state is read first, so a markup changed during the export makes it stale
+    state = get_markup_state(collection)
+    tmpdir = tempfile.mkdtemp(dir=folder)
+    try:
+        writer = ShardWriter(tmpdir)
+        markups = []
+        pool = Pool(workers)
+        try:
+            # Batches keep the masks in flight (read, or decoded) to a few per process
+            for batch in iter_batches(iter_markup_rows(collection),workers*16):
+                for row,(markup_id,mask,palette) in zip(batch,pool.map(decode_markup,batch)):
+                    shard,offset = writer.add(mask)
+                    markups.append({"markup":markup_id,
+                                    "image":row['image_id'],
+                                    "image_uid":row['image__uid'],
+                                    "creator":row['creator__username'],
+                                    "team":row['team_id'],
+                                    "shard":shard,
+                                    "offset":offset,
+                                    "shape":list(mask.shape),
+                                    "palette":palette,
+                                    "transformation":row['transformation']})
+        finally:
+            pool.close()
+            pool.join()
+        writer.flush()
+
+        index = {"collection":collection.id,
+                 "name":collection.name,
+                 "dtype":"uint8",
+                 "shards":writer.shards,
+                 "markups":markups}
+        with open(os.path.join(tmpdir,'index.json'),'w') as filey:
+            json.dump(index,filey)
+
+        tmpfile = os.path.join(tmpdir,'masks.tar.gz')
+        with tarfile.open(tmpfile,'w:gz') as archive:
+            for name in ['index.json'] + writer.shards:
+                archive.add(os.path.join(tmpdir,name),arcname=name)
+
+        # The state is moved last, so it never describes an older archive
+        tmpstate = os.path.join(tmpdir,'masks.json')
+        with open(tmpstate,'w') as filey:
+            json.dump(state,filey)
+        os.rename(tmpfile,path)
+        os.rename(tmpstate,get_export_state_path(collection.id))
+    finally:
+        shutil.rmtree(tmpdir)
+    return path
@@ -0,0 +1,199 @@
+'''
+
+Copyright (c) 2017 Vanessa Sochat
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+'''
+
+from docfish.apps.main.models import *
+from docfish.apps.main.navigation import (
+    get_contenders,
+    get_seen,
+    get_unseen_ids,
+    select_ids
+)
+from docfish.settings import ITEM_LEASE_SECONDS
+
+from django.db import (
+    IntegrityError,
+    transaction
+)
+from django.utils import timezone
+
+# Members of a team working on the same collection claim items through leases, so
+# that two members are never served the same item. Claiming an item inserts a row
+# in ItemLease, and the unique constraint (collection, team, task, item) decides
+# which member gets it when two claim at once. When the team has done every item,
+# members repeat items, also through leases, chosen at random.
+
+#############################################################################################
+# Leases
+#############################################################################################
+
+def get_leases(collection,team,task):
+    '''get_leases returns the current leases of a team for a task in a collection'''
+    return ItemLease.objects.filter(collection=collection,team=team,task=task)
+
+
+def release_expired(collection,team,task):
+    '''release_expired deletes leases that are past their expiration'''
+    get_leases(collection,team,task).filter(expires_at__lt=timezone.now()).delete()
+
+
+def release_items(user,collection,team,task,keep=None):
+    '''release_items releases the leases a team member holds for a task, except
+    for the ids in keep, which are renewed.
+    :param keep: a list of item ids to keep
+    '''
+    if keep is None:
+        keep = []
+    held = get_leases(collection,team,task).filter(holder=user)
+    held.exclude(item_id__in=keep).delete()
+    held.filter(item_id__in=keep).update(expires_at=get_expiration())
+
+
+def get_expiration():
+    '''get_expiration returns the expiration date for a lease taken now'''
+    return timezone.now() + timezone.timedelta(seconds=ITEM_LEASE_SECONDS)
+
+
+def lease_item(user,collection,team,task,item_id):
+    '''lease_item attempts to lease a single item to a team member. True is
+    returned if the lease was created, and False if the item is held by someone else.
+    '''
+    try:
+        with transaction.atomic():
+            ItemLease.objects.create(collection=collection,
+                                     team=team,
+                                     holder=user,
+                                     task=task,
+                                     item_id=item_id,
+                                     expires_at=get_expiration())
+        return True
+    except IntegrityError:
+        return False
+
+
+def lease_items(user,collection,team,task,candidates,N,attempts=10):
+    '''lease_items leases up to N of a (lazy, ordered) queryset of candidate ids to a team 
+    member, trying the next candidates if others claim first, and returns the ids leased
+    :param attempts: the number of extra candidates to try if others claim first
+    '''
+    claimed = []
+    for item_id in candidates[:N+attempts]:
+        if lease_item(user,collection,team,task,item_id):
+            claimed.append(item_id)
+        if len(claimed) == N:
+            break
+    return claimed
+
+
+def claim_items(user,collection,team,task,N=1,skip=None,attempts=10):
+    '''claim_items leases up to N items that the team has not seen, and that are not
+    leased to another member, to a team member. The member's other leases for the task
+    are released (except those in skip, the item(s) they are currently on).
+    :param user: the team member claiming the items
+    :param task: the task, as named in Collection.status (e.g., image_markup)
+    :param N: the number of items to claim
+    :param skip: one or more item ids the member is on, not to be claimed again
+    :param attempts: the number of extra candidates to try if others claim first
+    '''
+    if skip is None:
+        skip = []
+    if not isinstance(skip,list):
+        skip = [skip]
+
+    release_expired(collection,team,task)
+    release_items(user,collection,team,task,keep=skip)
+
+    get_images = task.startswith('image')
+    contenders = get_contenders(collection,get_images=get_images)
+    candidates = get_unseen_ids(contenders=contenders,
+                                seen=get_seen(task,team=team),
+                                get_images=get_images,
+                                skip=skip)
+
+    # Items leased by other members are not candidates
+    leased = get_leases(collection,team,task).values('item_id')
+    candidates = candidates.exclude(id__in=leased)
+
+    claimed = lease_items(user,collection,team,task,candidates,N=N,attempts=attempts)
+    rows = contenders.model.objects.in_bulk(claimed)
+    return [rows[x] for x in claimed if x in rows]
+
+
+def claim_next(user,collection,team,task,N=1,skip=None,attempts=10):
+    '''claim_next is the team counterpart of the navigation get_next_to_* functions.
+    Items are claimed (leased) for the member, and if the team has no unclaimed items 
+    left, the member is served items the team has already done (as a team can repeat),
+    leased at random from those no other member holds. Only if every other item is held 
+    is the member served one at random without a lease (or the item they are on, if it 
+    is the only one). A single item (None for an empty collection) is returned when N is 1, 
+    otherwise a list.
+    '''
+    if skip is None:
+        skip = []
+    if not isinstance(skip,list):
+        skip = [skip]
+
+    choices = claim_items(user=user,
+                          collection=collection,
+                          team=team,
+                          task=task,
+                          N=N,
+                          skip=skip,
+                          attempts=attempts)
+
+    contenders = get_contenders(collection,get_images=task.startswith('image'))
+    exclude = [x.id for x in choices] + skip
+    if len(choices) < N:
+        leased = get_leases(collection,team,task).values('item_id')
+        repeats = contenders.exclude(id__in=exclude).exclude(id__in=leased)
+        repeats = repeats.order_by('id').values_list('id',flat=True)
+        count = repeats.count()
+        candidates = select_ids(ids=repeats,
+                                count=count,
+                                return_number=min(N-len(choices)+attempts,count))
+        claimed = lease_items(user,collection,team,task,candidates,N=N-len(choices),attempts=attempts)
+        rows = contenders.in_bulk(claimed)
+        choices = choices + [rows[x] for x in claimed if x in rows]
+
+    if len(choices) < N:
+        exclude = [x.id for x in choices] + skip
+        others = contenders.exclude(id__in=exclude).order_by('id').values_list('id',flat=True)
+        count = others.count()
+        if count == 0:
+            others = contenders.exclude(id__in=[x.id for x in choices]).order_by('id').values_list('id',flat=True)
+            count = others.count()
+        selected = select_ids(ids=others,
+                              count=count,
+                              return_number=min(N-len(choices),count))
+        rows = contenders.in_bulk(selected)
+        choices = choices + [rows[x] for x in selected if x in rows]
+
+    # A collection with fewer items than N serves them again (views unpack the current and next)
+    if 0 < len(choices) < N:
+        choices = (choices * N)[:N]
+
+    if N == 1:
+        if len(choices) == 0:
+            return None
+        return choices[0]
+    return choices
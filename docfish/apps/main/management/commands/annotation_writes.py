@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand
+from docfish.apps.main.writes import (
+    count_writes,
+    discard_failed_writes,
+    get_failed_writes,
+    retry_failed_writes
+)
+import json
+
+class Command(BaseCommand):
+    '''This command will print the annotation writes (see writes.py, with 
+    ANNOTATION_WRITE_BEHIND) that failed to save, and retry or discard them.
+    '''
+    help = "Prints, retries, or discards failed annotation writes"
+    def add_arguments(self, parser):
+        parser.add_argument('--retry', action='store_true', default=False)
+        parser.add_argument('--discard', action='store_true', default=False)
+
+    def handle(self,*args, **options):
+        if options['retry']:
+            self.stdout.write("Queued %s failed writes again" %(retry_failed_writes()))
+            return
+        if options['discard']:
+            discard_failed_writes()
+            self.stdout.write("Discarded failed writes")
+            return
+        for write in get_failed_writes():
+            self.stdout.write(json.dumps(write,indent=4))
+        self.stdout.write("%s writes waiting to be saved" %(count_writes()))
@@ -0,0 +1,50 @@
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+from docfish.apps.main.models import (
+    Image,
+    ImageFile,
+    ImageLink,
+    Text,
+    TextFile,
+    TextLink,
+    get_content_type
+)
+
+class Command(BaseCommand):
+    '''This command will classify the content type of existing images and text,
+    from their file names or urls (and pdf or xml tags), and then rebuild the
+    content counts (which include pdfs). New content is classified on import.
+    '''
+    help = "Classifies the content type of images and text"
+
+    def classify(self,model,names,tag,tagged):
+        '''classify updates the content type of a model, grouping ids by type
+        :param names: a list of (id,name or url) to classify
+        :param tag: a tag (pdf or xml) that also sets the type
+        :param tagged: the models (the model and subclasses) that tags are kept for
+        '''
+        types = dict()
+        for item_id,name in names:
+            types[item_id] = get_content_type(name)
+        for tagged_model in tagged:
+            for item_id in tagged_model.objects.filter(tags__name=tag).values_list('id',flat=True):
+                types[item_id] = tag
+
+        groups = dict()
+        for item_id,content_type in types.items():
+            groups.setdefault(content_type,[]).append(item_id)
+        for content_type,item_ids in groups.items():
+            for start in range(0,len(item_ids),1000):
+                model.objects.filter(id__in=item_ids[start:start+1000]).update(content_type=content_type)
+            self.stdout.write("Classified %s %s as %s" %(len(item_ids),model.__name__,content_type))
+
+    def handle(self,*args, **options):
+        images = list(ImageLink.objects.values_list('id','url'))
+        images += list(ImageFile.objects.values_list('id','original'))
+        self.classify(Image,images,'pdf',[Image,ImageFile,ImageLink])
+
+        texts = list(TextLink.objects.values_list('id','original'))
+        texts += list(TextFile.objects.values_list('id','uid'))
+        self.classify(Text,texts,'xml',[Text,TextFile,TextLink])
+
+        call_command('rebuild_content_counts')
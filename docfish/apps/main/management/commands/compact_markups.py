@@ -0,0 +1,41 @@
+from django.core.management.base import BaseCommand
+from docfish.apps.main.models import ImageMarkup
+from docfish.apps.main.masks import (
+    decode_png,
+    encode_mask,
+    render_pixels
+)
+import numpy
+
+class Command(BaseCommand):
+    '''This command will convert the png overlays of markups saved before masks
+    (see masks.py) into masks. A mask is saved only if the overlay rendered from it
+    matches the png, and the png files are kept (the masks are used when present).
+    '''
+    help = "Converts saved markup overlays into compact masks"
+    def handle(self,*args, **options):
+        count = 0
+        skipped = 0
+        for markup in ImageMarkup.objects.filter(mask__isnull=True).exclude(overlay=''):
+            if not markup.overlay:
+                continue
+            with open(markup.overlay.path,'rb') as filey:
+                data = filey.read()
+            encoded = encode_mask(data)
+            if encoded is None:
+                skipped += 1
+                continue
+
+            # Fully transparent pixels have no color in a mask
+            mask,width,height,palette = encoded
+            pixels = numpy.array(decode_png(data))
+            pixels[pixels[:,:,3] == 0] = 0
+            if not numpy.array_equal(pixels,render_pixels(mask,width,height,palette)):
+                skipped += 1
+                continue
+            ImageMarkup.objects.filter(id=markup.id).update(mask=mask,
+                                                            mask_width=width,
+                                                            mask_height=height,
+                                                            mask_palette=palette)
+            count += 1
+        self.stdout.write("Converted %s markup overlays, %s kept as png" %(count,skipped))
@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+from docfish.apps.main.models import ImageFile
+from docfish.apps.main.tasks import make_image_derivatives
+
+class Command(BaseCommand):
+    '''This command will queue the worker to make the thumbnail, display image,
+    and deep zoom tiles (see tiles.py) for image files that don't have them yet,
+    for images imported before derivatives were made on save (or versioned).
+    '''
+    help = "Queues derivatives (thumbnail, display image, tiles) for image files"
+    def handle(self,*args, **options):
+        image_ids = ImageFile.objects.filter(Q(has_derivatives=False) | Q(derivatives_version__isnull=True),
+                                             content_type="image").values_list('id',flat=True)
+        count = 0
+        for image_id in image_ids:
+            make_image_derivatives.apply_async(kwargs={"image_id":image_id})
+            count += 1
+        self.stdout.write("Queued derivatives for %s images" %(count))
@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+from docfish.apps.main.blobs import put_blob
+from docfish.apps.main.models import TextFile
+
+class Command(BaseCommand):
+    '''This command will move the bodies of text files saved in the database
+    (TextFile.original) to the blob store, leaving only the hash (TextFile.blob).
+    Text files can be read while this runs, and it can be run again if interrupted.
+    '''
+    help = "Moves text file bodies to the blob store"
+    def handle(self,*args, **options):
+        texts = TextFile.objects.filter(blob__isnull=True,original__isnull=False)
+        text_ids = list(texts.values_list('id',flat=True))
+        for text_id in text_ids:
+            content = TextFile.objects.filter(id=text_id).values_list('original',flat=True).first()
+            if content is not None:
+                TextFile.objects.filter(id=text_id).update(blob=put_blob(content),original=None)
+        self.stdout.write("Moved %s text files to the blob store" %(len(text_ids)))
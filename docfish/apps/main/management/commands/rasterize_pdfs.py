@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+from docfish.apps.main.models import Image
+from docfish.apps.main.tasks import rasterize_pdf_pages
+
+class Command(BaseCommand):
+    '''This command will queue the worker to render the pages of pdf images that
+    don't have pages yet (see pages.py), for pdfs imported before pages were
+    rendered on save.
+    '''
+    help = "Queues page rendering for pdf images"
+    def handle(self,*args, **options):
+        image_ids = Image.objects.filter(content_type="pdf",
+                                         parent__isnull=True,
+                                         pages__isnull=True).values_list('id',flat=True)
+        count = 0
+        for image_id in image_ids:
+            rasterize_pdf_pages.apply_async(kwargs={"image_id":image_id})
+            count += 1
+        self.stdout.write("Queued page rendering for %s pdfs" %(count))
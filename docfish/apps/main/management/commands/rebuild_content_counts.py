@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Sum
+from docfish.apps.main.models import (
+    Collection,
+    Entity,
+    content_counters,
+    count_entity_content
+)
+
+class Command(BaseCommand):
+    '''This command will rebuild the counts of images and text for each entity,
+    and of entities, images and text for each collection, from the saved content.
+    Counts are otherwise kept up to date as content is saved and deleted.
+    '''
+    help = "Rebuilds entity and collection content counts"
+    def handle(self,*args, **options):
+        entity_ids = list(Entity.objects.values_list('id',flat=True))
+        for start in range(0,len(entity_ids),1000):
+            counts = count_entity_content(entity_ids[start:start+1000])
+            for entity_id,entity_counts in counts.items():
+                Entity.objects.filter(id=entity_id).update(**entity_counts)
+        self.stdout.write("Counted content for %s entities" %(len(entity_ids)))
+
+        for collection in Collection.objects.all():
+            totals = collection.entity_set.aggregate(*[Sum(c) for c in content_counters])
+            counts = dict([(c,totals['%s__sum' %c] or 0) for c in content_counters])
+            counts['entity_count'] = collection.entity_set.count()
+            Collection.objects.filter(id=collection.id).update(**counts)
+            self.stdout.write("Counted %s entities for %s" %(counts['entity_count'],collection.name))
@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand
+from django.db.models.aggregates import Count
+from docfish.apps.main.models import (
+    ItemCount,
+    task_models
+)
+
+class Command(BaseCommand):
+    '''This command will rebuild the per item annotator counts (ItemCount)
+    used to serve items by redundancy, from the saved markups, descriptions,
+    and annotations. Counts are otherwise kept up to date as work is saved.
+    '''
+    help = "Rebuilds per item annotator counts"
+    def handle(self,*args, **options):
+        ItemCount.objects.all().delete()
+        for task,model in task_models.items():
+            item_field = "text_id"
+            if task.startswith('image'):
+                item_field = "image_id"
+            counts = model.objects.order_by().values('collection_id',item_field).annotate(users=Count('creator',distinct=True),
+                                                                                        teams=Count('team',distinct=True))
+            ItemCount.objects.bulk_create([ItemCount(collection_id=c['collection_id'],
+                                                     task=task,
+                                                     item_id=c[item_field],
+                                                     count=c['users']+c['teams']) for c in counts])
+            self.stdout.write("Counted %s items for %s" %(len(counts),task))
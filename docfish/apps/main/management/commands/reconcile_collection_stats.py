@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+from docfish.apps.main.models import Collection
+from docfish.apps.main.stats import reconcile_collection_stats
+
+class Command(BaseCommand):
+    '''This command will reconcile the collection stats (CollectionStat) with
+    the saved markups, descriptions, and annotations, the same as the hourly 
+    reconcile_stats task. Use it to fill the stats for existing work.
+    '''
+    help = "Reconciles collection stats with saved work"
+    def handle(self,*args, **options):
+        for collection in Collection.objects.all():
+            changed = reconcile_collection_stats(collection)
+            self.stdout.write("Reconciled %s stats for %s" %(changed,collection.name))
@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+from docfish.apps.main.models import (
+    ImageBase,
+    ImageMarkup
+)
+from docfish.apps.main.pages import get_file_digest
+
+class Command(BaseCommand):
+    '''This command will register the base images of markups saved before the
+    registry (ImageBase), and link the markups to them. The files are not moved.
+    '''
+    help = "Registers the saved base images of markups"
+    def handle(self,*args, **options):
+        count = 0
+        markups = ImageMarkup.objects.filter(image_base__isnull=True).exclude(base='')
+        for markup in markups.exclude(base__isnull=True):
+            if not markup.base:
+                continue
+            image_base,created = ImageBase.objects.get_or_create(image_id=markup.image_id,
+                                                                 digest=get_file_digest(markup.base.path),
+                                                                 defaults={'base':markup.base.name})
+            ImageMarkup.objects.filter(id=markup.id).update(image_base=image_base)
+            count += 1
+        self.stdout.write("Registered base images for %s markups" %(count))
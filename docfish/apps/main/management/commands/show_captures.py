@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+from docfish.apps.base.capture import (
+    clear_captures,
+    get_captures
+)
+import json
+
+class Command(BaseCommand):
+    '''This command will print the request payloads captured for debugging (see
+    base/capture.py, enabled with REQUEST_CAPTURE_ENABLED), newest first.
+    '''
+    help = "Prints (or clears) captured request payloads"
+    def add_arguments(self, parser):
+        parser.add_argument('--count', type=int, default=None)
+        parser.add_argument('--clear', action='store_true', default=False)
+
+    def handle(self,*args, **options):
+        if options['clear']:
+            clear_captures()
+            self.stdout.write("Cleared captures")
+            return
+        for record in get_captures(options['count']):
+            self.stdout.write(json.dumps(record,indent=4))
@@ -0,0 +1,151 @@
+'''
+
+Copyright (c) 2017 Vanessa Sochat
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+'''
+
+from docfish.settings import (
+    MEDIA_ROOT,
+    MEDIA_URL
+)
+
+from PIL import Image as PILImage
+import errno
+import hashlib
+import io
+import numpy
+import os
+import tempfile
+import zlib
+
+# A markup overlay drawn in the browser is mostly transparent. Instead of saving it as
+# a png (rewritten in full for each save), it is kept as two planes, zlib compressed (see
+# ImageMarkup.mask): the color of each pixel, as an index into the palette of the colors drawn 
+# (0 for transparent), and the alpha of each pixel (so anti aliased edges are kept). With the 
+# palette (ImageMarkup.mask_palette) this is the overlay, without loss: the only change is that 
+# fully transparent pixels are black. An overlay with more colors than a palette holds isn't 
+# converted, and is kept as a png. The png overlay is rendered from the mask when it is first 
+# viewed, and kept under MEDIA_ROOT/overlays, named by the sha256 of the mask and palette.
+
+MAX_COLORS = 255
+
+#############################################################################################
+# Encoding
+#############################################################################################
+
+def decode_png(data):
+    '''decode_png returns an RGBA array (height,width,4) for png bytes (or a file)'''
+    if isinstance(data,bytes):
+        data = io.BytesIO(data)
+    image = PILImage.open(data)
+    return numpy.asarray(image.convert('RGBA'))
+
+
+def get_layers(pixels):
+    '''get_layers splits the RGBA array of an overlay into (indices, alpha, palette), where
+    indices is the (height,width) uint8 array of the palette color of each drawn pixel, counted 
+    from 1 (0 is not drawn), alpha is the (height,width) alpha, and palette is the list of the 
+    colors drawn, as RGB hex strings (e.g., ff0000). None is returned if there are more
+    than MAX_COLORS colors.
+    :param pixels: the RGBA array of the overlay
+    '''
+    alpha = numpy.ascontiguousarray(pixels[:,:,3])
+    drawn = alpha > 0
+    rgb = pixels[:,:,:3][drawn].astype(numpy.uint32)
+    codes = (rgb[:,0] << 16) | (rgb[:,1] << 8) | rgb[:,2]
+    values,inverse = numpy.unique(codes,return_inverse=True)
+    if len(values) > MAX_COLORS:
+        return None
+    indices = numpy.zeros(alpha.shape,dtype=numpy.uint8)
+    indices[drawn] = inverse + 1
+    palette = ["%06x" %value for value in values]
+    return indices,alpha,palette
+
+
+def encode_mask(data):
+    '''encode_mask converts overlay png bytes into a compressed mask, returning
+    (mask, width, height, palette), where mask is the zlib compressed color indices
+    and alpha of the pixels (see get_layers), in row order, and palette is the colors, 
+    comma separated. None is returned if the overlay can't be kept as a mask.
+    :param data: the png bytes (or file) of the overlay
+    '''
+    pixels = decode_png(data)
+    height,width = pixels.shape[:2]
+    layers = get_layers(pixels)
+    if layers is None:
+        return None
+    indices,alpha,palette = layers
+    mask = zlib.compress(indices.tobytes() + alpha.tobytes())
+    return mask,width,height,','.join(palette)
+
+
+def decode_mask(mask,width,height):
+    '''decode_mask returns the (indices, alpha) arrays (height,width) of a compressed mask'''
+    planes = numpy.frombuffer(zlib.decompress(bytes(mask)),dtype=numpy.uint8)
+    size = width*height
+    indices = planes[:size].reshape((height,width))
+    alpha = planes[size:2*size].reshape((height,width))
+    return indices,alpha
+
+
+def render_pixels(mask,width,height,palette):
+    '''render_pixels returns the RGBA array (height,width,4) of a compressed mask'''
+    indices,alpha = decode_mask(mask,width,height)
+    colors = numpy.zeros((len(palette.split(',')) + 1,3),dtype=numpy.uint8)
+    for number,color in enumerate(palette.split(','),1):
+        if color:
+            colors[number] = [int(color[i:i+2],16) for i in range(0,6,2)]
+    pixels = numpy.zeros((height,width,4),dtype=numpy.uint8)
+    pixels[:,:,:3] = colors[indices]
+    pixels[:,:,3] = alpha
+    return pixels
+
+
+#############################################################################################
+# Rendering
+#############################################################################################
+
+def get_overlay_name(mask,palette):
+    '''get_overlay_name returns the name (relative to MEDIA_ROOT) of a rendered overlay'''
+    digest = hashlib.sha256(bytes(mask) + palette.encode('utf-8')).hexdigest()
+    return os.path.join('overlays',digest[:2],"%s.png" %digest)
+
+
+def render_overlay(mask,width,height,palette):
+    '''render_overlay writes the png overlay for a mask, if it isn't written already,
+    and returns its url. The png is written to a temporary file and moved into place,
+    so a reader never sees a partial overlay.
+    '''
+    name = get_overlay_name(mask,palette)
+    path = os.path.join(MEDIA_ROOT,name)
+    if not os.path.exists(path):
+        folder = os.path.dirname(path)
+        try:
+            os.makedirs(folder)
+        except OSError as exc:
+            if exc.errno != errno.EEXIST:
+                raise
+        pixels = render_pixels(mask,width,height,palette)
+        handle,tmpfile = tempfile.mkstemp(dir=folder,suffix='.png')
+        with os.fdopen(handle,'wb') as filey:
+            PILImage.fromarray(pixels,'RGBA').save(filey,format='PNG',optimize=True)
+        os.rename(tmpfile,path)
+    return "%s%s" %(MEDIA_URL,name)
@@ -27,6 +27,23 @@ from polymorphic.models import PolymorphicModel
 from taggit.managers import TaggableManager
 
 from docfish.settings import MEDIA_ROOT
+from docfish.apps.main.blobs import (
+    open_blob,
+    put_blob,
+    read_blob
+)
+from docfish.apps.main.content import get_content
+from docfish.apps.main.masks import render_overlay
+from docfish.apps.main.schema import (
+    get_collection_schema,
+    invalidate_schema
+)
+from docfish.apps.main.tiles import get_derivative_url
+from docfish.apps.main.queues import (
+    clear_queue,
+    discard_queue_item,
+    get_queue_key
+)
 
 from django.contrib.auth.models import User
 from django.contrib.contenttypes.fields import GenericForeignKey
@@ -36,17 +53,29 @@ from django.core.urlresolvers import reverse
 from django.dispatch import receiver
 from django.db.models.signals import (
     m2m_changed,
+    post_delete,
+    post_save,
     pre_delete
 )
 
+from django.core.cache import cache
 from django.db.models import Q, DO_NOTHING
-from django.db import models
+from django.db import (
+    models,
+    transaction
+)
 
+from contextlib import contextmanager
+from itertools import chain
 import errno
+import hashlib
+import io
 import requests
 import collections
 import operator
 import os
+import re
+import threading
 
 
 
@@ -89,21 +118,55 @@ PRIVACY_CHOICES = ((False, 'Public (The collection will be accessible by anyone
 ACTIVE_CHOICES = ((False, 'Inactive. The object is not shown to the user in standard views.'),
                   (True, 'Active. The object is shown to the user.'))
 
+# Images and text are classified by content type when they are imported (see get_content_type)
+CONTENT_TYPES = (('pdf', 'PDF document'),
+                 ('xml', 'XML document'),
+                 ('text', 'Plain text'),
+                 ('image', 'Web image (png, jpg, gif, tiff)'),
+                 ('dicom', 'DICOM image'),
+                 ('nifti', 'NIfTI image'),
+                 ('unknown', 'Unknown'))
+
+
+def get_content_type(name=None,mimetype=None):
+    '''get_content_type classifies an image or text (one of CONTENT_TYPES) from its
+    mimetype if provided (e.g., a storage contentType), otherwise its file name or url.
+    '''
+    for candidate in [mimetype,name]:
+        if not candidate:
+            continue
+        candidate = candidate.lower()
+        if candidate.endswith('pdf'):
+            return 'pdf'
+        elif candidate.endswith('xml'):
+            return 'xml'
+        elif re.search('dcm$|dicom$',candidate):
+            return 'dicom'
+        elif re.search(r'\.nii$|\.nii\.gz$|nifti$',candidate):
+            return 'nifti'
+        elif re.search(r'\.png$|\.jpe?g$|\.gif$|\.tiff?$|^image/',candidate):
+            return 'image'
+        elif re.search(r'\.txt$|^text/plain',candidate):
+            return 'text'
+    return 'unknown'
+
 # Each collection owner has the ability to share an annotation portal page, with
 # custom instructions and links for each task. By default, all are active, with no
-# instruction.
+# instruction. A task can also have a redundancy target, the number of annotators
+# wanted per item (None serves each user everything they haven't seen).
 
 collection_status = {'text_annotation':  {'active':True,'instruction': "Please choose the descriptor that best matches the text.",
-                                          'title':'Text Annotation','symbol':'fa-pencil-square'},
+                                          'title':'Text Annotation','symbol':'fa-pencil-square','redundancy':None},
                      'text_describe':    {'active':True,'instruction': "Please describe the text.",
-                                          'title':'Text Description','symbol':'fa-pencil-square'},
+                                          'title':'Text Description','symbol':'fa-pencil-square','redundancy':None},
                      'text_markup':      {'active':True,'instruction': "Please highlight important parts of the text.",
-                                          'title':'Text Markup','symbol':'fa-pencil-square'},
+                                          'title':'Text Markup','symbol':'fa-pencil-square','redundancy':None},
                      'image_annotation': {'active':True,'instruction': "Please choose descriptors that best match the image.",
-                                          'title':'Image Annotation','symbol':'fa-picture-o'},
-                     'image_describe':   {'active':True,'instruction': "Please describe the image.",'title':'Image Description','symbol':'fa-picture-o'},
+                                          'title':'Image Annotation','symbol':'fa-picture-o','redundancy':None},
+                     'image_describe':   {'active':True,'instruction': "Please describe the image.",'title':'Image Description',
+                                          'symbol':'fa-picture-o','redundancy':None},
                      'image_markup':     {'active':True,'instruction': "Please mark important parts of the image", 
-                                          'title':'Image Markup','symbol':'fa-picture-o'}}
+                                          'title':'Image Markup','symbol':'fa-picture-o','redundancy':None}}
 
 #######################################################################################################
 # Annotations #########################################################################################
@@ -138,6 +201,22 @@ class Annotation(models.Model):
 # Collections and Entities ############################################################################
 #######################################################################################################
 
+# The counters kept for the images and text of each entity (and summed for each collection)
+content_counters = ['image_count','active_image_count','pdf_count','text_count','active_text_count']
+
+def get_save_kwargs(instance,counters,kwargs):
+    '''get_save_kwargs returns the arguments to save an existing instance with all fields but its 
+    counters. The counters are changed only with updates (see change_content_counts), so saving 
+    a copy of the instance loaded before a change would otherwise write old counts over it.
+    :param counters: the names of the counter fields
+    :param kwargs: the arguments given to save
+    '''
+    if not instance._state.adding and not kwargs.get('force_insert') and kwargs.get('update_fields') is None:
+        kwargs['update_fields'] = [f.name for f in instance._meta.concrete_fields 
+                                   if not f.primary_key and f.name not in counters]
+    return kwargs
+
+
 class Entity(models.Model):
     '''An entity is a person, place, whatever, that has one or more associated text and image things. 
        This is how we group text and images together under some common identifier.
@@ -145,6 +224,13 @@ class Entity(models.Model):
     uid = models.CharField(max_length=200, null=False, verbose_name="unique id of entity", unique=True)
     metadata = JSONField(default={})
 
+    # Counts of images and text, kept up to date as they are saved and deleted
+    image_count = models.PositiveIntegerField(default=0)
+    active_image_count = models.PositiveIntegerField(default=0)
+    pdf_count = models.PositiveIntegerField(default=0)
+    text_count = models.PositiveIntegerField(default=0)
+    active_text_count = models.PositiveIntegerField(default=0)
+
     def get_absolute_url(self):
         return reverse('entity_details', args=[str(self.id)])
 
@@ -160,6 +246,10 @@ class Entity(models.Model):
     def get_label(self):
         return "image"
 
+    def save(self, *args, **kwargs):
+        kwargs = get_save_kwargs(self,content_counters,kwargs)
+        super(Entity, self).save(*args, **kwargs)
+
     class Meta:
         app_label = 'main'
 
@@ -195,6 +285,14 @@ class Collection(models.Model):
     # Status objects and activation states for annotation/markups
     status = JSONField(default=collection_status)
 
+    # Counts of entities, and their images and text, kept up to date as they change
+    entity_count = models.PositiveIntegerField(default=0)
+    image_count = models.PositiveIntegerField(default=0)
+    active_image_count = models.PositiveIntegerField(default=0)
+    pdf_count = models.PositiveIntegerField(default=0)
+    text_count = models.PositiveIntegerField(default=0)
+    active_text_count = models.PositiveIntegerField(default=0)
+
 
     def get_absolute_url(self):
         return_cid = self.id
@@ -212,10 +310,7 @@ class Collection(models.Model):
     def has_images(self):
         '''has_images will return True if a collection has entities with images.
         '''
-        count = 0
-        for entity in self.entity_set.all():
-            count += entity.image_entity.count()
-        if count > 0:
+        if self.image_count > 0:
             return True
         return False
 
@@ -229,28 +324,19 @@ class Collection(models.Model):
         '''get_annotations will return a nicely formatted dictionary with common
         annotation labels (keys) and options list in (values)
         '''
-        annotations = self.allowed_annotations.all()
-        summary = dict()
-        for annot in annotations:
-            if annot.name not in summary:
-                summary[annot.name] = []
-            if annot.label not in summary[annot.name]:
-                summary[annot.name].append(annot.label)
-        return summary
+        return get_collection_schema(self).get_options()
     
         
     def has_text(self):
         '''has_text will return True if a collection has entities with text.
         '''
-        count = 0
-        for entity in self.entity_set.all():
-            count += entity.text_entity.count()
-        if count > 0:
+        if self.text_count > 0:
             return True
         return False
 
 
     def save(self, *args, **kwargs):
+        kwargs = get_save_kwargs(self,content_counters + ['entity_count'],kwargs)
         super(Collection, self).save(*args, **kwargs)
         assign_perm('del_collection', self.owner, self)
         assign_perm('edit_collection', self.owner, self)
@@ -283,6 +369,12 @@ class Image(models.Model):
     active = models.BooleanField(choices=ACTIVE_CHOICES, 
                                   default=True,
                                   verbose_name="active for annotation and markup")
+    content_type = models.CharField(max_length=25, choices=CONTENT_TYPES, 
+                                    default="unknown", db_index=True,
+                                    help_text="type of the image, classified on import")
+    parent = models.ForeignKey('self',related_name="pages",null=True,blank=True,
+                               help_text="the pdf that the image is a rendered page of")
+    page = models.PositiveIntegerField(null=True,blank=True)
     tags = TaggableManager()
 
     def get_label(self):
@@ -293,15 +385,8 @@ class Image(models.Model):
         unique_together =  (("entity", "uid"),)
 
     def is_pdf(self):
-        if hasattr(self,'imagelink'):
-            if self.imagelink.url.endswith('pdf'):
-                return True
-        elif hasattr(self,'imagefile'):
-            if self.imagefile.original.url.endswith('pdf'):
-                return True
-        else:
-            if self.original.url.endswith('pdf'):
-                return True
+        if self.content_type == "pdf":
+            return True
         return False
 
     def get_basename(self):
@@ -316,8 +401,13 @@ class Image(models.Model):
             return self.imagelink.url
         elif hasattr(self,'imagefile'):
             return self.imagefile.original.url
-        else:
-            return self.original.url
+        return None
+
+
+    def get_display_url(self):
+        if hasattr(self,'imagefile'):
+            return self.imagefile.get_display_url()
+        return self.get_url()
 
 
     def get_path(self):
@@ -325,8 +415,7 @@ class Image(models.Model):
             return self.imagelink.url
         elif hasattr(self,'imagefile'):
             return self.imagefile.original.path
-        else:
-            return self.original.path
+        return None
 
 
     def __str__(self):
@@ -342,11 +431,41 @@ class ImageFile(Image):
        file, and then markups of it.
     '''
     original = models.FileField(upload_to=get_upload_folder,null=True,blank=True)
+    width = models.PositiveIntegerField(null=True,blank=True)
+    height = models.PositiveIntegerField(null=True,blank=True)
+    has_derivatives = models.BooleanField(default=False,
+                                          help_text="thumbnail, display image, and tiles are made (see tiles.py)")
+    derivatives_version = models.CharField(max_length=16,null=True,blank=True,
+                                           help_text="the version (digest of the original) of the derivatives")
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super(ImageFile, cls).from_db(db, field_names, values)
+        instance._loaded_original = dict(zip(field_names,values)).get('original')
+        return instance
      
     @models.permalink
     def get_absolute_url(self):
         return ('upload-new', )
 
+    def get_thumbnail_url(self):
+        if self.has_derivatives and self.derivatives_version:
+            return get_derivative_url(self.id,self.derivatives_version,'thumbnail.jpg')
+        return self.original.url
+
+    def get_display_url(self):
+        '''get_display_url returns the url of the image to send to the markup tools,
+        sized for display, or the original if derivatives aren't made yet'''
+        if self.has_derivatives and self.derivatives_version:
+            return get_derivative_url(self.id,self.derivatives_version,'display.jpg')
+        return self.original.url
+
+    def get_tile_source(self):
+        '''get_tile_source returns the url of the deep zoom descriptor, or None'''
+        if self.has_derivatives and self.derivatives_version:
+            return get_derivative_url(self.id,self.derivatives_version,'tiles.dzi')
+        return None
+
     def get_url(self):
         return self.original.url
 
@@ -361,7 +480,13 @@ class ImageFile(Image):
 
     def save(self, *args, **kwargs):
         self.slug = self.original.name
+
+        # A new original (e.g., imported again) needs new derivatives
+        loaded = getattr(self,'_loaded_original',None)
+        if isinstance(loaded,str) and loaded != self.original.name:
+            self.has_derivatives = False
         super(Image, self).save(*args, **kwargs)
+        self._loaded_original = self.original.name
 
     def delete(self, *args, **kwargs):
         """delete -- Remove to leave file."""
@@ -374,10 +499,10 @@ class ImageLink(Image):
     url = models.TextField(null=False, blank=False)
      
     def get_url(self):
-        return self.original
+        return self.url
 
     def get_file_name(self):
-        return self.original.split('/')[-1]
+        return self.url.split('/')[-1]
 
     def get_path(self):
         return self.url
@@ -388,6 +513,20 @@ class ImageLink(Image):
 #######################################################################################################
 
 
+class ImageBase(models.Model):
+    '''An image base is the png of an image as it was shown to the markup tools (e.g., a rendered
+       slice of a dicom), saved once for each image and content (sha256), and shared by its markups.
+    '''
+    image = models.ForeignKey(Image,related_name="image_bases",related_query_name="image_base")
+    digest = models.CharField(max_length=64,db_index=True,help_text="sha256 of the base png")
+    base = models.ImageField(upload_to=get_upload_folder,help_text="saved base image as png")
+    add_date = models.DateTimeField('date added', auto_now_add=True)
+
+    class Meta:
+        app_label = 'main'
+        unique_together =  (("image", "digest"),)
+
+
 class ImageMarkup(models.Model):
     '''A markup is like a transparent layer that fits to its matched image (see Image.image_markups). 
        By default of being a markup, it is intended to be used on a 2D image, which means that if 
@@ -405,8 +544,16 @@ class ImageMarkup(models.Model):
                                 help_text="user that created the markup.",verbose_name="Creator")
     base = models.ImageField(upload_to=get_upload_folder,null=True,blank=True, 
                              help_text="saved base image as png")
+    image_base = models.ForeignKey(ImageBase,null=True,blank=True,on_delete=models.SET_NULL,
+                                   help_text="the registered base image (the base is its file)")
     overlay = models.ImageField(upload_to=get_upload_folder,null=True,blank=True,
                                help_text="an overlay is a transparent layer with the markup")
+    mask = models.BinaryField(null=True,blank=True,
+                              help_text="the color indices and alpha of the overlay, compressed (see masks.py)")
+    mask_width = models.PositiveIntegerField(null=True,blank=True)
+    mask_height = models.PositiveIntegerField(null=True,blank=True)
+    mask_palette = models.TextField(null=True,blank=True,
+                                    help_text="the colors (RGB hex, comma separated) the mask was drawn in")
     transformation = JSONField(default={}, 
                      help_text = "a metadata field with the transformation applied to the original image to produce the overlay dimension")
 
@@ -414,6 +561,21 @@ class ImageMarkup(models.Model):
         app_label = 'main'
         unique_together =  (("image", "creator"),("image","team"),)
 
+    def has_overlay(self):
+        if self.mask is not None or self.overlay:
+            return True
+        return False
+
+    def get_overlay_url(self):
+        '''get_overlay_url returns the url of the overlay png, rendered from the mask
+        the first time it is viewed, or the saved overlay of an older markup
+        '''
+        if self.mask is not None:
+            return render_overlay(self.mask,self.mask_width,self.mask_height,self.mask_palette)
+        elif self.overlay:
+            return self.overlay.url
+        return None
+
 
 class ImageDescription(models.Model):
     '''An image description is an open text field to describe an image.
@@ -475,14 +637,14 @@ class Text(models.Model):
     active = models.BooleanField(choices=ACTIVE_CHOICES, 
                                   default=True,
                                   verbose_name="active for annotation and markup")
+    content_type = models.CharField(max_length=25, choices=CONTENT_TYPES, 
+                                    default="unknown", db_index=True,
+                                    help_text="type of the text, classified on import")
     tags = TaggableManager()
 
     def is_xml(self):
-        if self.get_url().endswith('xml'):
+        if self.content_type == "xml":
             return True
-        for tag in self.tags.all():
-            if tag.name == "xml":
-                return True
         return False
 
     def get_basename(self):
@@ -500,18 +662,25 @@ class Text(models.Model):
         if hasattr(self,'textlink'):
             return self.textlink.original
         elif hasattr(self,'textfile'):
-            return self.textfile.original
-        else:
-            return self.original
+            return self.textfile.uid
+        return None
+
+    def get_original(self):
+        '''get_original returns the original of a text as the api serves it: the url
+        of linked text, and the body of a text file
+        '''
+        if hasattr(self,'textlink'):
+            return self.textlink.original
+        elif hasattr(self,'textfile'):
+            return self.textfile.get_text()
+        return None
 
     def get_text(self):
         if hasattr(self,'textlink'):
-            response = requests.get(self.textlink.original)
-            return response.text
+            return get_content(self.textlink.original)
         elif hasattr(self,'textfile'):
-            return self.textfile.original.replace('\n','<br>')
-        else:
-            return self.original
+            return self.textfile.get_text().replace('\n','<br>')
+        return None
 
     def __str__(self):
         return "%s" %(self.uid)
@@ -527,16 +696,33 @@ class Text(models.Model):
 
 
 class TextFile(Text):
-    '''A "text file" is a text object with an associated file
+    '''A "text file" is a text object with an associated file. The body is kept in the
+       blob store (see blobs.py), referenced by its hash. Bodies saved before the blob store
+       are in original, until moved (see the move_text_blobs command).
     '''
-    original = models.TextField(null=False, blank=False)
+    original = models.TextField(null=True, blank=True)
+    blob = models.CharField(max_length=64, null=True, blank=True, db_index=True,
+                            help_text="sha256 of the body in the blob store")
     
     def get_folder_name(self):
         return self.uid.split('/')[0]
 
     def get_text(self):
+        if self.blob is not None:
+            return read_blob(self.blob)
         return self.original
 
+    def open_text(self):
+        '''open_text returns a file object to stream the body'''
+        if self.blob is not None:
+            return open_blob(self.blob)
+        return io.StringIO(self.original or '')
+
+    def set_text(self,content):
+        '''set_text stores a body in the blob store, and references it (call save after)'''
+        self.blob = put_blob(content)
+        self.original = None
+
     def get_file_name(self):
         return self.uid.split('/')[-1]
 
@@ -551,8 +737,7 @@ class TextLink(Text):
         return self.original.split('/')[-1]
 
     def get_text(self):
-        response = requests.get(self.original)
-        return response.text
+        return get_content(self.original)
 
 
 class TextDescription(models.Model):
@@ -623,8 +808,17 @@ class TextAnnotation(models.Model):
         app_label = 'main'
 
 
-def contributors_changed(sender, instance, action, **kwargs):
+def contributors_changed(sender, instance, action, reverse=False, pk_set=None, **kwargs):
+    from docfish.apps.main.permission import invalidate_collection_permissions
     if action in ["post_remove", "post_add", "post_clear"]:
+
+        # Cached permissions of the collections (or of the user's collections, if reverse)
+        if reverse:
+            for cid in pk_set or []:
+                invalidate_collection_permissions(cid)
+            return
+        invalidate_collection_permissions(instance.id)
+
         current_contributors = set([user.pk for user in get_users_with_perms(instance)])
         new_contributors = set([user.pk for user in [instance.owner, ] + list(instance.contributors.all())])
 
@@ -638,4 +832,527 @@ def contributors_changed(sender, instance, action, **kwargs):
 
 
 
+def collection_saved(sender, instance, created, **kwargs):
+    '''when a collection is saved (e.g., given a new owner), cached permissions are looked up again'''
+    if not created:
+        from docfish.apps.main.permission import invalidate_collection_permissions
+        invalidate_collection_permissions(instance.id)
+
+
 m2m_changed.connect(contributors_changed, sender=Collection.contributors.through)
+post_save.connect(collection_saved, sender=Collection)
+
+
+def allowed_annotations_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    '''when the allowed annotations of a collection change, its label schema is rebuilt'''
+    if action in ["post_remove", "post_add", "post_clear"]:
+        if reverse:
+            cids = pk_set or []
+        else:
+            cids = [instance.id]
+        for cid in cids:
+            invalidate_schema(cid)
+
+
+def annotation_saved(sender, instance, created, **kwargs):
+    '''when an allowed annotation is changed, the collections that use it rebuild their schema'''
+    if not created:
+        for cid in instance.collection_allowed_annotations.values_list('id',flat=True):
+            invalidate_schema(cid)
+
+m2m_changed.connect(allowed_annotations_changed, sender=Collection.allowed_annotations.through)
+post_save.connect(annotation_saved, sender=Annotation)
+
+
+
+#######################################################################################################
+# Storage #############################################################################################
+#######################################################################################################
+
+def select_storage(queryset):
+    '''select_storage joins the file and link tables (the subclass that holds the storage) 
+    to a queryset of images or text, so that get_url, get_path, and get_text of each row 
+    don't need a query (or two) to find out which one it is.
+    :param queryset: a queryset of Image or Text
+    '''
+    if issubclass(queryset.model,Image):
+        return queryset.select_related('imagefile','imagelink')
+    return queryset.select_related('textfile','textlink')
+
+
+def image_file_saved(sender, instance, **kwargs):
+    '''when an image file (that Pillow can read) is saved without derivatives, the worker
+    is asked to make them, once the save is committed
+    '''
+    if instance.original and instance.has_derivatives == False and instance.content_type == "image":
+        original = hashlib.md5(instance.original.name.encode('utf-8')).hexdigest()
+        if cache.add("derivatives-%s-%s" %(instance.id,original),True,60*10):
+            from docfish.apps.main.tasks import make_image_derivatives
+            image_id = instance.id
+            transaction.on_commit(lambda: make_image_derivatives.apply_async(kwargs={"image_id":image_id}))
+
+post_save.connect(image_file_saved, sender=ImageFile)
+
+
+def pdf_saved(sender, instance, **kwargs):
+    '''when a pdf image (that isn't yet rendered) is saved, the worker is asked to render
+    its pages into images of the same entity, once the save is committed
+    '''
+    if instance.content_type != "pdf" or instance.parent_id is not None:
+        return
+    if isinstance(instance,ImageFile) and not instance.original:
+        return
+    if instance.pages.exists() == False:
+        if cache.add("pages-%s" %instance.id,True,60*10):
+            from docfish.apps.main.tasks import rasterize_pdf_pages
+            image_id = instance.id
+            transaction.on_commit(lambda: rasterize_pdf_pages.apply_async(kwargs={"image_id":image_id}))
+
+for image_model in [Image,ImageFile,ImageLink]:
+    post_save.connect(pdf_saved, sender=image_model)
+
+
+def get_entity_storage(entities):
+    '''get_entity_storage returns a queryset of entities with their images and text
+    (and storage) fetched in two more queries, for listing the content of many entities
+    :param entities: a queryset of entities
+    '''
+    return entities.prefetch_related(models.Prefetch('image_entity',queryset=select_storage(Image.objects.all())),
+                                     models.Prefetch('text_entity',queryset=select_storage(Text.objects.all())))
+
+
+#######################################################################################################
+# Content Counts ######################################################################################
+#######################################################################################################
+
+# The counters kept for the images and text of each entity (and summed for each collection)
+# are content_counters, defined with the Entity model
+
+# Images that are pdfs, as determined by Image.is_pdf
+pdf_images = Q(content_type='pdf')
+
+
+def count_when(condition):
+    '''count_when returns an aggregate counting the rows that meet a condition'''
+    return models.Sum(models.Case(models.When(condition,then=1),
+                                  default=0,
+                                  output_field=models.IntegerField()))
+
+
+def count_entity_content(entity_ids):
+    '''count_entity_content counts the images and text of one or more entities, with one grouped 
+    query for each, returning a dictionary of counters for each entity id
+    '''
+    counts = dict([(entity_id,dict([(c,0) for c in content_counters])) for entity_id in entity_ids])
+    images = Image.objects.filter(entity_id__in=entity_ids).order_by().values('entity_id')
+    images = images.annotate(image_count=models.Count('id'),
+                             active_image_count=count_when(Q(active=True)),
+                             pdf_count=count_when(pdf_images))
+    texts = Text.objects.filter(entity_id__in=entity_ids).order_by().values('entity_id')
+    texts = texts.annotate(text_count=models.Count('id'),
+                           active_text_count=count_when(Q(active=True)))
+    for row in chain(images,texts):
+        entity_id = row.pop('entity_id')
+        counts[entity_id].update(row)
+    return counts
+
+
+def change_content_counts(entity_id,changes):
+    '''change_content_counts adds changes (a dictionary of counter and amount) to the counters
+    of an entity and of the collections that it belongs to.
+    '''
+    changes = dict([(c,models.F(c) + change) for c,change in changes.items() if change != 0])
+    if len(changes) > 0:
+        Entity.objects.filter(id=entity_id).update(**changes)
+        Collection.objects.filter(entity_set__id=entity_id).update(**changes)
+
+
+def content_saved(sender, instance, **kwargs):
+    '''when an image or text is saved (added, activated, or deactivated), the entity 
+    is recounted, and the difference applied to it and its collections
+    '''
+    current = Entity.objects.filter(id=instance.entity_id).values(*content_counters).first()
+    if current is not None:
+        counts = count_entity_content([instance.entity_id])[instance.entity_id]
+        change_content_counts(instance.entity_id,
+                              dict([(c,counts[c] - current[c]) for c in content_counters]))
+
+
+def content_deleted(sender, instance, **kwargs):
+    '''before an image or text is deleted, it is removed from the counts of its
+    entity and collections (this is before the entity, if it is also being deleted)
+    '''
+    active = -1 if instance.active == True else 0
+    if sender == Image:
+        pdf = -1 if instance.is_pdf() else 0
+        changes = {'image_count':-1,'active_image_count':active,'pdf_count':pdf}
+    else:
+        changes = {'text_count':-1,'active_text_count':active}
+    change_content_counts(instance.entity_id,changes)
+
+
+def entity_deleted(sender, instance, **kwargs):
+    '''before an entity is deleted, it is removed from the entity count of its collections
+    (its images and text remove themselves)
+    '''
+    Collection.objects.filter(entity_set__id=instance.id).update(entity_count=models.F('entity_count') - 1)
+
+
+def entities_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    '''when entities are added to or removed from a collection, they are added to or 
+    removed from its counts.
+    '''
+    if action not in ["post_add","post_remove","pre_clear"]:
+        return
+
+    # The collection (or entity, if reverse) changed, and the entities (or collections) added or removed
+    if reverse:
+        entity_ids = [instance.id]
+        collection_ids = pk_set
+        if action == "pre_clear":
+            collection_ids = list(instance.collection.values_list('id',flat=True))
+    else:
+        collection_ids = [instance.id]
+        entity_ids = pk_set
+        if action == "pre_clear":
+            entity_ids = list(instance.entity_set.values_list('id',flat=True))
+
+    if not entity_ids or not collection_ids:
+        return
+
+    sign = 1 if action == "post_add" else -1
+    totals = Entity.objects.filter(id__in=list(entity_ids)).aggregate(*[models.Sum(c) for c in content_counters])
+    changes = {'entity_count':models.F('entity_count') + sign * len(entity_ids)}
+    for c in content_counters:
+        changes[c] = models.F(c) + sign * (totals['%s__sum' %c] or 0)
+    Collection.objects.filter(id__in=list(collection_ids)).update(**changes)
+
+
+# Saving a subclass (e.g., ImageFile) sends signals with it as sender, deleting sends them for all
+for content_model in [Image,ImageFile,ImageLink,Text,TextFile,TextLink]:
+    post_save.connect(content_saved, sender=content_model)
+
+pre_delete.connect(content_deleted, sender=Image)
+pre_delete.connect(content_deleted, sender=Text)
+pre_delete.connect(entity_deleted, sender=Entity)
+m2m_changed.connect(entities_changed, sender=Collection.entity_set.through)
+
+
+#######################################################################################################
+# Leases ##############################################################################################
+#######################################################################################################
+
+
+class ItemLease(models.Model):
+    '''An item lease reserves an image or text for one member of a team working on a task,
+       so that two members are not served the same item at the same time. A lease is 
+       released when the team saves its work for the item, and an expired lease is free 
+       to be claimed again.
+    '''
+    collection = models.ForeignKey(Collection)
+    team = models.ForeignKey('users.Team')
+    holder = models.ForeignKey(User,related_name="holder_of_item_lease",
+                               related_query_name="holder_of_item_lease",
+                               help_text="team member that holds the lease.",verbose_name="Holder")
+    task = models.CharField(max_length=50, null=False, blank=False,
+                            help_text="task the item is leased for, as named in Collection.status")
+    item_id = models.PositiveIntegerField(help_text="id of the leased image or text")
+    expires_at = models.DateTimeField('date of expiration', db_index=True)
+
+    def __str__(self):
+        return "%s:%s:%s" %(self.task,self.item_id,self.holder_id)
+
+    def __unicode__(self):
+        return "%s:%s:%s" %(self.task,self.item_id,self.holder_id)
+
+    def get_label(self):
+        return "main"
+
+    class Meta:
+        app_label = 'main'
+        unique_together =  (("collection","team","task","item_id"),)
+
+
+#######################################################################################################
+# Item Counts #########################################################################################
+#######################################################################################################
+
+
+class ItemCount(models.Model):
+    '''An item count is the number of annotators (users or teams) that have done a task for an 
+       image or text in a collection. It is kept up to date as work is saved and deleted, and 
+       indexed so that the items furthest below a collection's redundancy target come first.
+    '''
+    collection = models.ForeignKey(Collection)
+    task = models.CharField(max_length=50, null=False, blank=False,
+                            help_text="task that is counted, as named in Collection.status")
+    item_id = models.PositiveIntegerField(help_text="id of the counted image or text")
+    count = models.IntegerField(default=0,help_text="number of annotators that have done the task")
+
+    def __str__(self):
+        return "%s:%s:%s" %(self.task,self.item_id,self.count)
+
+    def __unicode__(self):
+        return "%s:%s:%s" %(self.task,self.item_id,self.count)
+
+    def get_label(self):
+        return "main"
+
+    class Meta:
+        app_label = 'main'
+        unique_together =  (("collection","task","item_id"),)
+        index_together = (("collection","task","count"),)
+
+
+#######################################################################################################
+# Collection Stats ####################################################################################
+#######################################################################################################
+
+
+class CollectionStat(models.Model):
+    '''A collection stat is the number of markups, descriptions, or annotations done for a task
+       in a collection by one creator (null for work with no creator), and for annotations, with 
+       one label. Stats are kept up to date as work is saved and deleted, and reconciled with 
+       the work itself periodically (see tasks.reconcile_stats), so the statistics pages read 
+       a handful of rows instead of counting the work.
+    '''
+    collection = models.ForeignKey(Collection)
+    task = models.CharField(max_length=50, null=False, blank=False,
+                            help_text="task that is counted, as named in Collection.status")
+    creator = models.ForeignKey(User,related_name="creator_of_collection_stat", null=True,
+                                related_query_name="creator_of_collection_stat", blank=True,
+                                help_text="user that did the work.",verbose_name="Creator")
+    annotation = models.ForeignKey(Annotation,null=True,blank=True,
+                                   related_name="annotation_of_collection_stat",
+                                   related_query_name="annotation_of_collection_stat")
+    count = models.IntegerField(default=0,help_text="number of markups, descriptions, or annotations")
+
+    def __str__(self):
+        return "%s:%s:%s" %(self.task,self.creator_id,self.count)
+
+    def __unicode__(self):
+        return "%s:%s:%s" %(self.task,self.creator_id,self.count)
+
+    def get_label(self):
+        return "main"
+
+    class Meta:
+        app_label = 'main'
+        unique_together =  (("collection","task","creator","annotation"),)
+
+
+#######################################################################################################
+# Tasks ###############################################################################################
+#######################################################################################################
+
+# The model that holds the work for each task, keyed as in Collection.status
+
+task_models = {'text_annotation': TextAnnotation,
+               'text_describe': TextDescription,
+               'text_markup': TextMarkup,
+               'image_annotation': ImageAnnotation,
+               'image_describe': ImageDescription,
+               'image_markup': ImageMarkup}
+
+
+def get_task(sender):
+    '''get_task returns the task (key in Collection.status) for a markup, 
+    description, or annotation model, or None if the model is not for a task.
+    '''
+    for task,model in task_models.items():
+        if sender == model:
+            return task
+    return None
+
+
+def get_item_id(instance):
+    '''get_item_id returns the id of the image or text that a markup, description,
+    or annotation is for.
+    '''
+    if hasattr(instance,'image_id'):
+        return instance.image_id
+    return instance.text_id
+
+
+def get_queue_keys(task,instance):
+    '''get_queue_keys returns the work queue keys (for the creator and team) that
+    a markup, description, or annotation instance affects.
+    '''
+    keys = []
+    if instance.creator_id is not None:
+        keys.append(get_queue_key(task,instance.collection_id,user_id=instance.creator_id))
+    if instance.team_id is not None:
+        keys.append(get_queue_key(task,instance.collection_id,team_id=instance.team_id))
+    return keys
+
+
+def get_annotator_work(sender,instance):
+    '''get_annotator_work returns a queryset of all the work of the creator (or team) of
+    an instance on the same item and collection, including the instance. Annotations can have
+    more than one row per annotator (one per label), other tasks have one.
+    '''
+    work = sender.objects.filter(collection_id=instance.collection_id)
+    if hasattr(instance,'image_id'):
+        work = work.filter(image_id=instance.image_id)
+    else:
+        work = work.filter(text_id=instance.text_id)
+    if instance.team_id is not None:
+        return work.filter(team_id=instance.team_id)
+    return work.filter(creator_id=instance.creator_id)
+
+
+def count_item(task,instance,change):
+    '''count_item changes the ItemCount of the item an instance is for.
+    :param change: the amount to add (1) or remove (-1)
+    '''
+    item_count,created = ItemCount.objects.get_or_create(collection_id=instance.collection_id,
+                                                         task=task,
+                                                         item_id=get_item_id(instance))
+    ItemCount.objects.filter(id=item_count.id).update(count=models.F('count') + change)
+
+
+def count_stat(task,instance,change):
+    '''count_stat changes the CollectionStat of the creator (and label, for annotations)
+    of an instance.
+    :param change: the amount to add (1) or remove (-1)
+    '''
+    stat,created = CollectionStat.objects.get_or_create(collection_id=instance.collection_id,
+                                                        task=task,
+                                                        creator_id=instance.creator_id,
+                                                        annotation_id=getattr(instance,'annotation_id',None))
+    CollectionStat.objects.filter(id=stat.id).update(count=models.F('count') + change)
+
+
+def count_teams(instance,change):
+    '''count_teams changes the annotation count of the team of an instance, and of the
+    teams that the creator is a member of.
+    :param change: the amount to add (1) or remove (-1)
+    '''
+    from docfish.apps.users.models import Team
+    if instance.team_id is not None:
+        Team.objects.filter(id=instance.team_id).update(annotation_count=models.F('annotation_count') + change)
+    if instance.creator_id is not None:
+        Team.objects.filter(members__id=instance.creator_id).update(annotation_count=models.F('annotation_count') + change)
+
+
+# Work saved and deleted together (see bulk_update_annotations) is counted once for the
+# batch (see count_batch), and not by the signals for each row, in the thread doing it
+_batches = threading.local()
+
+@contextmanager
+def batch_task_signals():
+    '''batch_task_signals turns off task_saved and task_deleted (for this thread) within it'''
+    _batches.active = True
+    try:
+        yield
+    finally:
+        _batches.active = False
+
+
+def count_stats(task,instance,changes):
+    '''count_stats changes the CollectionStat of the creator of an instance for several labels,
+    with one update for each distinct change (usually one)
+    :param changes: a dictionary of annotation id and the amount to add (or remove)
+    '''
+    stats = CollectionStat.objects.filter(collection_id=instance.collection_id,
+                                          task=task,
+                                          creator_id=instance.creator_id)
+    ids = dict(stats.filter(annotation_id__in=list(changes.keys())).values_list('annotation_id','id'))
+    for annotation_id in changes:
+        if annotation_id not in ids:
+            stat,created = stats.get_or_create(annotation_id=annotation_id)
+            ids[annotation_id] = stat.id
+    for change in set(changes.values()):
+        if change != 0:
+            stat_ids = [ids[aid] for aid,amount in changes.items() if amount == change]
+            CollectionStat.objects.filter(id__in=stat_ids).update(count=models.F('count') + change)
+
+
+def count_batch(sender,instance,added,removed,had_work):
+    '''count_batch does what task_saved and task_deleted do, once, for annotations of an annotator 
+    on one item, created and deleted together (with batch_task_signals)
+    :param instance: an (unsaved) annotation with the collection, item, creator, and team
+    :param added: the annotation ids of the rows created
+    :param removed: the annotation ids of the rows deleted
+    :param had_work: True if the annotator had work on the item before
+    '''
+    task = get_task(sender)
+    if len(added) == 0 and len(removed) == 0:
+        return
+
+    for key in get_queue_keys(task,instance):
+        if len(removed) > 0:
+            clear_queue(key)
+        else:
+            discard_queue_item(key,get_item_id(instance))
+
+    changes = collections.Counter(added)
+    changes.subtract(collections.Counter(removed))
+    count_stats(task,instance,dict(changes))
+    if len(added) != len(removed):
+        count_teams(instance,len(added) - len(removed))
+
+    has_work = get_annotator_work(sender,instance).exists()
+    if has_work and not had_work:
+        count_item(task,instance,1)
+    elif had_work and not has_work:
+        count_item(task,instance,-1)
+
+    if instance.team_id is not None and len(added) > 0:
+        ItemLease.objects.filter(collection_id=instance.collection_id,
+                                 team_id=instance.team_id,
+                                 task=task,
+                                 item_id=get_item_id(instance)).delete()
+
+
+def task_saved(sender, instance, created, **kwargs):
+    '''when a markup, description, or annotation is saved, the item is removed from
+    the work queues of the creator and team, the collection stats, team annotation counts,
+    and item count go up (the latter for the first work of the annotator on it), and any 
+    team lease on it is released.
+    '''
+    if getattr(_batches,'active',False):
+        return
+    task = get_task(sender)
+    for key in get_queue_keys(task,instance):
+        discard_queue_item(key,get_item_id(instance))
+
+    if created:
+        count_stat(task,instance,1)
+        count_teams(instance,1)
+
+        # The first work of an annotator on the item counts toward redundancy
+        if not get_annotator_work(sender,instance).filter(id__lt=instance.id).exists():
+            count_item(task,instance,1)
+
+    # Work for a team releases the lease on the item
+    if instance.team_id is not None:
+        ItemLease.objects.filter(collection_id=instance.collection_id,
+                                 team_id=instance.team_id,
+                                 task=task,
+                                 item_id=get_item_id(instance)).delete()
+
+
+def task_deleted(sender, instance, **kwargs):
+    '''when a markup, description, or annotation is deleted, the item can be 
+    seen again, so the work queues are rebuilt on next use, and the collection stats, team
+    annotation counts, and item count go down (the latter if it was the last work of the 
+    annotator on it).
+    '''
+    if getattr(_batches,'active',False):
+        return
+    task = get_task(sender)
+    for key in get_queue_keys(task,instance):
+        clear_queue(key)
+
+    count_stat(task,instance,-1)
+    count_teams(instance,-1)
+
+    # The last work of an annotator on the item no longer counts
+    if not get_annotator_work(sender,instance).exists():
+        count_item(task,instance,-1)
+
+
+for task_model in task_models.values():
+    post_save.connect(task_saved, sender=task_model)
+    post_delete.connect(task_deleted, sender=task_model)
@@ -23,28 +23,43 @@ SOFTWARE.
 '''
 
 from docfish.apps.main.models import *
-from itertools import chain
-from random import choice
+from docfish.apps.main.queues import (
+    fill_queue,
+    get_queue_key,
+    has_queue,
+    lock_refill,
+    needs_refill,
+    peek_queue,
+    pop_queue
+)
+from docfish.apps.main.prefetch import prefetch_text_ids
+from docfish.apps.main.tasks import refill_queue
+from docfish.settings import (
+    ANNOTATION_QUEUE_SIZE,
+    CONTENT_PREFETCH_COUNT
+)
+from random import (
+    sample,
+    shuffle
+)
 
 #############################################################################################
 # Collection Level Selection (Images)
 #############################################################################################
 
 def get_contenders(collection,active=True,get_images=True):
-    '''get contenders will return contender (images or text) across a set of entities.
+    '''get contenders will return a queryset of contenders (images or text) across the
+    entities of a collection. The queryset is lazy, so the selection (and filtering out
+    of seen items) is done in the database.
     :param collection: the collection to get entities from
     :param active: return active or inactive (default active)
     :param get_images: if true, return images. Else, return text
     '''
-    contenders = []
-    for entity in collection.entity_set.all():
-        if get_images == True:
-            image_set = entity.image_entity.exclude(tags__name="pdf")
-            contenders = list(chain(contenders,image_set.filter(active=active)))    
-        else:
-            text_set = entity.text_entity.exclude(tags__name="pdf")
-            contenders = list(chain(contenders,text_set.filter(active=active)))
-    return contenders
+    if get_images == True:
+        contenders = Image.objects.filter(entity__collection=collection)
+    else:
+        contenders = Text.objects.filter(entity__collection=collection)
+    return contenders.filter(active=active).exclude(content_type="pdf")
 
 
 def get_next_to_markup(user,collection,get_images=True,team=None,N=1,skip=None):
@@ -55,20 +70,34 @@ def get_next_to_markup(user,collection,get_images=True,team=None,N=1,skip=None):
     :param collection: the collection to use
     :param get_images: when True, filter to ImageMarkup. Otherwise will return text.
     '''
+    task = "text_markup"
+    if get_images == True:
+        task = "image_markup"
+
+    # Collections with a redundancy target serve the items furthest below it
+    if team is None and get_redundancy(collection,task) is not None:
+        return get_next_by_redundancy(task,user=user,collection=collection,N=N,skip=skip)
+
+    # A single next item is served from the user or team work queue
+    if N == 1 and skip is None:
+        next_item = get_next_from_queue(task,user=user,collection=collection,team=team)
+        if next_item is not None:
+            return next_item
+
     contenders = get_contenders(collection,get_images=get_images)
 
     # Do we want image or text markups?
     if get_images == True:
         if team:
-            previous_markups = ImageMarkup.objects.filter(team=team,image__in=contenders)
+            previous_markups = ImageMarkup.objects.filter(team=team)
         else:
-            previous_markups = ImageMarkup.objects.filter(creator=user,image__in=contenders)
+            previous_markups = ImageMarkup.objects.filter(creator=user)
 
     else:
         if team:
-            previous_markups = TextMarkup.objects.filter(team=team,text__in=contenders)
+            previous_markups = TextMarkup.objects.filter(team=team)
         else:
-            previous_markups = TextMarkup.objects.filter(creator=user,text__in=contenders)
+            previous_markups = TextMarkup.objects.filter(creator=user)
 
     # Return a single unseen image or text
     repeat = False
@@ -87,19 +116,33 @@ def get_next_to_describe(user,collection,get_images=True,team=None,N=1,skip=None
     '''get next to describe will first return images for entities that a user has not seen,
     and then a random selection
     '''
+    task = "text_describe"
+    if get_images == True:
+        task = "image_describe"
+
+    # Collections with a redundancy target serve the items furthest below it
+    if team is None and get_redundancy(collection,task) is not None:
+        return get_next_by_redundancy(task,user=user,collection=collection,N=N,skip=skip)
+
+    # A single next item is served from the user or team work queue
+    if N == 1 and skip is None:
+        next_item = get_next_from_queue(task,user=user,collection=collection,team=team)
+        if next_item is not None:
+            return next_item
+
     contenders = get_contenders(collection,get_images=get_images)
 
     # Do we want image or text markups?
     if get_images == True:
         if team:
-            previous_descriptions = ImageDescription.objects.filter(team=team,image__in=contenders)
+            previous_descriptions = ImageDescription.objects.filter(team=team)
         else:
-            previous_descriptions = ImageDescription.objects.filter(creator=user,image__in=contenders)
+            previous_descriptions = ImageDescription.objects.filter(creator=user)
     else:
         if team:
-            previous_descriptions = TextDescription.objects.filter(team=team,text__in=contenders)
+            previous_descriptions = TextDescription.objects.filter(team=team)
         else:
-            previous_descriptions = TextDescription.objects.filter(creator=user,text__in=contenders)
+            previous_descriptions = TextDescription.objects.filter(creator=user)
 
     # Return a single unseen image or text
     repeat = False
@@ -118,19 +161,33 @@ def get_next_to_annotate(user,collection,get_images=True,team=None,N=1,skip=None
     '''get next to annotate will first return images for entities that a user has not seen,
     and then a random selection
     '''
+    task = "text_annotation"
+    if get_images == True:
+        task = "image_annotation"
+
+    # Collections with a redundancy target serve the items furthest below it
+    if team is None and get_redundancy(collection,task) is not None:
+        return get_next_by_redundancy(task,user=user,collection=collection,N=N,skip=skip)
+
+    # A single next item is served from the user or team work queue
+    if N == 1 and skip is None:
+        next_item = get_next_from_queue(task,user=user,collection=collection,team=team)
+        if next_item is not None:
+            return next_item
+
     contenders = get_contenders(collection,get_images=get_images)
 
     # Do we want image or text markups?
     if get_images == True:
         if team:
-            previous_annotations = ImageAnnotation.objects.filter(team=team,image__in=contenders) 
+            previous_annotations = ImageAnnotation.objects.filter(team=team) 
         else:
-            previous_annotations = ImageAnnotation.objects.filter(creator=user,image__in=contenders)
+            previous_annotations = ImageAnnotation.objects.filter(creator=user)
     else:
         if team:
-            previous_annotations = TextAnnotation.objects.filter(team=team,text__in=contenders)
+            previous_annotations = TextAnnotation.objects.filter(team=team)
         else:
-            previous_annotations = TextAnnotation.objects.filter(creator=user,text__in=contenders)
+            previous_annotations = TextAnnotation.objects.filter(creator=user)
 
     # Return a single unseen image or text
     repeat = False
@@ -146,58 +203,227 @@ def get_next_to_annotate(user,collection,get_images=True,team=None,N=1,skip=None
 
 
 
+#############################################################################################
+# Redundancy
+#############################################################################################
+
+def get_redundancy(collection,task):
+    '''get_redundancy returns the redundancy target for a task in a collection, meaning
+    the number of annotators wanted for each item, or None if there isn't one.
+    :param task: the task, as named in Collection.status (e.g., image_markup)
+    '''
+    if task in collection.status:
+        return collection.status[task].get('redundancy')
+    return None
+
+
+def get_next_by_redundancy(task,user,collection,N=1,skip=None):
+    '''get_next_by_redundancy returns items a user has not seen, starting with the items
+    that have the fewest annotators. Items that have reached the collection redundancy target 
+    are not returned. Items that no one has done are selected randomly, and the rest are 
+    ordered by their (indexed) ItemCount.
+    '''
+    target = get_redundancy(collection,task)
+    get_images = task.startswith('image')
+    remaining = get_unseen_ids(contenders=get_contenders(collection,get_images=get_images),
+                               seen=get_seen(task,user=user),
+                               get_images=get_images,
+                               skip=skip)
+
+    # Items that no one has done yet are furthest below the target
+    item_counts = ItemCount.objects.filter(collection=collection,task=task)
+    uncounted = remaining.exclude(id__in=item_counts.filter(count__gt=0).values('item_id'))
+    count = uncounted.count()
+    selected = select_ids(ids=uncounted,
+                          count=count,
+                          return_number=min(N,count))
+
+    # The rest come from the counts, lowest first
+    if len(selected) < N:
+        below_target = item_counts.filter(count__gt=0,
+                                          count__lt=target,
+                                          item_id__in=remaining).order_by('count')
+        selected = selected + list(below_target.values_list('item_id',flat=True)[:N-len(selected)])
+
+    if len(selected) == 0:
+        return None
+    if get_images == True:
+        rows = Image.objects.in_bulk(selected)
+    else:
+        rows = Text.objects.in_bulk(selected)
+    choices = [rows[x] for x in selected if x in rows]
+    if len(choices) == 1:
+        return choices[0]
+    return choices
+
+
+
+#############################################################################################
+# Work Queues
+#############################################################################################
+
+def get_seen(task,user=None,team=None):
+    '''get_seen returns a queryset of the markups, descriptions, or annotations
+    done for a task by a team or (if no team is provided) a user.
+    :param task: the task, as named in Collection.status (e.g., image_markup)
+    '''
+    model = task_models[task]
+    if team is not None:
+        return model.objects.filter(team=team)
+    return model.objects.filter(creator=user)
+
+
+def build_queue(task,collection,user=None,team=None):
+    '''build_queue returns a shuffled list of (at most ANNOTATION_QUEUE_SIZE) ids 
+    of images or text that a user or team has not yet seen for a task.
+    '''
+    get_images = task.startswith('image')
+    contenders = get_contenders(collection,get_images=get_images)
+    ids = list(get_unseen_ids(contenders=contenders,
+                              seen=get_seen(task,user=user,team=team),
+                              get_images=get_images))
+    shuffle(ids)
+    return ids[:ANNOTATION_QUEUE_SIZE]
+
+
+def get_next_from_queue(task,user,collection,team=None):
+    '''get_next_from_queue returns the next image or text from the work queue of a
+    user (or team) for a task, building the queue on first use. The queue is refilled
+    in the background when it runs low. None is returned if the queue is exhausted.
+    '''
+    user_id = None
+    team_id = None
+    if team is not None:
+        team_id = team.id
+    else:
+        user_id = user.id
+    key = get_queue_key(task,collection.id,user_id=user_id,team_id=team_id)
+
+    if not has_queue(key):
+        fill_queue(key,build_queue(task,collection,user=user,team=team))
+
+    get_images = task.startswith('image')
+    contenders = get_contenders(collection,get_images=get_images)
+    seen = get_seen(task,user=user,team=team)
+
+    next_item = None
+    item_id = pop_queue(key)
+    while item_id is not None:
+
+        # The item must still be active, and not seen through another route
+        if get_images == True:
+            already_seen = seen.filter(image_id=item_id).exists()
+        else:
+            already_seen = seen.filter(text_id=item_id).exists()
+        if not already_seen:
+            next_item = contenders.filter(id=item_id).first()
+            if next_item is not None:
+                break
+        item_id = pop_queue(key)
+
+    if needs_refill(key) and lock_refill(key):
+        refill_queue.apply_async(kwargs={"task":task,
+                                         "cid":collection.id,
+                                         "user_id":user_id,
+                                         "team_id":team_id})
+
+    # Linked text that comes next is fetched while this item is worked on
+    if get_images == False:
+        prefetch_text_ids(peek_queue(key,CONTENT_PREFETCH_COUNT))
+    return next_item
+
+
+
 #############################################################################################
 # Image Filtering
 #############################################################################################
 
 
+def get_unseen_ids(contenders,seen,get_images=True,skip=None):
+    '''get unseen ids will return a (lazy) queryset of contenders that are not in
+    the seen set. The anti-join is done in the database with a subquery, so no
+    model instances are loaded.
+    :param contenders: a queryset of images or text to select from
+    :param seen: a queryset of markups, descriptions, or annotations already done
+    :param skip: one or more ids to also exclude
+    '''
+    if get_images == True:
+        already_seen = seen.values('image_id')
+    else:
+        already_seen = seen.values('text_id')
+
+    remaining = contenders.exclude(id__in=already_seen)
+    if skip is not None:
+        if not isinstance(skip,list):
+            skip = [skip]
+        remaining = remaining.exclude(id__in=skip)
+    return remaining.order_by('id').values_list('id',flat=True)
+
+
+def select_ids(ids,count,return_number,random_select=True):
+    '''select ids will pick return_number ids from an ordered values_list queryset
+    of ids, without pulling the full list out of the database. Each random choice is
+    a single row fetched by offset.
+    :param ids: an ordered queryset of ids (see get_unseen_ids)
+    :param count: the number of ids in the queryset
+    :param return_number: the number of ids to select
+    :param random_select: if False, take first off list
+    '''
+    if not random_select:
+        return list(ids[:return_number])
+
+    selected = []
+    for offset in sample(range(count),return_number):
+        try:
+            selected.append(ids[offset])
+
+        # The set can change under us between count and selection
+        except IndexError:
+            continue
+    return selected
+
+
 def get_unseen(contenders,seen,return_number=None,get_images=True,repeat=False,
                random_select=True,skip=None):
     '''get unseen images will take a set of seen_images and a set of contenders
     and return one (in case of return_single is True) or a set of unseen images
     :param return_single: randomly select from the set
-    :param seen: a list of already seen images
-    :param contenders: all images to select from
+    :param seen: a queryset of already seen images
+    :param contenders: a queryset of all images to select from
     :param return_number: if None, will return all
     :param repeat: allow the user to select from seen, otherwise return None.
     default is False, the user does not annotate twice.
     :param random_select: if False, take first off list
     :param skip: skip over one or more images (in the case of already being selected)
     '''
-    if get_images == True:
-        already_seen = [saw.image.id for saw in seen]
-    else:
-        already_seen = [saw.text.id for saw in seen]
-
-    if skip is not None:
-        if not isinstance(skip,list):
-            skip = [skip]
-        already_seen = already_seen + skip
-
-    remaining = [c for c in contenders if c.id not in already_seen]
+    remaining = get_unseen_ids(contenders=contenders,
+                               seen=seen,
+                               get_images=get_images,
+                               skip=skip)
+    count = remaining.count()
 
     # If there are unseen, filter to them
-    if len(remaining) > 0: 
+    if count > 0: 
         selection = remaining
 
     # Otherwise select randomly from all
     else:
         if repeat == False:
             return None
-        selection = contenders
+        selection = contenders.order_by('id').values_list('id',flat=True)
+        count = selection.count()
 
     # User wants to return all, or wants more than we have
-    if return_number == None or return_number > len(selection):
-        return selection
+    if return_number == None or return_number > count:
+        return list(contenders.model.objects.filter(id__in=selection).order_by('id'))
     
-    # or randomly select one from it
-    choices = []
-    for c in range(return_number):
-        if random_select:
-            idx = choice(range(0,len(selection)))
-        else:
-            idx = 0
-        choices.append(selection.pop(idx))
+    # or randomly select from it, and only then retrieve the rows
+    selected = select_ids(ids=selection,
+                          count=count,
+                          return_number=return_number,
+                          random_select=random_select)
+    rows = contenders.model.objects.in_bulk(selected)
+    choices = [rows[x] for x in selected if x in rows]
     if len(choices) == 1:
         return choices[0]
     return choices
@@ -0,0 +1,135 @@
+'''
+
+Copyright (c) 2017 Vanessa Sochat
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+'''
+
+from docfish.settings import (
+    MEDIA_ROOT,
+    PDF_PAGE_DPI,
+    PDF_PAGE_LIMIT,
+    PDF_RENDER_TIMEOUT
+)
+
+import errno
+import hashlib
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+
+# A pdf can't be marked up in the browser, so the worker renders its pages (with
+# pdftoppm, from poppler-utils, without any network service) into png images under
+# MEDIA_ROOT/pages, in a folder named by the sha256 of the pdf. The same pdf imported 
+# twice (e.g., for two articles) is rendered once, and the pages are never modified.
+
+#############################################################################################
+# Paths
+#############################################################################################
+
+def get_pages_folder(digest):
+    '''get_pages_folder returns the folder with the rendered pages of a pdf
+    :param digest: the sha256 (hex) of the pdf
+    '''
+    return os.path.join(MEDIA_ROOT,'pages',digest[:2],digest)
+
+
+def get_file_digest(path,chunk_size=1024*1024):
+    '''get_file_digest returns the sha256 (hex) of a file, read in chunks'''
+    digest = hashlib.sha256()
+    with open(path,'rb') as filey:
+        chunk = filey.read(chunk_size)
+        while chunk:
+            digest.update(chunk)
+            chunk = filey.read(chunk_size)
+    return digest.hexdigest()
+
+
+def list_pages(digest):
+    '''list_pages returns the names (relative to MEDIA_ROOT, as stored by a FileField)
+    of the rendered pages of a pdf, in page order, or None if it isn't rendered
+    '''
+    folder = get_pages_folder(digest)
+    if not os.path.exists(folder):
+        return None
+    pages = sorted([x for x in os.listdir(folder) if x.endswith('.png')])
+    return [os.path.relpath(os.path.join(folder,x),MEDIA_ROOT) for x in pages]
+
+
+#############################################################################################
+# Rendering
+#############################################################################################
+
+def render_pages(path,folder):
+    '''render_pages renders the pages of a pdf into png images in a folder, named 
+    page-0001.png, page-0002.png, etc.
+    :param path: the path to the pdf
+    :param folder: the (empty) folder to write to
+    '''
+    prefix = os.path.join(folder,'page')
+    subprocess.check_call(['pdftoppm','-png',
+                           '-r',str(PDF_PAGE_DPI),
+                           '-l',str(PDF_PAGE_LIMIT),
+                           path,prefix],
+                          stdout=subprocess.DEVNULL,
+                          stderr=subprocess.DEVNULL,
+                          timeout=PDF_RENDER_TIMEOUT)
+
+    # pdftoppm pads page numbers to the width of the page count, so they are made uniform
+    for filename in os.listdir(folder):
+        match = re.search(r'^page-(\d+)[.]png$',filename)
+        if match:
+            os.rename(os.path.join(folder,filename),
+                      os.path.join(folder,"page-%04d.png" %int(match.group(1))))
+
+
+def rasterize_pdf(path):
+    '''rasterize_pdf renders the pages of a pdf, if they aren't rendered already, and
+    returns the page names (see list_pages). Pages are rendered into a temporary folder
+    that is moved into place, so a reader never sees a partial set of pages.
+    :param path: the path to the pdf
+    '''
+    digest = get_file_digest(path)
+    pages = list_pages(digest)
+    if pages is not None:
+        return pages
+
+    folder = get_pages_folder(digest)
+    parent = os.path.dirname(folder)
+    try:
+        os.makedirs(parent)
+    except OSError as exc:
+        if exc.errno != errno.EEXIST:
+            raise
+
+    tmpdir = tempfile.mkdtemp(dir=parent)
+    try:
+        render_pages(path,tmpdir)
+        os.rename(tmpdir,folder)
+    except OSError:
+        # Another worker rendered the same pdf first
+        if not os.path.exists(folder):
+            raise
+    finally:
+        if os.path.exists(tmpdir):
+            shutil.rmtree(tmpdir)
+    return list_pages(digest)
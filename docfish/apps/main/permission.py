@@ -25,7 +25,17 @@ SOFTWARE.
 '''
 
 from docfish.apps.users.utils import has_same_institution
+from docfish.settings import PERMISSION_CACHE_TIMEOUT
 from django.contrib.auth.decorators import login_required
+from django.core.cache import cache
+import uuid
+
+# What a user can do with a collection (is the user a contributor, or of the owner's institution), 
+# and team membership, are kept in the shared cache for each user, under a version for the
+# collection (or team). Changes to the contributors, owner, or team members replace the version (see 
+# invalidate_collection_permissions), and within a request, each answer is kept on the request, 
+# so views that check permissions more than once only ask once. Versions are random, as in 
+# schema.py, so a version lost from the cache never brings back answers cached under an old one.
 
 
 ###############################################################################################
@@ -42,7 +52,7 @@ def get_permissions(request,context):
 
     # Edit and annotate permissions?
     context["edit_permission"] = has_collection_edit_permission(request,collection)
-    context["delete_permission"] = request.user == collection.owner
+    context["delete_permission"] = request.user.id == collection.owner_id
     
     return context
 
@@ -51,14 +61,14 @@ def get_permissions(request,context):
 
 def has_delete_permission(request,collection):
     '''collection owners have delete permission'''
-    if request.user == collection.owner:
+    if request.user.id == collection.owner_id:
         return True
     return False
 
 
 def has_collection_edit_permission(request,collection):
     '''owners and contributors have edit permission'''
-    if request.user == collection.owner or request.user in collection.contributors.all():
+    if request.user.id == collection.owner_id or is_contributor(request,collection):
         return True
     return False
 
@@ -69,14 +79,118 @@ def has_collection_annotate_permission(request,collection,team=None):
     a team is provided, the user must be a member to contribute to the team
     annotation.'''
     if team is not None:
-        if request.user not in team.members.all():
+        if not is_team_member(request,team):
             return False
-    if request.user == collection.owner:
+    if request.user.id == collection.owner_id:
         return True
     if collection.private == False:
         return True
-    if request.user in collection.contributors.all():
+    if is_contributor(request,collection):
         return True
-    return has_same_institution(owner=request.user,
-                                requester=collection.owner)
+    return is_owner_institution(request,collection)
+
+
+###############################################################################################
+# Memberships #################################################################################
+###############################################################################################
+
+
+def is_contributor(request,collection):
+    '''is_contributor returns True if the user is a contributor to the collection'''
+    def resolve():
+        return collection.contributors.filter(id=request.user.id).exists()
+    return get_collection_permission(request,collection,"contributor",resolve)
 
+
+def is_owner_institution(request,collection):
+    '''is_owner_institution returns True if the user belongs to the institution of the
+    collection owner (see has_same_institution)
+    '''
+    def resolve():
+        return has_same_institution(owner=request.user,
+                                    requester=collection.owner)
+    return get_collection_permission(request,collection,"institution",resolve)
+
+
+def is_team_member(request,team):
+    '''is_team_member returns True if the user is a member of the team'''
+    if request.user.is_anonymous():
+        return False
+    memo = get_memo(request)
+    if ("team",team.id) not in memo:
+        version = get_version(get_version_key("team",team.id))
+        key = "permissions-team-%s-%s-%s" %(team.id,request.user.id,version)
+        member = cache.get(key)
+        if member is None:
+            member = team.members.filter(id=request.user.id).exists()
+            cache.set(key,member,PERMISSION_CACHE_TIMEOUT)
+        memo[("team",team.id)] = member
+    return memo[("team",team.id)]
+
+
+def get_memo(request):
+    '''get_memo returns the permissions already looked up for a request'''
+    memo = getattr(request,'_permissions',None)
+    if memo is None:
+        memo = dict()
+        request._permissions = memo
+    return memo
+
+
+def get_collection_permission(request,collection,name,resolve):
+    '''get_collection_permission returns a permission of the user for a collection from the 
+    request, or the shared cache, and otherwise calls resolve to look it up (and saves it). An
+    anonymous user has none.
+    :param name: the name of the permission (e.g., contributor)
+    :param resolve: a function that returns the permission
+    '''
+    if request.user.is_anonymous():
+        return False
+    memo = get_memo(request)
+    if ("collection",collection.id) not in memo:
+        version = get_version(get_version_key("collection",collection.id))
+        key = "permissions-collection-%s-%s-%s" %(collection.id,request.user.id,version)
+        memo[("collection",collection.id)] = (key,cache.get(key) or dict())
+
+    key,permissions = memo[("collection",collection.id)]
+    if name not in permissions:
+        permissions[name] = resolve()
+        cache.set(key,permissions,PERMISSION_CACHE_TIMEOUT)
+    return permissions[name]
+
+
+###############################################################################################
+# Versions ####################################################################################
+###############################################################################################
+
+
+def get_version_key(kind,pk):
+    return "permissions-version-%s-%s" %(kind,pk)
+
+
+def get_version(key):
+    '''get_version returns the current version of the permissions of a collection or team'''
+    version = cache.get(key)
+    if version is None:
+        version = uuid.uuid4().hex
+        cache.add(key,version,None)
+        version = cache.get(key) or version
+    return version
+
+
+def bump_version(key):
+    cache.set(key,uuid.uuid4().hex,None)
+
+
+def invalidate_collection_permissions(cid):
+    '''invalidate_collection_permissions replaces the version of the permissions of a collection,
+    when its contributors or owner change
+    '''
+    bump_version(get_version_key("collection",cid))
+
+
+def invalidate_team_permissions(tid):
+    '''invalidate_team_permissions replaces the version of the membership of a team,
+    when members join or leave
+    '''
+    bump_version(get_version_key("team",tid))
@@ -0,0 +1,99 @@
+'''
+
+Copyright (c) 2017 Vanessa Sochat
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+'''
+
+from docfish.apps.main.content import (
+    get_content,
+    has_fresh_content
+)
+from docfish.apps.main.models import TextLink
+from docfish.settings import CONTENT_PREFETCH_WORKERS
+
+from concurrent.futures import ThreadPoolExecutor
+import threading
+
+# While an annotator works on one item, the remote content of the next few (the body
+# of a TextLink) is fetched into the content cache by a small pool of threads, so the
+# next page renders from local disk. Prefetching never raises, and a url that is 
+# fresh in the cache (or already being fetched) is skipped.
+
+_lock = threading.Lock()
+_pending = set()
+_executor = None
+
+
+def get_executor():
+    '''get_executor returns the thread pool shared by the process, created on first use'''
+    global _executor
+    with _lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=CONTENT_PREFETCH_WORKERS)
+    return _executor
+
+
+def fetch_url(url):
+    '''fetch_url gets the content of a url into the cache, in a prefetch thread'''
+    try:
+        get_content(url)
+    except Exception:
+        pass
+    finally:
+        with _lock:
+            _pending.discard(url)
+
+
+def prefetch_urls(urls):
+    '''prefetch_urls starts fetching a list of urls into the content cache, and 
+    returns without waiting.
+    '''
+    for url in urls:
+        with _lock:
+            if url in _pending:
+                continue
+            _pending.add(url)
+        if has_fresh_content(url):
+            with _lock:
+                _pending.discard(url)
+            continue
+        get_executor().submit(fetch_url,url)
+
+
+def prefetch_texts(texts):
+    '''prefetch_texts prefetches the content of a list of text objects (those that
+    are not linked are skipped)
+    :param texts: a list of Text, or None entries
+    '''
+    urls = []
+    for text in texts:
+        if text is not None and hasattr(text,'textlink'):
+            urls.append(text.textlink.original)
+    prefetch_urls(urls)
+
+
+def prefetch_text_ids(text_ids):
+    '''prefetch_text_ids prefetches the content of texts by id, typically the next
+    ids in an annotator's work queue
+    '''
+    if len(text_ids) > 0:
+        urls = TextLink.objects.filter(id__in=list(text_ids)).values_list('original',flat=True)
+        prefetch_urls(list(urls))
@@ -0,0 +1,166 @@
+'''
+
+Copyright (c) 2017 Vanessa Sochat
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+'''
+
+from django.core.cache import cache
+from django_redis import get_redis_connection
+from docfish.settings import (
+    ANNOTATION_QUEUE_REFILL,
+    ANNOTATION_QUEUE_TIMEOUT
+)
+
+# Annotation work queues are shuffled lists of item (image or text) ids that a user
+# or team has yet to see for a collection and task. The list is a redis list, so moving
+# to the next item doesn't need to recompute the remaining set, and each operation (pop,
+# discard) is one atomic command, so concurrent requests never pop the same item. An empty 
+# list doesn't exist in redis, so a second key marks that the queue was built. If the
+# cache isn't redis (e.g., a local memory cache in tests) there are no queues, and each
+# operation does nothing, so the next item is selected from the database.
+
+#############################################################################################
+# Queue Keys
+#############################################################################################
+
+def get_queue_key(task,cid,user_id=None,team_id=None):
+    '''get_queue_key returns the cache key for a work queue. A queue belongs
+    to either a team or a user.
+    :param task: the task, as named in Collection.status (e.g., image_markup)
+    :param cid: the collection id
+    :param user_id: the user id, if not a team queue
+    :param team_id: the team id, for a team queue
+    '''
+    if team_id is not None:
+        return "queue-%s-%s-team-%s" %(task,cid,team_id)
+    return "queue-%s-%s-user-%s" %(task,cid,user_id)
+
+
+def get_built_key(key):
+    return "%s-built" %key
+
+
+def get_connection():
+    '''get_connection returns the redis connection of the default cache, or None
+    if the cache isn't redis
+    '''
+    try:
+        return get_redis_connection('default')
+    except NotImplementedError:
+        return None
+
+
+#############################################################################################
+# Queue Operations
+#############################################################################################
+
+def has_queue(key):
+    '''has_queue returns True if a queue has been built (it can be empty)'''
+    connection = get_connection()
+    if connection is None:
+        return False
+    return connection.exists(get_built_key(key)) == True
+
+
+def fill_queue(key,ids):
+    '''fill_queue replaces the content of a queue with a list of ids.
+    :param ids: a (shuffled) list of item ids
+    '''
+    connection = get_connection()
+    if connection is None:
+        return
+    ids = list(ids)
+    pipeline = connection.pipeline()
+    pipeline.delete(key)
+    if len(ids) > 0:
+        pipeline.rpush(key,*ids)
+        pipeline.expire(key,ANNOTATION_QUEUE_TIMEOUT)
+    pipeline.set(get_built_key(key),1,ex=ANNOTATION_QUEUE_TIMEOUT)
+    pipeline.execute()
+
+
+def pop_queue(key):
+    '''pop_queue removes and returns the next id in a queue, or None if the
+    queue is empty (or was never built).
+    '''
+    connection = get_connection()
+    if connection is None:
+        return None
+    pipeline = connection.pipeline()
+    pipeline.rpop(key)
+    pipeline.expire(key,ANNOTATION_QUEUE_TIMEOUT)
+    pipeline.expire(get_built_key(key),ANNOTATION_QUEUE_TIMEOUT)
+    item_id = pipeline.execute()[0]
+    if item_id is None:
+        return None
+    return int(item_id)
+
+
+def peek_queue(key,N=1):
+    '''peek_queue returns the next N ids in a queue without removing them.
+    '''
+    connection = get_connection()
+    if connection is None:
+        return []
+    ids = connection.lrange(key,-N,-1)
+    return [int(x) for x in reversed(ids)]
+
+
+def needs_refill(key):
+    '''needs_refill returns True if a queue has fewer ids than the refill 
+    threshold (ANNOTATION_QUEUE_REFILL). Without redis, there is nothing to refill.
+    '''
+    connection = get_connection()
+    if connection is None:
+        return False
+    if not connection.exists(get_built_key(key)):
+        return True
+    return connection.llen(key) < ANNOTATION_QUEUE_REFILL
+
+
+def discard_queue_item(key,item_id):
+    '''discard_queue_item removes an id from a queue, typically because the
+    item was seen (annotated, described, marked up) through another path.
+    '''
+    connection = get_connection()
+    if connection is not None:
+        connection.lrem(key,0,item_id)
+
+
+def clear_queue(key):
+    '''clear_queue deletes a queue, so it is rebuilt on next use.
+    '''
+    connection = get_connection()
+    if connection is not None:
+        connection.delete(key,get_built_key(key))
+
+
+def lock_refill(key,timeout=60):
+    '''lock_refill returns True if the caller may start a refill of the queue,
+    and False if one was already started (within timeout seconds).
+    '''
+    return cache.add("%s-refill" %key,True,timeout)
+
+
+def unlock_refill(key):
+    '''unlock_refill allows the queue to be refilled again
+    '''
+    cache.delete("%s-refill" %key)
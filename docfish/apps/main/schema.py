@@ -0,0 +1,119 @@
+'''
+
+Copyright (c) 2017 Vanessa Sochat
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+'''
+
+from django.core.cache import cache
+from docfish.settings import ANNOTATION_SCHEMA_TIMEOUT
+from collections import OrderedDict
+import uuid
+
+# The label schema of a collection (its allowed annotations: each name, with its ordered
+# options, and the id of each name and label) is kept in the shared cache, and in each 
+# process, under a version for the collection. A change to the allowed annotations
+# replaces the version (see invalidate_schema), so every process rebuilds the schema on 
+# next use, and rendering or submitting annotations needs no query for the labels. 
+# Versions are random (not counted), so a version lost from the cache is never followed
+# by an old one again, which would bring back a schema cached under it.
+
+_schemas = dict()
+
+#############################################################################################
+# Schema
+#############################################################################################
+
+class AnnotationSchema(object):
+    '''AnnotationSchema holds the allowed annotations of a collection.
+    :param labels: a list of (id,name,label), in the order the options are shown
+    '''
+    def __init__(self,labels):
+        self.labels = [tuple(x) for x in labels]
+        self.options = OrderedDict()
+        self.ids = dict()
+        for annotation_id,name,label in self.labels:
+            if label not in self.options.setdefault(name,[]):
+                self.options[name].append(label)
+            self.ids["%s||%s" %(name,label)] = annotation_id
+
+    def get_id(self,name,label):
+        '''get_id returns the id of an allowed annotation, or None if it isn't allowed'''
+        return self.ids.get("%s||%s" %(name,label))
+
+    def get_options(self):
+        '''get_options returns a (new) dictionary of names, each with its list of options'''
+        return OrderedDict([(name,list(labels)) for name,labels in self.options.items()])
+
+    def __len__(self):
+        return len(self.labels)
+
+
+#############################################################################################
+# Versions
+#############################################################################################
+
+def get_schema_key(cid,version):
+    return "schema-%s-%s" %(cid,version)
+
+
+def get_version_key(cid):
+    return "schema-version-%s" %(cid)
+
+
+def get_schema_version(cid):
+    '''get_schema_version returns the current version of the schema of a collection'''
+    key = get_version_key(cid)
+    version = cache.get(key)
+    if version is None:
+        version = uuid.uuid4().hex
+        cache.add(key,version,None)
+        version = cache.get(key) or version
+    return version
+
+
+def invalidate_schema(cid):
+    '''invalidate_schema replaces the version of the schema of a collection, so that 
+    the next use (in any process) rebuilds it
+    '''
+    cache.set(get_version_key(cid),uuid.uuid4().hex,None)
+    _schemas.pop(int(cid),None)
+
+
+def get_collection_schema(collection):
+    '''get_collection_schema returns the AnnotationSchema of a collection, from the 
+    process if it is current, then from the shared cache, then from the database
+    :param collection: the collection (or its id)
+    '''
+    cid = int(getattr(collection,'id',collection))
+    version = get_schema_version(cid)
+    local = _schemas.get(cid)
+    if local is not None and local[0] == version:
+        return local[1]
+
+    key = get_schema_key(cid,version)
+    labels = cache.get(key)
+    if labels is None:
+        from docfish.apps.main.models import Annotation
+        labels = list(Annotation.objects.filter(contributor__id=cid).values_list('id','name','label'))
+        cache.set(key,labels,ANNOTATION_SCHEMA_TIMEOUT)
+    schema = AnnotationSchema(labels)
+    _schemas[cid] = (version,schema)
+    return schema
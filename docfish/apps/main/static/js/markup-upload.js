@@ -0,0 +1,42 @@
+// Sends a markup layer (a Blob, e.g. from canvas.toBlob) to the upload endpoint
+// as binary chunks. If the server is missing a chunk (409), the upload resumes
+// from the bytes it has. Requires cookie-token.js for the csrf header.
+
+function uploadMarkupLayer(url, blob, layer, done, failed) {
+    var chunkSize = 1024 * 1024;
+    var uploadId = null;
+    var retries = 0;
+
+    function send(start) {
+        var end = Math.min(start + chunkSize, blob.size);
+        var headers = {"Content-Range": "bytes " + start + "-" + (end - 1) + "/" + blob.size,
+                       "X-Markup-Layer": layer};
+        if (uploadId) {
+            headers["X-Upload-Id"] = uploadId;
+        }
+        $.ajax({url: url,
+                type: "POST",
+                data: blob.slice(start, end),
+                processData: false,
+                contentType: "application/octet-stream",
+                headers: headers})
+        .done(function(response) {
+            uploadId = response.upload_id;
+            if (response.received < blob.size) {
+                send(response.received);
+            } else {
+                done(response);
+            }
+        })
+        .fail(function(xhr) {
+            if (xhr.status == 409 && xhr.responseJSON && retries < 5) {
+                retries += 1;
+                uploadId = xhr.responseJSON.upload_id;
+                send(xhr.responseJSON.received);
+            } else if (failed) {
+                failed(xhr);
+            }
+        });
+    }
+    send(0);
+}
@@ -23,7 +23,9 @@ SOFTWARE.
 '''
 
 from django.contrib.auth.models import User
-from django.db.models.aggregates import Count
+from django.db import transaction
+from django.db.models import F
+from django.db.models.aggregates import Count, Sum
 from itertools import chain
 from docfish.apps.main.models import *
 
@@ -33,6 +35,7 @@ from docfish.settings import MEDIA_ROOT
 from random import randint
 from numpy.random import shuffle
 import numpy
+import collections
 import json
 import operator
 import pandas
@@ -41,125 +44,90 @@ import os
 import re
 
 
+# The stats fieldtypes (in urls) for each task, keyed as in Collection.status
+
+stats_tasks = {'image_markups':'image_markup',
+               'text_markups':'text_markup',
+               'image_annotations':'image_annotation',
+               'text_annotations':'text_annotation',
+               'image_descriptions':'image_describe',
+               'text_descriptions':'text_describe'}
+
+
 def count_task_annotations(collection,fieldtype):
     '''count task annotations by user, also breaking down labels, for
     a task type in image_markups, text_markups, etc.
     '''
     counts = []
-    if fieldtype == "image_markups":
-        counts = count_image_markups(collection)
-    elif fieldtype == "text_markups":
-        counts = count_text_markups(collection)
-    elif fieldtype == "image_annotations":
-        counts = count_image_annotations(collection)
-    elif fieldtype == "text_annotations":
-        counts = count_text_annotations(collection)
-    elif fieldtype == "image_descriptions":
-        counts = count_image_descriptions(collection)
-    elif fieldtype == "text_descriptions":
-        counts = count_text_descriptions(collection)
+    if fieldtype in ["image_markups","text_markups","image_descriptions","text_descriptions"]:
+        counts = count_user_work(stats_tasks[fieldtype],collection)
+    elif fieldtype in ["image_annotations","text_annotations"]:
+        counts = count_user_annotations(stats_tasks[fieldtype],collection)
     if len(counts) > 0:
         return counts
     return None
 
 
+#############################################################################################
+# Collection Stats
+#############################################################################################
 
-def count_text_markups(collection):
-    '''return list of dictionaries with user and count for each
+def get_collection_labels(collection):
+    '''get_collection_labels returns a list of (id,name,label) for the allowed
+    annotations of a collection, in one query
     '''
-    counts = []
-    user_ids = list(TextMarkup.objects.filter(text__entity__collection=collection).values_list('creator',flat=True).distinct())
-    for user_id in user_ids:
-        count = TextMarkup.objects.filter(text__entity__collection=collection,creator__id=user_id).count()
-        record = {'user':get_user(user_id),
-                  'count': count}       
-        counts.append(record)
-    return counts
+    return list(collection.allowed_annotations.order_by().values_list('id','name','label'))
 
 
-def count_image_markups(collection):
-    '''return list of dictionaries with user and count for each
+def get_user_stats(task,collection):
+    '''get_user_stats returns the (nonzero) CollectionStat for each user for a task, 
+    with the user selected in the same query
     '''
-    counts = []
-    user_ids = list(ImageMarkup.objects.filter(image__entity__collection=collection).values_list('creator',flat=True).distinct())
-    for user_id in user_ids:
-        count = ImageMarkup.objects.filter(image__entity__collection=collection,creator__id=user_id).count()
-        record = {'user':get_user(user_id),
-                  'count': count}       
-        counts.append(record)
-    return counts
-
-
-def count_image_descriptions(collection):
-    '''return list of dictionaries with user and count for each
-    '''
-    counts = []
-    user_ids = list(ImageDescription.objects.filter(image__entity__collection=collection).values_list('creator',flat=True).distinct())
-    for user_id in user_ids:
-        count = ImageDescription.objects.filter(image__entity__collection=collection,creator__id=user_id).count()
-        record = {'user':get_user(user_id),
-                  'count': count}       
-        counts.append(record)
-    return counts
+    stats = CollectionStat.objects.filter(collection=collection,
+                                          task=task,
+                                          creator__isnull=False,
+                                          count__gt=0)
+    return stats.select_related('creator').order_by('creator__username')
 
 
-def count_text_descriptions(collection):
-    '''return list of dictionaries with user and count for each
+def count_user_work(task,collection):
+    '''count_user_work returns a list of dictionaries with user and count for each,
+    for a markup or description task
     '''
     counts = []
-    user_ids = list(TextDescription.objects.filter(text__entity__collection=collection).values_list('creator',flat=True).distinct())
-    for user_id in user_ids:
-        count = TextDescription.objects.filter(text__entity__collection=collection,creator__id=user_id).count()
-        record = {'user':get_user(user_id),
-                  'count': count}       
+    for stat in get_user_stats(task,collection):
+        record = {'user':stat.creator,
+                  'count': stat.count}       
         counts.append(record)
     return counts
 
 
-def count_text_annotations(collection):
-    '''return list of dictionaries with user and count for each
+def count_user_annotations(task,collection):
+    '''count_user_annotations returns a list of dictionaries with user, total, and count for each,
+    where the count is a list of the allowed annotations (with id, name, and label) and the number
+    of times the user chose each. Options are counted by annotation, as names can share a label 
+    (e.g., yes or unknown).
     '''
-    counts = []
-    user_ids = list(TextAnnotation.objects.filter(text__entity__collection=collection).values_list('creator',flat=True).distinct())
-    labels = list(collection.allowed_annotations.order_by().values_list('name',flat=True).distinct())
-
-    for user_id in user_ids:
-        annotations = dict()
-        for label in labels:
-            annot_set = dict()
-            options = list(collection.allowed_annotations.filter(name=label).order_by().values_list('label',flat=True).distinct())
-            for option in options:
-                annot_set[option] = TextAnnotation.objects.filter(text__entity__collection=collection,
-                                                                  annotation__name=label,
-                                                                  annotation__label=option,
-                                                                  creator__id=user_id).distinct().count()
-            annotations[label] = annot_set
-        record = {'user':get_user(user_id),
-                  'count': annot_set}       
-        counts.append(record)
-    return counts
+    labels = get_collection_labels(collection)
+    options = dict([(aid,(name,label)) for aid,name,label in labels])
 
+    annotations = collections.OrderedDict()
+    users = dict()
+    for stat in get_user_stats(task,collection).filter(annotation_id__in=list(options.keys())):
+        if stat.creator_id not in annotations:
+            annotations[stat.creator_id] = dict([(aid,0) for aid in options])
+            users[stat.creator_id] = stat.creator
+        annotations[stat.creator_id][stat.annotation_id] += stat.count
 
-def count_image_annotations(collection):
-    '''return list of dictionaries with user and count for each
-    '''
     counts = []
-    user_ids = list(TextAnnotation.objects.filter(text__entity__collection=collection).values_list('creator',flat=True).distinct())
-    labels = list(collection.allowed_annotations.order_by().values_list('name',flat=True).distinct())
-
-    for user_id in user_ids:
-        annotations = dict()
-        for label in labels:
-            annot_set = dict()
-            options = list(collection.allowed_annotations.filter(name=label).order_by().values_list('label',flat=True).distinct())
-            for option in options:
-                annot_set[option] = ImageAnnotation.objects.filter(image__entity__collection=collection,
-                                                                   annotation__name=label,
-                                                                   annotation__label=option,
-                                                                   creator__id=user_id).distinct().count()
-            annotations[label] = annot_set
-        record = {'user':get_user(user_id),
-                  'count': annot_set}       
+    for user_id,annot_set in annotations.items():
+        annot_counts = [{'id':aid,
+                         'name':name,
+                         'label':label,
+                         'count':annot_set[aid]} for aid,name,label in sorted(labels,key=lambda x: x[1:])]
+        record = {'user':users[user_id],
+                  'total': sum(annot_set.values()),
+                  'count': annot_counts}       
         counts.append(record)
     return counts
 
@@ -167,36 +135,84 @@ def count_image_annotations(collection):
 def count_collection_annotations(collection):
     '''return the count of a annotations, by type, across a collection
     '''
-    counts = dict()
+    totals = CollectionStat.objects.filter(collection=collection).order_by()
+    totals = totals.values_list('task','annotation').annotate(total=Sum('count'))
+    totals = dict([((task,aid),total) for task,aid,total in totals])
 
     # Count markups and descriptions of images and text
-    counts['image markups'] = ImageMarkup.objects.filter(image__entity__collection=collection).distinct().count()
-    counts['text markups'] = TextMarkup.objects.filter(text__entity__collection=collection).distinct().count()
-    counts['text descriptions'] = TextDescription.objects.filter(text__entity__collection=collection).distinct().count()
-    counts['image descriptions'] = ImageDescription.objects.filter(image__entity__collection=collection).distinct().count()
+    counts = dict()
+    counts['image markups'] = totals.get(('image_markup',None),0)
+    counts['text markups'] = totals.get(('text_markup',None),0)
+    counts['text descriptions'] = totals.get(('text_describe',None),0)
+    counts['image descriptions'] = totals.get(('image_describe',None),0)
 
     # For each annotation, we have labels
-    labels = list(collection.allowed_annotations.order_by().values_list('name',flat=True).distinct())
-
     image_annotations = dict()
     text_annotations = dict()
-    for label in labels:
-        text_set = dict()
-        image_set = dict()
-        options = list(collection.allowed_annotations.filter(name=label).order_by().values_list('label',flat=True).distinct())
-        for option in options:
-            text_set[option] = TextAnnotation.objects.filter(text__entity__collection=collection,
-                                                             annotation__name=label,
-                                                             annotation__label=option).distinct().count()
-            image_set[option] = ImageAnnotation.objects.filter(image__entity__collection=collection,
-                                                               annotation__name=label,
-                                                               annotation__label=option).distinct().count()
-        image_annotations[label] = image_set
-        text_annotations[label] = text_set
+    for aid,name,label in get_collection_labels(collection):
+        if name not in image_annotations:
+            image_annotations[name] = dict()
+            text_annotations[name] = dict()
+        image_annotations[name][label] = totals.get(('image_annotation',aid),0)
+        text_annotations[name][label] = totals.get(('text_annotation',aid),0)
 
     counts['image annotations'] = image_annotations
     counts['text annotations'] = text_annotations
-
     return counts
 
 
+#############################################################################################
+# Reconcile
+#############################################################################################
+
+def summarize_collection_work(collection):
+    '''summarize_collection_work counts the work for each task of a collection with one
+    grouped query per task, returning a dictionary with (task,creator,annotation) 
+    lookups, the same rows kept in CollectionStat
+    '''
+    summary = dict()
+    for task,model in task_models.items():
+        work = model.objects.filter(collection=collection).order_by()
+        if task.endswith('_annotation'):
+            work = work.values_list('creator','annotation').annotate(count=Count('id'))
+            for creator_id,annotation_id,count in work:
+                summary[(task,creator_id,annotation_id)] = count
+        else:
+            work = work.values_list('creator').annotate(count=Count('id'))
+            for creator_id,count in work:
+                summary[(task,creator_id,None)] = count
+    return summary
+
+
+def reconcile_collection_stats(collection):
+    '''reconcile_collection_stats corrects any drift between the CollectionStat of a
+    collection and its work, updating only the rows that are wrong. Returns the number
+    of rows changed. The stats are locked before the work is counted, so count_stat
+    (which adds to them as work is saved) waits, and corrections are added to the 
+    count (with F) instead of replacing it, so no change made meanwhile is lost.
+    '''
+    changed = 0
+    with transaction.atomic():
+        stats = CollectionStat.objects.select_for_update().filter(collection=collection)
+        stats = list(stats.values_list('id','task','creator_id','annotation_id','count'))
+        summary = summarize_collection_work(collection)
+        for stat_id,task,creator_id,annotation_id,count in stats:
+            difference = summary.pop((task,creator_id,annotation_id),0) - count
+            if difference != 0:
+                CollectionStat.objects.filter(id=stat_id).update(count=F('count') + difference)
+                changed += 1
+
+        # Work that has no stat yet, which count_stat may be creating at the same time
+        for (task,creator_id,annotation_id),count in summary.items():
+            stat,created = CollectionStat.objects.get_or_create(collection=collection,
+                                                                task=task,
+                                                                creator_id=creator_id,
+                                                                annotation_id=annotation_id,
+                                                                defaults={'count':count})
+            if not created:
+                stat = CollectionStat.objects.select_for_update().get(id=stat.id)
+                if stat.count == count:
+                    continue
+                CollectionStat.objects.filter(id=stat.id).update(count=F('count') + count - stat.count)
+            changed += 1
+    return changed
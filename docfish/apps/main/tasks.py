@@ -0,0 +1,191 @@
+'''
+
+Copyright (c) 2017 Vanessa Sochat
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+'''
+
+from celery.decorators import periodic_task
+from celery import shared_task, Celery
+from celery.schedules import crontab
+
+from django.conf import settings
+from django.core.cache import cache
+from django.contrib.auth.models import User
+
+from docfish.apps.main.models import *
+from docfish.apps.main.queues import (
+    fill_queue,
+    get_queue_key,
+    unlock_refill
+)
+from docfish.apps.main.content import get_session
+from docfish.apps.main.exports import export_collection_masks
+from docfish.apps.main.pages import (
+    get_file_digest,
+    rasterize_pdf
+)
+from docfish.apps.main.stats import reconcile_collection_stats
+from docfish.apps.main.tiles import make_derivatives
+from docfish.apps.main.uploads import prune_uploads
+from docfish.apps.main.writes import save_writes
+
+from docfish.settings import CONTENT_FETCH_TIMEOUT
+import os
+import shutil
+import tempfile
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'docfish.settings')
+app = Celery('docfish')
+app.config_from_object('django.conf:settings')
+app.autodiscover_tasks(lambda: settings.INSTALLED_APPS)
+
+
+@shared_task
+def refill_queue(task,cid,user_id=None,team_id=None):
+    '''refill_queue rebuilds the work queue of a user or team for a task in a 
+    collection. It is fired by navigation when the queue runs low.
+    :param task: the task, as named in Collection.status (e.g., image_markup)
+    :param cid: the collection id
+    :param user_id: the user id, if not a team queue
+    :param team_id: the team id, for a team queue
+    '''
+    from docfish.apps.main.navigation import build_queue
+    from docfish.apps.users.models import Team
+
+    key = get_queue_key(task,cid,user_id=user_id,team_id=team_id)
+    try:
+        collection = Collection.objects.get(id=cid)
+        user = User.objects.filter(id=user_id).first()
+        team = Team.objects.filter(id=team_id).first()
+        if user is not None or team is not None:
+            fill_queue(key,build_queue(task,collection,user=user,team=team))
+    except Collection.DoesNotExist:
+        pass
+    unlock_refill(key)
+
+
+@periodic_task(run_every=crontab(minute=30))
+def reconcile_stats():
+    '''reconcile_stats corrects any drift between the collection stats (kept up to date
+    as work is saved and deleted) and the work itself, for all collections, once an hour
+    '''
+    for collection in Collection.objects.all():
+        reconcile_collection_stats(collection)
+
+
+@shared_task
+def save_annotation_writes():
+    '''save_annotation_writes saves the annotation writes queued by requests (see writes.py),
+    fired when writes are queued. Only one runs at a time, so writes are saved in order.
+    '''
+    cache.delete("annotation-writes-scheduled")
+    if cache.add("annotation-writes-lock",True,60*10):
+        try:
+            save_writes()
+        finally:
+            cache.delete("annotation-writes-lock")
+
+
+@periodic_task(run_every=crontab())
+def check_annotation_writes():
+    '''check_annotation_writes saves any queued annotation writes that were missed 
+    (e.g., queued as the worker finished), once a minute
+    '''
+    save_annotation_writes()
+
+
+@periodic_task(run_every=crontab(minute=0,hour=3))
+def prune_markup_uploads():
+    '''prune_markup_uploads removes the partial files of markup layer uploads
+    that were abandoned (see uploads.py), once a day
+    '''
+    prune_uploads()
+
+
+@shared_task
+def make_image_derivatives(image_id):
+    '''make_image_derivatives writes the thumbnail, display image, and deep zoom tiles
+    for an image file (see tiles.py), fired when the image file is saved.
+    :param image_id: the id of the ImageFile
+    '''
+    image = ImageFile.objects.filter(id=image_id).first()
+    if image is not None and image.original:
+        version = get_file_digest(image.original.path)[:16]
+        width,height = make_derivatives(image.id,image.original.path,version)
+
+        # Unless the original was replaced while they were made
+        ImageFile.objects.filter(id=image.id,
+                                 original=image.original.name).update(width=width,
+                                                                      height=height,
+                                                                      has_derivatives=True,
+                                                                      derivatives_version=version)
+
+
+@shared_task
+def rasterize_pdf_pages(image_id):
+    '''rasterize_pdf_pages renders the pages of a pdf image (see pages.py) and adds them
+    as images of the same entity, so they can be annotated. It is fired when a pdf image is 
+    saved, and does nothing if the pages are already added.
+    :param image_id: the id of the (pdf) Image
+    '''
+    image = Image.objects.filter(id=image_id,content_type="pdf").first()
+    if image is None or image.pages.exists():
+        return
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        if hasattr(image,'imagefile'):
+            path = image.imagefile.original.path
+        else:
+            path = os.path.join(tmpdir,'original.pdf')
+            response = get_session().get(image.get_url(),stream=True,timeout=CONTENT_FETCH_TIMEOUT)
+            response.raise_for_status()
+            with open(path,'wb') as filey:
+                for chunk in response.iter_content(chunk_size=1024*1024):
+                    filey.write(chunk)
+        pages = rasterize_pdf(path)
+    finally:
+        shutil.rmtree(tmpdir)
+
+    for number,name in enumerate(pages,1):
+        page,created = ImageFile.objects.get_or_create(uid="%s/page-%04d.png" %(image.uid,number),
+                                                       entity=image.entity,
+                                                       defaults={'original':name,
+                                                                 'parent':image,
+                                                                 'page':number,
+                                                                 'content_type':'image',
+                                                                 'metadata':{'pdf':image.uid,
+                                                                             'page':number}})
+
+
+@shared_task
+def export_masks(cid):
+    '''export_masks writes the mask export of a collection (see exports.py) for download,
+    fired by the download view when the export is missing or stale
+    :param cid: the collection id
+    '''
+    try:
+        collection = Collection.objects.get(id=cid)
+        export_collection_masks(collection)
+    except Collection.DoesNotExist:
+        pass
+    finally:
+        cache.delete("export-masks-%s" %cid)
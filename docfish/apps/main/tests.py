@@ -0,0 +1,1044 @@
+'''
+
+Copyright (c) 2017 Vanessa Sochat
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+'''
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management import call_command
+from django.test import (
+    RequestFactory,
+    SimpleTestCase,
+    TestCase,
+    override_settings
+)
+from django.utils import timezone
+
+from docfish.apps.api.serializers import TextSerializer
+from docfish.apps.main.actions import bulk_update_annotations
+from docfish.apps.main import (
+    blobs,
+    content,
+    writes
+)
+from docfish.apps.main.exports import (
+    ShardWriter,
+    get_markup_state
+)
+from docfish.apps.main.leases import (
+    claim_items,
+    claim_next
+)
+from docfish.apps.main.masks import (
+    decode_mask,
+    encode_mask,
+    render_pixels
+)
+from docfish.apps.main.models import (
+    Annotation,
+    Collection,
+    CollectionStat,
+    Entity,
+    ImageAnnotation,
+    ImageLink,
+    ImageMarkup,
+    ItemCount,
+    ItemLease,
+    Text,
+    TextFile,
+    TextLink,
+    get_content_type
+)
+from docfish.apps.main.navigation import (
+    get_contenders,
+    get_next_by_redundancy,
+    get_next_to_annotate,
+    get_unseen,
+    get_unseen_ids,
+    select_ids
+)
+from docfish.apps.main.permission import (
+    get_version_key as get_permission_version_key,
+    is_contributor,
+    is_team_member
+)
+from docfish.apps.main.queues import (
+    clear_queue,
+    discard_queue_item,
+    fill_queue,
+    get_connection,
+    get_queue_key,
+    has_queue,
+    lock_refill,
+    needs_refill,
+    peek_queue,
+    pop_queue,
+    unlock_refill
+)
+from docfish.apps.main.schema import (
+    AnnotationSchema,
+    get_collection_schema,
+    get_schema_version,
+    get_version_key
+)
+from docfish.apps.main.stats import (
+    count_user_annotations,
+    reconcile_collection_stats
+)
+from docfish.apps.main.uploads import parse_content_range
+from docfish.apps.users.models import Team
+from docfish.settings import ANNOTATION_QUEUE_REFILL
+
+from http.server import (
+    BaseHTTPRequestHandler,
+    HTTPServer
+)
+from PIL import Image as PILImage
+from unittest import (
+    mock,
+    skipIf
+)
+import copy
+import io
+import numpy
+import os
+import shutil
+import tempfile
+import threading
+import uuid
+
+
+# Tests of the database use a local memory cache, so they don't need redis. Tests of the
+# redis structures (queues, queued writes) are skipped if redis can't be reached.
+LOCAL_CACHES = {'default':{'BACKEND':'django.core.cache.backends.locmem.LocMemCache'}}
+
+def get_redis():
+    '''get_redis returns a connection to the redis of the default cache, or None'''
+    connection = get_connection()
+    try:
+        connection.ping()
+    except Exception:
+        return None
+    return connection
+
+
+def make_png(pixels):
+    '''make_png returns the png bytes of an RGBA array'''
+    filey = io.BytesIO()
+    PILImage.fromarray(pixels,'RGBA').save(filey,format='PNG')
+    return filey.getvalue()
+
+
+@override_settings(CACHES=LOCAL_CACHES)
+class ContentCountTest(TestCase):
+
+    def setUp(self):
+        self.owner = User.objects.create_user(username="owner",password="owner")
+        self.collection = Collection.objects.create(name="collection",owner=self.owner)
+
+    def test_import_counts(self):
+        '''an import (as in pubmed add_storage_articles) saves the entity and collection it holds 
+        after adding images and text, which must not write back the counts it loaded
+        '''
+        collection = Collection.objects.get(id=self.collection.id)
+        entity,created = Entity.objects.get_or_create(uid="PMC0001")
+        entity.save()
+        ImageLink.objects.create(uid="PMC0001/figure1.png",
+                                 entity=entity,
+                                 url="http://localhost/figure1.png",
+                                 content_type="image")
+        TextLink.objects.create(uid="PMC0001/abstract.txt",
+                                entity=entity,
+                                original="http://localhost/abstract.txt",
+                                content_type="text")
+        entity.save()
+        collection.entity_set.add(entity)
+        collection.save()
+
+        entity = Entity.objects.get(id=entity.id)
+        self.assertEqual(entity.image_count,1)
+        self.assertEqual(entity.text_count,1)
+        collection = Collection.objects.get(id=self.collection.id)
+        self.assertEqual(collection.entity_count,1)
+        self.assertTrue(collection.has_images())
+        self.assertTrue(collection.has_text())
+
+    def test_save_keeps_counts(self):
+        '''saving a collection loaded before its counts changed keeps the new counts'''
+        stale = Collection.objects.get(id=self.collection.id)
+        entity = Entity.objects.create(uid="entity")
+        self.collection.entity_set.add(entity)
+        ImageLink.objects.create(uid="entity/image.png",
+                                 entity=entity,
+                                 url="http://localhost/image.png",
+                                 content_type="image")
+        stale.name = "renamed"
+        stale.save()
+
+        collection = Collection.objects.get(id=self.collection.id)
+        self.assertEqual(collection.name,"renamed")
+        self.assertEqual(collection.image_count,1)
+
+
+class MaskTest(TestCase):
+
+    def test_round_trip(self):
+        '''an overlay with several colors and partial alpha is rendered back as drawn'''
+        pixels = numpy.zeros((40,50,4),dtype=numpy.uint8)
+        pixels[5:10,5:20] = [255,0,0,255]
+        pixels[10,5:20] = [255,0,0,90]
+        pixels[20:30,30:40] = [0,128,255,200]
+        mask,width,height,palette = encode_mask(make_png(pixels))
+        self.assertEqual((width,height),(50,40))
+        self.assertEqual(palette,"0080ff,ff0000")
+        self.assertTrue(numpy.array_equal(render_pixels(mask,width,height,palette),pixels))
+
+        indices,alpha = decode_mask(mask,width,height)
+        self.assertEqual(indices[6,6],2)
+        self.assertEqual(indices[25,35],1)
+        self.assertEqual(alpha[10,10],90)
+
+    def test_empty(self):
+        pixels = numpy.zeros((4,4,4),dtype=numpy.uint8)
+        mask,width,height,palette = encode_mask(make_png(pixels))
+        self.assertEqual(palette,"")
+        self.assertEqual(render_pixels(mask,width,height,palette).sum(),0)
+
+    def test_too_many_colors(self):
+        '''an overlay with more colors than a palette holds is not converted'''
+        pixels = numpy.zeros((32,32,4),dtype=numpy.uint8)
+        pixels[:,:,0] = numpy.arange(32*32).reshape((32,32)) % 256
+        pixels[:,:,1] = numpy.arange(32*32).reshape((32,32)) // 256
+        pixels[:,:,3] = 255
+        self.assertIsNone(encode_mask(make_png(pixels)))
+
+
+@override_settings(CACHES=LOCAL_CACHES)
+class StatsTest(TestCase):
+
+    def test_shared_labels(self):
+        '''annotation names that share an option are counted apart for each user'''
+        owner = User.objects.create_user(username="owner",password="owner")
+        collection = Collection.objects.create(name="collection",owner=owner)
+        fracture = Annotation.objects.create(name="FRACTURE",label="YES")
+        tumor = Annotation.objects.create(name="TUMOR",label="YES")
+        collection.allowed_annotations.add(fracture,tumor)
+        CollectionStat.objects.create(collection=collection,task="image_annotation",
+                                      creator=owner,annotation=fracture,count=2)
+        CollectionStat.objects.create(collection=collection,task="image_annotation",
+                                      creator=owner,annotation=tumor,count=3)
+
+        counts = count_user_annotations("image_annotation",collection)
+        self.assertEqual(len(counts),1)
+        self.assertEqual(counts[0]['total'],5)
+        options = dict([((x['name'],x['label']),x['count']) for x in counts[0]['count']])
+        self.assertEqual(options,{("FRACTURE","YES"):2,("TUMOR","YES"):3})
+
+    def test_reconcile(self):
+        '''reconciling corrects a wrong stat and adds a missing one'''
+        owner = User.objects.create_user(username="owner",password="owner")
+        collection = Collection.objects.create(name="collection",owner=owner)
+        fracture = Annotation.objects.create(name="FRACTURE",label="YES")
+        tumor = Annotation.objects.create(name="TUMOR",label="YES")
+        entity = Entity.objects.create(uid="entity")
+        image = ImageLink.objects.create(uid="entity/image.png",
+                                         entity=entity,
+                                         url="http://localhost/image.png",
+                                         content_type="image")
+        for annotation in [fracture,tumor]:
+            ImageAnnotation.objects.create(image=image,collection=collection,
+                                           creator=owner,annotation=annotation)
+        stats = CollectionStat.objects.filter(collection=collection,task="image_annotation")
+        stats.filter(annotation=fracture).update(count=5)
+        stats.filter(annotation=tumor).delete()
+
+        self.assertEqual(reconcile_collection_stats(collection),2)
+        self.assertEqual(dict(stats.values_list('annotation_id','count')),{fracture.id:1,tumor.id:1})
+        self.assertEqual(reconcile_collection_stats(collection),0)
+
+
+@override_settings(CACHES=LOCAL_CACHES)
+class BulkAnnotationTest(TestCase):
+
+    def setUp(self):
+        self.owner = User.objects.create_user(username="owner",password="owner")
+        self.collection = Collection.objects.create(name="collection",owner=self.owner)
+        self.yes = Annotation.objects.create(name="FRACTURE",label="YES")
+        self.no = Annotation.objects.create(name="FRACTURE",label="NO")
+        self.tumor = Annotation.objects.create(name="TUMOR",label="YES")
+        self.collection.allowed_annotations.add(self.yes,self.no,self.tumor)
+        entity = Entity.objects.create(uid="entity")
+        self.collection.entity_set.add(entity)
+        self.image = ImageLink.objects.create(uid="entity/image.png",
+                                              entity=entity,
+                                              url="http://localhost/image.png",
+                                              content_type="image")
+
+    def get_stats(self):
+        stats = CollectionStat.objects.filter(collection=self.collection,task="image_annotation")
+        return dict(stats.values_list('annotation_id','count'))
+
+    def test_one_option_per_name(self):
+        '''the last option submitted for a name is kept'''
+        results = bulk_update_annotations(self.owner,self.image,
+                                          ["FRACTURE||YES","FRACTURE||NO","TUMOR||YES"],
+                                          cid=self.collection.id)
+        self.assertEqual(results["FRACTURE||YES"],"replaced")
+        self.assertEqual(results["FRACTURE||NO"],"created")
+        saved = ImageAnnotation.objects.filter(image=self.image,creator=self.owner)
+        self.assertEqual(set(saved.values_list('annotation_id',flat=True)),set([self.no.id,self.tumor.id]))
+
+    def test_counts(self):
+        '''stats and item counts follow annotations that are created and replaced'''
+        bulk_update_annotations(self.owner,self.image,["FRACTURE||YES","TUMOR||YES"],
+                                cid=self.collection.id)
+        self.assertEqual(self.get_stats(),{self.yes.id:1,self.tumor.id:1})
+        bulk_update_annotations(self.owner,self.image,["FRACTURE||NO","TUMOR||YES"],
+                                cid=self.collection.id)
+        self.assertEqual(self.get_stats(),{self.yes.id:0,self.no.id:1,self.tumor.id:1})
+        item_count = ItemCount.objects.get(collection=self.collection,
+                                           task="image_annotation",
+                                           item_id=self.image.id)
+        self.assertEqual(item_count.count,1)
+
+
+@override_settings(CACHES=LOCAL_CACHES)
+class ExportStateTest(TestCase):
+
+    def setUp(self):
+        self.owner = User.objects.create_user(username="owner",password="owner")
+        self.collection = Collection.objects.create(name="collection",owner=self.owner)
+        entity = Entity.objects.create(uid="entity")
+        self.image = ImageLink.objects.create(uid="entity/image.png",
+                                              entity=entity,
+                                              url="http://localhost/image.png",
+                                              content_type="image")
+
+    def add_markup(self):
+        return ImageMarkup.objects.create(image=self.image,
+                                          collection=self.collection,
+                                          creator=self.owner)
+
+    def test_delete_changes_state(self):
+        '''deleting a markup that is not the last changed one makes the export stale'''
+        first = self.add_markup()
+        self.add_markup()
+        state = get_markup_state(self.collection)
+        first.delete()
+        self.assertNotEqual(get_markup_state(self.collection),state)
+
+    def test_replace_changes_state(self):
+        '''deleting a markup and adding another keeps the count, but not the largest id'''
+        markup = self.add_markup()
+        state = get_markup_state(self.collection)
+        markup.delete()
+        self.add_markup()
+        self.assertNotEqual(get_markup_state(self.collection),state)
+
+
+class ContentTypeTest(SimpleTestCase):
+
+    def test_names(self):
+        '''extensions are matched with their dot, so names that only end in the letters are unknown'''
+        expected = {"figure.png":"image",
+                    "figure.JPG":"image",
+                    "figure.jpeg":"image",
+                    "scan.tif":"image",
+                    "brain.nii.gz":"nifti",
+                    "abstract.txt":"text",
+                    "http://localhost/files/thumbnailpng":"unknown",
+                    "notes_txt":"unknown",
+                    "figure_gif":"unknown"}
+        for name,content_type in expected.items():
+            self.assertEqual(get_content_type(name=name),content_type)
+
+    def test_mimetype(self):
+        '''a mimetype is used before the name'''
+        self.assertEqual(get_content_type("figure","image/webp"),"image")
+        self.assertEqual(get_content_type("figure.png","text/plain"),"text")
+
+
+class ContentServer(BaseHTTPRequestHandler):
+    '''ContentServer stands in for a remote server of text, answering conditional 
+    requests with 304 while the body (set on the server) is unchanged
+    '''
+    def do_GET(self):
+        server = self.server
+        server.requests.append(dict(self.headers))
+        etag = '"%s"' %server.version
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        body = server.body.encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type','text/plain; charset=utf-8')
+        self.send_header('Content-Length',str(len(body)))
+        self.send_header('ETag',etag)
+        self.send_header('Last-Modified','Mon, 02 Jan 2017 00:00:00 GMT')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self,*args):
+        pass
+
+
+class ContentCacheTest(SimpleTestCase):
+
+    def setUp(self):
+        self.server = HTTPServer(('127.0.0.1',0),ContentServer)
+        self.server.requests = []
+        self.server.body = "first"
+        self.server.version = 1
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.url = "http://127.0.0.1:%s/abstract.txt" %self.server.server_port
+        self.root = tempfile.mkdtemp()
+        patches = [mock.patch.object(content,'CONTENT_CACHE_ROOT',self.root),
+                   mock.patch.object(content,'_memory',content.collections.OrderedDict()),
+                   mock.patch.object(content,'_disk_bytes',None)]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def tearDown(self):
+        self.stop_server()
+        shutil.rmtree(self.root)
+
+    def stop_server(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+    def test_fresh_from_memory_and_disk(self):
+        '''fresh content is served without asking the server, from disk after memory is cleared'''
+        self.assertEqual(content.get_content(self.url),"first")
+        self.assertEqual(content.get_content(self.url),"first")
+        content._memory.clear()
+        self.assertEqual(content.get_content(self.url),"first")
+        self.assertEqual(len(self.server.requests),1)
+        self.assertTrue(content.has_fresh_content(self.url))
+
+    def test_revalidate(self):
+        '''stale content is revalidated with its etag and last modified, and replaced if changed'''
+        with mock.patch.object(content,'CONTENT_CACHE_MAX_AGE',0):
+            self.assertEqual(content.get_content(self.url),"first")
+            self.assertEqual(content.get_content(self.url),"first")
+            headers = self.server.requests[-1]
+            self.assertEqual(headers.get('If-None-Match'),'"1"')
+            self.assertEqual(headers.get('If-Modified-Since'),'Mon, 02 Jan 2017 00:00:00 GMT')
+            self.server.body = "second"
+            self.server.version = 2
+            self.assertEqual(content.get_content(self.url),"second")
+            content._memory.clear()
+            self.assertEqual(content.get_content(self.url),"second")
+        self.assertEqual(len(self.server.requests),4)
+
+    def test_stale_when_server_is_down(self):
+        '''a stale copy is returned if the server cannot be reached'''
+        self.assertEqual(content.get_content(self.url),"first")
+        self.stop_server()
+        with mock.patch.object(content,'CONTENT_CACHE_MAX_AGE',0):
+            self.assertEqual(content.get_content(self.url),"first")
+
+    def test_prune(self):
+        '''pruning deletes the least recently used bodies, with their meta'''
+        for number in range(4):
+            url = "%s?page=%s" %(self.url,number)
+            content.disk_set(url,"x" * 100,{'url':url})
+            path = content.get_content_path(url)
+            os.utime("%s.body" %path,(number,number))
+        self.assertEqual(content.prune_content(max_bytes=250,root=self.root),200)
+        self.assertIsNone(content.disk_get("%s?page=0" %self.url))
+        self.assertIsNotNone(content.disk_get("%s?page=3" %self.url))
+
+
+class ContentRangeTest(SimpleTestCase):
+
+    def test_valid(self):
+        self.assertEqual(parse_content_range("bytes 0-1048575/5242880"),(0,1048575,5242880))
+        self.assertEqual(parse_content_range(" bytes 9-9/10 "),(9,9,10))
+
+    def test_invalid(self):
+        '''missing, malformed, backwards, and out of range headers are None'''
+        for header in [None,"","bytes */100","bytes 0-10","items 0-1/2",
+                       "bytes 10-5/100","bytes 0-100/100","bytes -1-5/10"]:
+            self.assertIsNone(parse_content_range(header))
+
+
+class AnnotationSchemaTest(SimpleTestCase):
+
+    def setUp(self):
+        self.schema = AnnotationSchema([(1,"FRACTURE","YES"),
+                                        (2,"FRACTURE","NO"),
+                                        (3,"TUMOR","YES"),
+                                        (4,"FRACTURE","YES")])
+
+    def test_options(self):
+        '''options keep the order they are shown, without repeating a label'''
+        options = self.schema.get_options()
+        self.assertEqual(list(options.keys()),["FRACTURE","TUMOR"])
+        self.assertEqual(options["FRACTURE"],["YES","NO"])
+        options["FRACTURE"].append("MAYBE")
+        self.assertEqual(self.schema.get_options()["FRACTURE"],["YES","NO"])
+        self.assertEqual(len(self.schema),4)
+
+    def test_ids(self):
+        self.assertEqual(self.schema.get_id("TUMOR","YES"),3)
+        self.assertEqual(self.schema.get_id("FRACTURE","YES"),4)
+        self.assertIsNone(self.schema.get_id("TUMOR","NO"))
+
+
+@override_settings(CACHES=LOCAL_CACHES)
+class SchemaVersionTest(TestCase):
+
+    def test_evicted_version(self):
+        '''a schema cached under an old version is not used after the version is evicted'''
+        owner = User.objects.create_user(username="owner",password="owner")
+        collection = Collection.objects.create(name="collection",owner=owner)
+        collection.allowed_annotations.add(Annotation.objects.create(name="FRACTURE",label="YES"))
+        first = get_schema_version(collection.id)
+        self.assertEqual(len(get_collection_schema(collection)),1)
+
+        collection.allowed_annotations.add(Annotation.objects.create(name="TUMOR",label="YES"))
+        cache.delete(get_version_key(collection.id))
+        self.assertNotEqual(get_schema_version(collection.id),first)
+        self.assertEqual(len(get_collection_schema(collection)),2)
+
+
+class ShardWriterTest(SimpleTestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_shards(self):
+        '''masks are split across shards by size, and read back from their offsets'''
+        writer = ShardWriter(self.folder,shard_bytes=100)
+        masks = [numpy.full((4,10),number,dtype=numpy.uint8) for number in range(3)]
+        masks.append(numpy.full((20,10),9,dtype=numpy.uint8))
+        locations = [writer.add(mask) for mask in masks]
+        writer.flush()
+        self.assertEqual(writer.shards,["masks-0000.npy","masks-0001.npy","masks-0002.npy"])
+        self.assertEqual(locations,[("masks-0000.npy",0),("masks-0000.npy",40),
+                                    ("masks-0001.npy",0),("masks-0002.npy",0)])
+        for mask,(name,offset) in zip(masks,locations):
+            shard = numpy.load(os.path.join(self.folder,name),mmap_mode='r')
+            height,width = mask.shape
+            read = shard[offset:offset + height*width].reshape((height,width))
+            self.assertTrue((read == mask).all())
+
+    def test_empty(self):
+        writer = ShardWriter(self.folder)
+        writer.flush()
+        self.assertEqual(writer.shards,[])
+
+
+@skipIf(get_redis() is None,"redis is not available")
+class QueueTest(SimpleTestCase):
+
+    def setUp(self):
+        self.key = get_queue_key("image_annotation",uuid.uuid4().hex,user_id=1)
+        self.addCleanup(clear_queue,self.key)
+        self.addCleanup(unlock_refill,self.key)
+
+    def test_build_and_pop(self):
+        '''a built queue pops each id once, in the order peeked, and stays built when empty'''
+        self.assertFalse(has_queue(self.key))
+        fill_queue(self.key,[1,2,3])
+        self.assertTrue(has_queue(self.key))
+        peeked = peek_queue(self.key,3)
+        self.assertEqual(sorted(peeked),[1,2,3])
+        self.assertEqual([pop_queue(self.key) for x in range(3)],peeked)
+        self.assertIsNone(pop_queue(self.key))
+        self.assertTrue(has_queue(self.key))
+
+    def test_fill_replaces(self):
+        fill_queue(self.key,[1,2,3])
+        fill_queue(self.key,[4])
+        self.assertEqual(pop_queue(self.key),4)
+        self.assertIsNone(pop_queue(self.key))
+
+    def test_discard(self):
+        '''a discarded id is never popped'''
+        fill_queue(self.key,[1,2,3])
+        discard_queue_item(self.key,2)
+        self.assertEqual(sorted([pop_queue(self.key),pop_queue(self.key)]),[1,3])
+        self.assertIsNone(pop_queue(self.key))
+
+    def test_refill(self):
+        '''a queue needs a refill before it is built, and once it runs low, by one caller at a time'''
+        self.assertTrue(needs_refill(self.key))
+        fill_queue(self.key,range(ANNOTATION_QUEUE_REFILL + 1))
+        self.assertFalse(needs_refill(self.key))
+        pop_queue(self.key)
+        pop_queue(self.key)
+        self.assertTrue(needs_refill(self.key))
+        self.assertTrue(lock_refill(self.key))
+        self.assertFalse(lock_refill(self.key))
+        unlock_refill(self.key)
+        self.assertTrue(lock_refill(self.key))
+
+    def test_clear(self):
+        '''a cleared queue is rebuilt on next use'''
+        fill_queue(self.key,[1])
+        clear_queue(self.key)
+        self.assertFalse(has_queue(self.key))
+        self.assertIsNone(pop_queue(self.key))
+
+
+@override_settings(CACHES=LOCAL_CACHES)
+class QueueWithoutRedisTest(SimpleTestCase):
+
+    def test_no_queue(self):
+        '''without redis there is never a queue, so the next item comes from the database'''
+        key = get_queue_key("image_annotation",1,user_id=1)
+        self.assertIsNone(get_connection())
+        fill_queue(key,[1,2,3])
+        discard_queue_item(key,1)
+        self.assertFalse(has_queue(key))
+        self.assertIsNone(pop_queue(key))
+        self.assertEqual(peek_queue(key,2),[])
+        self.assertFalse(needs_refill(key))
+        clear_queue(key)
+
+
+@override_settings(CACHES=LOCAL_CACHES)
+class PendingWritesTest(TestCase):
+
+    def setUp(self):
+        self.owner = User.objects.create_user(username="owner",password="owner")
+        self.collection = Collection.objects.create(name="collection",owner=self.owner)
+        self.collection.allowed_annotations.add(Annotation.objects.create(name="FRACTURE",label="YES"),
+                                                Annotation.objects.create(name="FRACTURE",label="NO"),
+                                                Annotation.objects.create(name="TUMOR",label="YES"))
+        entity = Entity.objects.create(uid="entity")
+        self.image = ImageLink.objects.create(uid="entity/image.png",
+                                              entity=entity,
+                                              url="http://localhost/image.png",
+                                              content_type="image")
+        self.queued = []
+        patch = mock.patch.object(writes,'push_write',self.queued.append)
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def queue(self,labels):
+        writes.queue_annotations(self.owner,self.image,labels,self.collection.id)
+        return self.queued[-1]
+
+    def get_pending(self,collection=None):
+        summary = {"labels":dict(),"counts":dict()}
+        return writes.add_pending_annotations(summary,self.image,collection or self.collection,
+                                              user=self.owner)['labels']
+
+    def save(self,write):
+        writes.apply_write(write)
+        writes.clear_pending(write)
+
+    def test_pending_overlay(self):
+        '''queued annotations are shown until saved, and only in their collection'''
+        other = Collection.objects.create(name="other",owner=self.owner)
+        first = self.queue(["FRACTURE||YES","TUMOR||YES"])
+        second = self.queue(["FRACTURE||NO"])
+        self.assertEqual(self.get_pending(),{"FRACTURE":"NO","TUMOR":"YES"})
+        self.assertEqual(self.get_pending(other),{})
+        self.save(first)
+        self.assertEqual(self.get_pending(),{"FRACTURE":"NO"})
+        self.save(second)
+        self.assertEqual(self.get_pending(),{})
+
+    def test_replay(self):
+        '''saving a batch again (after the worker stops before removing it) has the same result'''
+        batch = [self.queue(["FRACTURE||YES","TUMOR||YES"]),self.queue(["FRACTURE||NO"])]
+        for write in batch + batch:
+            self.save(write)
+        saved = ImageAnnotation.objects.filter(image=self.image,creator=self.owner)
+        self.assertEqual(sorted(saved.values_list('annotation__name','annotation__label')),
+                         [("FRACTURE","NO"),("TUMOR","YES")])
+
+    def test_retry_keeps_newer(self):
+        '''a failed write is retried without the names a newer write has set'''
+        failed = self.queue(["FRACTURE||YES","TUMOR||YES"])
+        writes.keep_pending(failed)
+        self.save(self.queue(["FRACTURE||NO"]))
+        self.assertEqual(self.get_pending(),{"TUMOR":"YES"})
+        retry = writes.get_retry(dict(failed))
+        self.assertEqual(retry['labels'],["TUMOR||YES"])
+
+    def test_retry_replaced(self):
+        '''a failed write that newer writes have replaced is not retried, even when they saved
+        nothing new (the newer label was already saved)
+        '''
+        self.save(self.queue(["FRACTURE||NO"]))
+        failed = self.queue(["FRACTURE||YES"])
+        writes.keep_pending(failed)
+        self.save(self.queue(["FRACTURE||NO"]))
+        self.assertIsNone(writes.get_retry(dict(failed)))
+
+    def test_discard(self):
+        '''discarding a failed write removes what it had pending'''
+        failed = self.queue(["TUMOR||YES"])
+        writes.keep_pending(failed)
+        self.assertEqual(self.get_pending(),{"TUMOR":"YES"})
+        writes.clear_pending(failed)
+        self.assertEqual(self.get_pending(),{})
+
+
+@skipIf(get_redis() is None,"redis is not available")
+class QueuedWritesTest(TestCase):
+
+    def setUp(self):
+        self.owner = User.objects.create_user(username="owner",password="owner")
+        self.collection = Collection.objects.create(name="collection",owner=self.owner)
+        self.collection.allowed_annotations.add(Annotation.objects.create(name="FRACTURE",label="YES"),
+                                                Annotation.objects.create(name="FRACTURE",label="NO"),
+                                                Annotation.objects.create(name="TUMOR",label="YES"))
+        entity = Entity.objects.create(uid="entity")
+        self.image = ImageLink.objects.create(uid="entity/image.png",
+                                              entity=entity,
+                                              url="http://localhost/image.png",
+                                              content_type="image")
+        prefix = uuid.uuid4().hex
+        patches = [mock.patch.object(writes,'WRITES_KEY',"%s-writes" %prefix),
+                   mock.patch.object(writes,'FAILED_KEY',"%s-failed" %prefix),
+                   mock.patch('docfish.apps.main.tasks.save_annotation_writes.apply_async')]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.addCleanup(get_redis().delete,"%s-writes" %prefix,"%s-failed" %prefix)
+
+    def get_saved(self):
+        saved = ImageAnnotation.objects.filter(image=self.image,creator=self.owner)
+        return dict(saved.values_list('annotation__name','annotation__label'))
+
+    def test_in_order(self):
+        '''queued writes are saved in the order they were queued'''
+        writes.queue_annotations(self.owner,self.image,["FRACTURE||YES"],self.collection.id)
+        writes.queue_annotations(self.owner,self.image,["FRACTURE||NO"],self.collection.id)
+        self.assertEqual(writes.save_writes(batch_size=1),2)
+        self.assertEqual(writes.count_writes(),0)
+        self.assertEqual(self.get_saved(),{"FRACTURE":"NO"})
+
+    def test_failed_and_retry(self):
+        '''a failed write is kept, and its retry doesn't undo a newer write'''
+        writes.queue_annotations(self.owner,self.image,["FRACTURE||YES","TUMOR||YES"],self.collection.id)
+        writes.queue_annotations(self.owner,self.image,["FRACTURE||NO"],self.collection.id)
+        apply_write = writes.apply_write
+        def fail_first(write):
+            if "TUMOR||YES" in write['labels']:
+                raise ValueError("database is down")
+            apply_write(write)
+
+        with mock.patch.object(writes,'apply_write',fail_first):
+            self.assertEqual(writes.save_writes(),1)
+        failed = writes.get_failed_writes()
+        self.assertEqual(len(failed),1)
+        self.assertEqual(failed[0]['error'],"database is down")
+        self.assertEqual(self.get_saved(),{"FRACTURE":"NO"})
+
+        self.assertEqual(writes.retry_failed_writes(),1)
+        self.assertEqual(writes.get_failed_writes(),[])
+        self.assertEqual(writes.save_writes(),1)
+        self.assertEqual(self.get_saved(),{"FRACTURE":"NO","TUMOR":"YES"})
+
+
+@override_settings(CACHES=LOCAL_CACHES)
+class PermissionCacheTest(TestCase):
+
+    def setUp(self):
+        self.owner = User.objects.create_user(username="owner",password="owner")
+        self.user = User.objects.create_user(username="user",password="user")
+        self.collection = Collection.objects.create(name="collection",owner=self.owner)
+        self.team = Team.objects.create(name="team",owner=self.owner)
+
+    def get_request(self):
+        '''a new request, so the permissions come from the cache and not the request'''
+        request = RequestFactory().get('/')
+        request.user = self.user
+        return request
+
+    def test_contributor_removed(self):
+        '''removing a contributor takes effect, also after the version is evicted'''
+        self.collection.contributors.add(self.user)
+        self.assertTrue(is_contributor(self.get_request(),self.collection))
+        self.collection.contributors.remove(self.user)
+        self.assertFalse(is_contributor(self.get_request(),self.collection))
+        cache.delete(get_permission_version_key("collection",self.collection.id))
+        self.assertFalse(is_contributor(self.get_request(),self.collection))
+
+    def test_member_removed(self):
+        '''removing a team member takes effect, also after the version is evicted'''
+        self.team.members.add(self.user)
+        self.assertTrue(is_team_member(self.get_request(),self.team))
+        self.team.members.remove(self.user)
+        self.assertFalse(is_team_member(self.get_request(),self.team))
+        cache.delete(get_permission_version_key("team",self.team.id))
+        self.assertFalse(is_team_member(self.get_request(),self.team))
+
+
+@override_settings(CACHES=LOCAL_CACHES)
+class LeaseTest(TestCase):
+
+    def setUp(self):
+        self.owner = User.objects.create_user(username="owner",password="owner")
+        self.member = User.objects.create_user(username="member",password="member")
+        self.team = Team.objects.create(name="team",owner=self.owner)
+        self.team.members.add(self.owner,self.member)
+        self.collection = Collection.objects.create(name="collection",owner=self.owner)
+        self.images = self.add_images(self.collection,3)
+
+    def add_images(self,collection,count):
+        entity = Entity.objects.create(uid="entity-%s" %collection.id)
+        collection.entity_set.add(entity)
+        return [ImageLink.objects.create(uid="%s/image%s.png" %(entity.uid,number),
+                                         entity=entity,
+                                         url="http://localhost/image%s.png" %number,
+                                         content_type="image") for number in range(count)]
+
+    def claim(self,user,collection=None,**kwargs):
+        return claim_next(user=user,
+                          collection=collection or self.collection,
+                          team=self.team,
+                          task="image_annotation",
+                          **kwargs)
+
+    def test_exclusive(self):
+        '''two members are never served the same unclaimed item'''
+        first = self.claim(self.owner)
+        second = self.claim(self.member)
+        self.assertNotEqual(first.id,second.id)
+        self.assertEqual(ItemLease.objects.filter(team=self.team).count(),2)
+
+    def test_release(self):
+        '''a member keeps the lease on the item they are on, and releases the rest'''
+        first = self.claim(self.owner)
+        second = self.claim(self.owner,skip=first.id)
+        self.assertNotEqual(first.id,second.id)
+        held = ItemLease.objects.filter(team=self.team,holder=self.owner)
+        self.assertEqual(set(held.values_list('item_id',flat=True)),set([first.id,second.id]))
+        third = self.claim(self.owner,skip=second.id)
+        self.assertEqual(set(held.values_list('item_id',flat=True)),set([second.id,third.id]))
+
+    def test_expired(self):
+        '''items held by another member are claimed once their leases expire'''
+        claimed = claim_items(self.owner,self.collection,self.team,"image_annotation",N=3)
+        self.assertEqual(len(claimed),3)
+        self.assertEqual(claim_items(self.member,self.collection,self.team,"image_annotation"),[])
+        ItemLease.objects.filter(holder=self.owner).update(expires_at=timezone.now() - timezone.timedelta(seconds=1))
+        self.assertEqual(len(claim_items(self.member,self.collection,self.team,"image_annotation")),1)
+
+    def test_repeat_leased(self):
+        '''when the team has done every item, members repeat different items'''
+        annotation = Annotation.objects.create(name="FRACTURE",label="YES")
+        for image in self.images:
+            ImageAnnotation.objects.create(image=image,collection=self.collection,
+                                           team=self.team,annotation=annotation)
+        first = self.claim(self.owner)
+        second = self.claim(self.member)
+        self.assertNotEqual(first.id,second.id)
+        self.assertEqual(ItemLease.objects.filter(team=self.team).count(),2)
+
+    def test_one_item(self):
+        '''a collection with one item serves it again, and an empty one serves nothing'''
+        collection = Collection.objects.create(name="one",owner=self.owner)
+        image = self.add_images(collection,1)[0]
+        self.assertEqual(self.claim(self.owner,collection,skip=image.id),image)
+        self.assertEqual(self.claim(self.owner,collection,N=2),[image,image])
+        empty = Collection.objects.create(name="empty",owner=self.owner)
+        self.assertIsNone(self.claim(self.owner,empty))
+        self.assertEqual(self.claim(self.owner,empty,N=2),[])
+
+
+class BlobTest(SimpleTestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        patch = mock.patch.object(blobs,'TEXT_BLOB_ROOT',self.root)
+        patch.start()
+        self.addCleanup(patch.stop)
+        self.addCleanup(shutil.rmtree,self.root)
+
+    def list_blobs(self):
+        return [name for folder,dirs,files in os.walk(self.root) for name in files]
+
+    def test_deduplicate(self):
+        '''the same body (as text or bytes) is stored once, under its hash'''
+        digest = blobs.put_blob("The fish swims.")
+        self.assertEqual(blobs.put_blob("The fish swims.".encode('utf-8')),digest)
+        self.assertEqual(self.list_blobs(),["%s.gz" %digest])
+        self.assertNotEqual(blobs.put_blob("The fish sleeps."),digest)
+        self.assertEqual(len(self.list_blobs()),2)
+
+    def test_read(self):
+        '''a blob reads back whole, streamed, and in chunks'''
+        body = "caf\u00e9\nfish " * 1000
+        digest = blobs.put_blob(body)
+        self.assertTrue(blobs.has_blob(digest))
+        self.assertEqual(blobs.read_blob(digest),body)
+        with blobs.open_blob(digest) as filey:
+            self.assertEqual(filey.readline(),"caf\u00e9\n")
+        chunks = list(blobs.iter_blob(digest,chunk_size=100))
+        self.assertTrue(len(chunks) > 1)
+        self.assertEqual("".join(chunks),body)
+
+
+@override_settings(CACHES=LOCAL_CACHES)
+class TextBlobTest(TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        patch = mock.patch.object(blobs,'TEXT_BLOB_ROOT',self.root)
+        patch.start()
+        self.addCleanup(patch.stop)
+        self.addCleanup(shutil.rmtree,self.root)
+        self.entity = Entity.objects.create(uid="entity")
+
+    def test_move_text_blobs(self):
+        '''bodies saved in the database are moved to the blob store, once for the same body'''
+        texts = [TextFile.objects.create(uid="entity/%s.txt" %number,
+                                         entity=self.entity,
+                                         original="The fish swims.") for number in range(2)]
+        call_command('move_text_blobs',stdout=io.StringIO())
+        digests = set()
+        for text in texts:
+            text = TextFile.objects.get(id=text.id)
+            self.assertIsNone(text.original)
+            self.assertEqual(text.get_text(),"The fish swims.")
+            digests.add(text.blob)
+        self.assertEqual(len(digests),1)
+        call_command('move_text_blobs',stdout=io.StringIO())
+
+    def test_api_original(self):
+        '''the api serves the body of a text file, and the url of linked text, as original'''
+        text = TextFile(uid="entity/abstract.txt",entity=self.entity)
+        text.set_text("The fish swims.")
+        text.save()
+        link = TextLink.objects.create(uid="entity/link.txt",
+                                       entity=self.entity,
+                                       original="http://localhost/link.txt")
+        self.assertEqual(TextSerializer(Text.objects.get(id=text.id)).data['original'],"The fish swims.")
+        self.assertEqual(TextSerializer(Text.objects.get(id=link.id)).data['original'],"http://localhost/link.txt")
+
+
+@override_settings(CACHES=LOCAL_CACHES)
+class NavigationTest(TestCase):
+
+    def setUp(self):
+        self.owner = User.objects.create_user(username="owner",password="owner")
+        self.other = User.objects.create_user(username="other",password="other")
+        self.collection = Collection.objects.create(name="collection",owner=self.owner)
+        self.annotation = Annotation.objects.create(name="FRACTURE",label="YES")
+        entity = Entity.objects.create(uid="entity")
+        self.collection.entity_set.add(entity)
+        self.images = [ImageLink.objects.create(uid="entity/image%s.png" %number,
+                                                entity=entity,
+                                                url="http://localhost/image%s.png" %number,
+                                                content_type="image") for number in range(5)]
+        self.ids = [x.id for x in self.images]
+
+    def annotate(self,user,images):
+        for image in images:
+            ImageAnnotation.objects.create(image=image,collection=self.collection,
+                                           creator=user,annotation=self.annotation)
+
+    def get_unseen(self,**kwargs):
+        return get_unseen(contenders=get_contenders(self.collection),
+                          seen=ImageAnnotation.objects.filter(creator=self.owner),
+                          **kwargs)
+
+    def test_unseen_ids(self):
+        '''seen and skipped items are excluded, in order of id'''
+        self.annotate(self.owner,self.images[:1])
+        self.annotate(self.other,self.images[1:2])
+        seen = ImageAnnotation.objects.filter(creator=self.owner)
+        contenders = get_contenders(self.collection)
+        self.assertEqual(list(get_unseen_ids(contenders,seen)),self.ids[1:])
+        self.assertEqual(list(get_unseen_ids(contenders,seen,skip=self.ids[1])),self.ids[2:])
+        self.assertEqual(list(get_unseen_ids(contenders,seen,skip=self.ids[1:3])),self.ids[3:])
+
+    def test_select_ids(self):
+        ids = get_contenders(self.collection).order_by('id').values_list('id',flat=True)
+        self.assertEqual(select_ids(ids,5,2,random_select=False),self.ids[:2])
+        selected = select_ids(ids,5,3)
+        self.assertEqual(len(set(selected)),3)
+        self.assertTrue(set(selected) <= set(self.ids))
+
+    def test_return_number(self):
+        '''one item is returned alone, more as a list, and all (in order) if N is None or too large'''
+        self.annotate(self.owner,self.images[:2])
+        single = self.get_unseen(return_number=1)
+        self.assertIn(single.id,self.ids[2:])
+        several = self.get_unseen(return_number=2)
+        self.assertEqual(len(set([x.id for x in several])),2)
+        self.assertTrue(set([x.id for x in several]) <= set(self.ids[2:]))
+        self.assertEqual([x.id for x in self.get_unseen()],self.ids[2:])
+        self.assertEqual([x.id for x in self.get_unseen(return_number=10)],self.ids[2:])
+
+    def test_random_select(self):
+        '''without random selection, the first unseen items are returned'''
+        self.annotate(self.owner,self.images[:1])
+        self.assertEqual(self.get_unseen(return_number=1,random_select=False),self.images[1])
+        self.assertEqual(self.get_unseen(return_number=2,random_select=False,skip=self.ids[1]),
+                         self.images[2:4])
+
+    def test_repeat(self):
+        '''when everything is seen, nothing is returned, unless items can be repeated'''
+        self.annotate(self.owner,self.images)
+        self.assertIsNone(self.get_unseen(return_number=1))
+        self.assertIn(self.get_unseen(return_number=1,repeat=True).id,self.ids)
+        self.assertEqual(len(self.get_unseen(return_number=2,repeat=True)),2)
+
+    def test_next_to_annotate(self):
+        '''without work queues (redis), the next item is selected from the database'''
+        self.annotate(self.owner,self.images[:4])
+        self.assertEqual(get_next_to_annotate(self.owner,self.collection),self.images[4])
+        self.assertEqual(get_next_to_annotate(self.owner,self.collection,skip=self.ids[4]),None)
+        self.annotate(self.owner,self.images[4:])
+        self.assertIsNone(get_next_to_annotate(self.owner,self.collection))
+
+    def test_redundancy(self):
+        '''with a redundancy target, items no one has done come first, then those with the
+        fewest annotators, and items at the target (or seen by the user) are never served
+        '''
+        status = copy.deepcopy(self.collection.status)
+        status['image_annotation']['redundancy'] = 2
+        Collection.objects.filter(id=self.collection.id).update(status=status)
+        self.collection = Collection.objects.get(id=self.collection.id)
+        self.annotate(self.other,self.images[:3])
+        third = User.objects.create_user(username="third",password="third")
+        self.annotate(third,self.images[:1])
+        self.annotate(self.owner,self.images[3:4])
+
+        # image0 is at the target, image1 and image2 have one, image3 is seen, image4 is new
+        first = get_next_to_annotate(self.owner,self.collection)
+        self.assertEqual(first,self.images[4])
+        choices = get_next_by_redundancy("image_annotation",user=self.owner,
+                                         collection=self.collection,N=5)
+        self.assertEqual(choices[0],self.images[4])
+        self.assertEqual(set([x.id for x in choices[1:]]),set(self.ids[1:3]))
+        self.assertIsNone(get_next_by_redundancy("image_annotation",user=self.owner,
+                                                 collection=self.collection,N=1,
+                                                 skip=self.ids[1:3] + self.ids[4:]))
@@ -0,0 +1,184 @@
+'''
+
+Copyright (c) 2017 Vanessa Sochat
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+'''
+
+from docfish.settings import (
+    IMAGE_DISPLAY_SIZE,
+    IMAGE_MAX_PIXELS,
+    IMAGE_THUMBNAIL_SIZE,
+    IMAGE_TILE_OVERLAP,
+    IMAGE_TILE_SIZE,
+    MEDIA_ROOT,
+    MEDIA_URL
+)
+
+from PIL import Image as PILImage
+import math
+import os
+import shutil
+
+# Large images (scans, microscopy) are too big to send to the browser whole. For each
+# image file, the worker writes derivatives under MEDIA_ROOT/derivatives/<image id>/<version>:
+# a thumbnail, a display size image for the markup tools, and a deep zoom pyramid 
+# (tiles.dzi, with tiles in tiles_files/<level>/<column>_<row>.jpg) for viewers that 
+# stream only the tiles in view. The version is from the digest of the original, so
+# derivatives at a url never change (a new original gets a new url), and are cached forever.
+
+PILImage.MAX_IMAGE_PIXELS = IMAGE_MAX_PIXELS
+
+#############################################################################################
+# Paths
+#############################################################################################
+
+def get_derivative_folder(image_id,version=None):
+    '''get_derivative_folder returns the folder with the derivatives of an image (for one
+    version, or all versions if not given)
+    '''
+    folder = os.path.join(MEDIA_ROOT,'derivatives',str(image_id))
+    if version is not None:
+        folder = os.path.join(folder,version)
+    return folder
+
+
+def get_derivative_url(image_id,version,name):
+    '''get_derivative_url returns the url for a derivative (e.g., thumbnail.jpg) of an image'''
+    return "%sderivatives/%s/%s/%s" %(MEDIA_URL,image_id,version,name)
+
+
+def get_tile_path(image_id,version,level,column,row):
+    '''get_tile_path returns the path of a deep zoom tile'''
+    return os.path.join(get_derivative_folder(image_id,version),'tiles_files',str(level),"%s_%s.jpg" %(column,row))
+
+
+#############################################################################################
+# Derivatives
+#############################################################################################
+
+def to_rgb(image):
+    '''to_rgb converts an image to RGB (for jpeg), putting any transparency on white'''
+    if image.mode in ['RGBA','LA'] or (image.mode == 'P' and 'transparency' in image.info):
+        image = image.convert('RGBA')
+        background = PILImage.new('RGB',image.size,(255,255,255))
+        background.paste(image,mask=image.split()[-1])
+        return background
+    if image.mode != 'RGB':
+        return image.convert('RGB')
+    return image
+
+
+def save_resized(image,path,size):
+    '''save_resized saves a copy of an image with the largest side at most size'''
+    copy = image.copy()
+    copy.thumbnail((size,size),PILImage.LANCZOS)
+    copy.save(path,'JPEG',quality=85)
+
+
+def get_level_count(width,height):
+    '''get_level_count returns the number of deep zoom levels for an image, from 
+    one pixel (level 0) to full size
+    '''
+    return int(math.ceil(math.log(max(width,height),2))) + 1
+
+
+def save_tiles(image,folder,level,tile_size=None,overlap=None):
+    '''save_tiles cuts one level of the pyramid (the image at that level's size) into 
+    tiles, each overlapping its neighbors by overlap pixels
+    '''
+    if tile_size is None:
+        tile_size = IMAGE_TILE_SIZE
+    if overlap is None:
+        overlap = IMAGE_TILE_OVERLAP
+    level_folder = os.path.join(folder,str(level))
+    os.makedirs(level_folder)
+
+    width,height = image.size
+    for column in range(int(math.ceil(width / tile_size))):
+        for row in range(int(math.ceil(height / tile_size))):
+            left = column * tile_size - (overlap if column > 0 else 0)
+            top = row * tile_size - (overlap if row > 0 else 0)
+            right = min((column + 1) * tile_size + overlap, width)
+            bottom = min((row + 1) * tile_size + overlap, height)
+            tile = image.crop((left,top,right,bottom))
+            tile.save(os.path.join(level_folder,"%s_%s.jpg" %(column,row)),'JPEG',quality=85)
+
+
+def save_pyramid(image,folder,tile_size=None,overlap=None):
+    '''save_pyramid writes a deep zoom pyramid (tiles.dzi, and tiles_files) for an image,
+    halving the image for each level down from full size.
+    '''
+    if tile_size is None:
+        tile_size = IMAGE_TILE_SIZE
+    if overlap is None:
+        overlap = IMAGE_TILE_OVERLAP
+    width,height = image.size
+    tiles_folder = os.path.join(folder,'tiles_files')
+
+    level = get_level_count(width,height) - 1
+    while level >= 0:
+        save_tiles(image,tiles_folder,level,tile_size,overlap)
+        size = (max(int(math.ceil(image.size[0] / 2.0)),1),
+                max(int(math.ceil(image.size[1] / 2.0)),1))
+        image = image.resize(size,PILImage.LANCZOS)
+        level -= 1
+
+    descriptor = '''<?xml version="1.0" encoding="UTF-8"?>
+<Image xmlns="http://schemas.microsoft.com/deepzoom/2008" TileSize="%s" Overlap="%s" Format="jpg">
+  <Size Width="%s" Height="%s"/>
+</Image>
+''' %(tile_size,overlap,width,height)
+    with open(os.path.join(folder,'tiles.dzi'),'w') as filey:
+        filey.write(descriptor)
+
+
+def make_derivatives(image_id,path,version):
+    '''make_derivatives writes the thumbnail, display image, and deep zoom pyramid for
+    an image file. They are written to a temporary folder, and moved into place when
+    complete, and derivatives of other versions are removed. Returns the (width,height) 
+    of the image.
+    :param image_id: the id of the Image
+    :param path: the path to the original image file
+    :param version: the version of the derivatives (see ImageFile.derivatives_version)
+    '''
+    folder = get_derivative_folder(image_id,version)
+    tmp_folder = "%s.tmp" %folder
+    shutil.rmtree(tmp_folder,ignore_errors=True)
+    os.makedirs(tmp_folder)
+
+    image = to_rgb(PILImage.open(path))
+    save_resized(image,os.path.join(tmp_folder,'thumbnail.jpg'),IMAGE_THUMBNAIL_SIZE)
+    save_resized(image,os.path.join(tmp_folder,'display.jpg'),IMAGE_DISPLAY_SIZE)
+    save_pyramid(image,tmp_folder)
+
+    shutil.rmtree(folder,ignore_errors=True)
+    os.rename(tmp_folder,folder)
+
+    # Derivatives of an older original (or before versions)
+    parent = get_derivative_folder(image_id)
+    for name in os.listdir(parent):
+        if name != version:
+            old = os.path.join(parent,name)
+            if os.path.isdir(old):
+                shutil.rmtree(old,ignore_errors=True)
+            else:
+                os.remove(old)
+    return image.size
@@ -0,0 +1,135 @@
+'''
+
+Copyright (c) 2017 Vanessa Sochat
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+'''
+
+from docfish.settings import (
+    MARKUP_UPLOAD_EXPIRES,
+    MARKUP_UPLOAD_ROOT
+)
+
+import errno
+import os
+import re
+import time
+import uuid
+
+# Markup layers (overlay or base png) can be sent to the upload endpoint as raw binary,
+# in chunks, instead of base64 form fields. Each chunk names its byte range (a Content-Range
+# header) and upload id, and is appended to a partial file under MARKUP_UPLOAD_ROOT, in a 
+# folder for the user. A client that loses a chunk asks for (or is told) the bytes received,
+# and resumes from there. Partial files left behind are removed by prune_uploads.
+
+#############################################################################################
+# Paths
+#############################################################################################
+
+def new_upload_id():
+    '''new_upload_id returns a random id for a new upload'''
+    return uuid.uuid4().hex
+
+
+def is_upload_id(upload_id):
+    '''is_upload_id returns True if an upload id (sent by the client) is well formed'''
+    if upload_id is None:
+        return False
+    return re.search('^[0-9a-f]{32}$',upload_id) is not None
+
+
+def get_upload_path(user_id,upload_id,root=None):
+    '''get_upload_path returns the path of the partial file of an upload'''
+    if root is None:
+        root = MARKUP_UPLOAD_ROOT
+    return os.path.join(root,str(user_id),"%s.part" %upload_id)
+
+
+def get_received(path):
+    '''get_received returns the number of bytes received for an upload'''
+    if os.path.exists(path):
+        return os.path.getsize(path)
+    return 0
+
+
+#############################################################################################
+# Chunks
+#############################################################################################
+
+def parse_content_range(header):
+    '''parse_content_range returns (start, end, total) for a Content-Range header
+    (e.g., bytes 0-1048575/5242880), or None if it isn't valid
+    '''
+    if header is None:
+        return None
+    match = re.search(r'^bytes (\d+)-(\d+)/(\d+)$',header.strip())
+    if match is None:
+        return None
+    start,end,total = [int(x) for x in match.groups()]
+    if start > end or end >= total:
+        return None
+    return start,end,total
+
+
+def write_chunk(path,stream,length,chunk_size=64*1024):
+    '''write_chunk appends a chunk of an upload from a stream (e.g., the request) to
+    its partial file, reading a piece at a time so memory doesn't grow with the
+    upload, and returns the bytes received
+    :param path: the partial file (see get_upload_path)
+    :param stream: a file like object to read the chunk from
+    :param length: the length of the chunk
+    '''
+    folder = os.path.dirname(path)
+    try:
+        os.makedirs(folder)
+    except OSError as exc:
+        if exc.errno != errno.EEXIST:
+            raise
+    with open(path,'ab') as filey:
+        remaining = length
+        while remaining > 0:
+            data = stream.read(min(chunk_size,remaining))
+            if not data:
+                break
+            filey.write(data)
+            remaining -= len(data)
+    return get_received(path)
+
+
+def prune_uploads(max_age=None,root=None):
+    '''prune_uploads removes partial files that haven't been written to for
+    max_age seconds (abandoned uploads), and returns the number removed
+    '''
+    if max_age is None:
+        max_age = MARKUP_UPLOAD_EXPIRES
+    if root is None:
+        root = MARKUP_UPLOAD_ROOT
+    removed = 0
+    cutoff = time.time() - max_age
+    for folder,dirs,files in os.walk(root):
+        for filename in files:
+            path = os.path.join(folder,filename)
+            try:
+                if os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+                    removed += 1
+            except OSError:
+                pass
+    return removed
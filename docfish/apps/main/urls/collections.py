@@ -33,6 +33,7 @@ urlpatterns = [
     url(r'^collections/(?P<cid>\d+)/$',views.view_collection,name='collection_details'),
     url(r'^collections/(?P<cid>\d+)/explorer$',views.collection_explorer,name='collection_explorer'),
     url(r'^collections/(?P<cid>\d+)/stats/(?P<fieldtype>.+?)/detail$',views.collection_stats_detail,name='collection_stats_detail'),
+    url(r'^collections/(?P<cid>\d+)/export/masks$',views.collection_export_masks,name='collection_export_masks'),
     url(r'^collections/(?P<cid>\d+)/stats/$',views.collection_stats,name='collection_stats'),
     url(r'^collections/(?P<cid>\d+)/entities/delete$',views.delete_collection_entities,name='delete_collection_entities'),
     url(r'^collections/(?P<cid>\d+)/delete$',views.delete_collection,name='delete_collection'),
@@ -45,11 +46,13 @@ urlpatterns = [
     # Collection Annotation/Markup Portal
     url(r'^collections/(?P<cid>\d+)/start$',views.collection_start,name='collection_start'), # all options
     url(r'^collections/(?P<cid>\d+)/instruction/update$',actions.collection_update_instruction,name='collection_update_instruction'),
+    url(r'^collections/(?P<cid>\d+)/redundancy/update$',actions.collection_update_redundancy,name='collection_update_redundancy'),
     url(r'^collections/(?P<cid>\d+)/activate$',views.collection_activate,name='collection_activate'),
     url(r'^collections/(?P<cid>\d+)/(?P<fieldtype>.+?)/activate$',views.collection_activate,name='collection_activate'),
 
     # General
     url(r'^images/(?P<uid>\d+)/metadata$',actions.serve_image_metadata,name='serve_image_metadata'),
+    url(r'^images/(?P<uid>\d+)/derivatives$',actions.serve_image_derivatives,name='serve_image_derivatives'),
     url(r'^text/(?P<uid>\d+)/metadata$',actions.serve_text_metadata,name='serve_text_metadata'),
     url(r'^text/(?P<uid>\d+)/original$',actions.serve_text,name='serve_text'),
 
@@ -32,6 +32,10 @@ urlpatterns = [
     url(r'^collections/(?P<cid>\d+)/images/markup$',views.collection_markup_image,name='collection_markup_image'),
     url(r'^collections/(?P<cid>\d+)/text/markup$',views.collection_markup_text,name='collection_markup_text'),
 
+    # Binary (chunked) upload of a markup layer
+    url(r'^collections/(?P<cid>\d+)/images/(?P<uid>\d+)/markup/upload$',views.upload_markup_layer,name='upload_markup_layer'),
+    url(r'^teams/(?P<tid>\d+)/collection/(?P<cid>\d+)/images/(?P<uid>\d+)/markup/upload$',views.upload_markup_layer,name='upload_markup_layer'),
+
     # Collections (user) save of a single markup
     url(r'^collections/(?P<cid>\d+)/images/(?P<uid>.+?)/markup$',views.markup_image,name='markup_image'),
     url(r'^collections/(?P<cid>\d+)/text/(?P<uid>.+?)/markup$',views.markup_text,name='markup_text'),
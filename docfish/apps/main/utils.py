@@ -45,10 +45,24 @@ from django.db.models.aggregates import Count
 from itertools import chain
 
 from docfish.apps.main.models import *
+from docfish.apps.main.blobs import get_digest
+from docfish.apps.main.masks import encode_mask
+from docfish.apps.main.writes import (
+    add_pending_annotations,
+    add_pending_markup
+)
+from django.db import (
+    IntegrityError,
+    transaction
+)
 from base64 import b64decode
-from docfish.settings import MEDIA_ROOT
+from docfish.settings import (
+    ANNOTATION_WRITE_BEHIND,
+    MEDIA_ROOT
+)
 from random import randint
 from numpy.random import shuffle
+import hashlib
 import numpy
 import json
 import operator
@@ -111,11 +125,12 @@ def get_collection_users(collection):
     return list(chain(contributors,[owner]))
 
 
-def get_annotations(instance,user=None,team=None,return_dict=False):
+def get_annotations(instance,user=None,team=None,return_dict=False,collection=None):
     '''get_annotations will return the Annotation objects for a user and image.
     :param user: the user to return objects for
     :param image: the image to find annotations for
     :param return_dict: if True, convert Annotation objects to dictionary
+    :param collection: the collection annotated in, to show annotations not yet saved (see writes.py)
     '''
     annotations = []
     if user is None and team is None:
@@ -129,6 +144,10 @@ def get_annotations(instance,user=None,team=None,return_dict=False):
 
     if return_dict == True:
         annotations = summarize_annotations(annotations)   
+
+        # Annotations queued to be saved (see writes.py) are shown to the annotator
+        if ANNOTATION_WRITE_BEHIND and collection is not None:
+            annotations = add_pending_annotations(annotations,instance,collection,user=user,team=team)
     return annotations
 
 
@@ -207,41 +226,66 @@ def sniff_template_extension(filename):
 ###########################################################################################
 
 def get_image_basepath(image,full_path=False):
-    '''get_base_image determines if a base image is saved for an image. This is to later match
-    it to it's overlay.
+    '''get_base_image returns the path of the (most recent) base image registered for an 
+    image (see ImageBase), to later match it to it's overlay, or None
     :param full_path: returns full path (False)
     '''
-    filename = get_upload_folder(image,"base-%s.png" %(image.uid))
-    filename_path = "%s/%s" %(MEDIA_ROOT,filename)
-    if os.path.exists(filename_path):
+    image_base = get_image_base(image,return_registry=True)
+    if image_base is not None:
         if full_path:
-            return filename_path
-        return filename
+            return image_base.base.path
+        return image_base.base.name
     return None
 
 
 def has_image_base(image):
-    '''has_base_image returns a boolean value for get_image_basepath to determine
-    if the base image has been saved
+    '''has_base_image returns a boolean value to determine if the base image has been 
+    saved, with one (indexed) query of the registry
     '''
     #TODO: need to think about if we should save base for web ready images... no?
     if isinstance(image,ImageFile):
-        if get_image_basepath(image) is not None:
-            return True
-        return False
+        return ImageBase.objects.filter(image_id=image.id).exists()
     return True
 
 
-def get_image_base(image):
-    '''get image base will return the ContentFile for a particular
-    image.
+def get_image_base(image,return_registry=False):
+    '''get image base will return the saved base file for a particular
+    image, or None
     :param image: the image to get the base for
+    :param return_registry: return the ImageBase instead of the file
     '''
-    image_base = None
-    image_basepath = get_image_basepath(image)
-    contenders = ImageMarkup.objects.filter(base=image_basepath)
-    if len(contenders) > 0:
-        image_base = contenders[0].base
+    image_base = ImageBase.objects.filter(image_id=image.id).order_by('-id').first()
+    if image_base is None or return_registry == True:
+        return image_base
+    return image_base.base
+
+
+def register_image_base(image,content):
+    '''register_image_base saves png content as the base of an image, unless the same
+    content is already saved, and returns the ImageBase
+    :param image: the image the base was made from
+    :param content: the png bytes of the base, or a File
+    '''
+    if isinstance(content,bytes):
+        digest = get_digest(content)
+        content = ContentFile(content)
+    else:
+        digest = hashlib.sha256()
+        for chunk in content.chunks():
+            digest.update(chunk)
+        digest = digest.hexdigest()
+        content.seek(0)
+    image_base = ImageBase.objects.filter(image_id=image.id,digest=digest).first()
+    if image_base is None:
+        image_base = ImageBase(image=image,digest=digest)
+        image_base.base.save("base-%s.png" %(image.uid),content,save=False)
+        try:
+            with transaction.atomic():
+                image_base.save()
+        except IntegrityError:
+            # Another annotator saved the same base first
+            image_base.base.delete(save=False)
+            image_base = ImageBase.objects.get(image_id=image.id,digest=digest)
     return image_base
 
 
@@ -250,21 +294,33 @@ def save_markup(markup,overlay=None,base=None,team=None):
     It handles naming the file based on the user, and adding optional
     png data
     :param markup: the markup object
-    :param overlay: the png data of the overlay to save
-    :param base: the base image to save
+    :param overlay: the png data (or file) of the overlay to save, kept as a mask (see masks.py)
+    :param base: the png data (or File) of the base image to save
     '''
-    if team is None:
-        markup_name = "user-%s-%s.png" %(markup.creator.username,markup.image.uid)
-    else:
-        markup_name = "team-%s-%s.png" %(markup.team.id,markup.image.uid)
     if overlay is not None:
-        if markup.overlay is not None:
-            markup.overlay.delete()
-        markup.overlay.save(markup_name, ContentFile(png2base64(overlay)))
+        if isinstance(overlay,str):
+            overlay = png2base64(overlay)
+        elif not isinstance(overlay,bytes):
+            overlay = overlay.read()
+        encoded = encode_mask(overlay)
+        if markup.overlay:
+            markup.overlay.delete(save=False)
+
+        # An overlay with too many colors for a mask is kept as a png
+        if encoded is None:
+            if markup.team_id is not None:
+                markup_name = "team-%s-%s.png" %(markup.team_id,markup.image.uid)
+            else:
+                markup_name = "user-%s-%s.png" %(markup.creator.username,markup.image.uid)
+            markup.overlay.save(markup_name,ContentFile(overlay),save=False)
+            encoded = (None,None,None,None)
+        markup.mask,markup.mask_width,markup.mask_height,markup.mask_palette = encoded
     if base is not None:
-        if markup.base is not None:
-            markup.base.delete()
-        markup.base.save("base-%s.png" %(markup.image.uid), ContentFile(png2base64(base)))
+        if isinstance(base,str):
+            base = png2base64(base)
+        markup.image_base = register_image_base(markup.image,base)
+        markup.base = markup.image_base.base
+    markup.save()
     return markup
 
 def png2base64(data):
@@ -298,6 +354,23 @@ def get_markup(instance,user,collection,team=None):
             markup = TextMarkup.objects.filter(text=instance,
                                                creator=user,
                                                collection=collection).first()
+        if ANNOTATION_WRITE_BEHIND:
+            markup = add_pending_markup(markup,instance,user,collection,team=team)
+    return markup
+
+
+def get_markup_to_save(image,user,collection,team=None):
+    '''get_markup_to_save returns the markup of an image by a user (or team) in a
+    collection, creating it if it doesn't exist
+    '''
+    if team is not None:
+        markup,created = ImageMarkup.objects.get_or_create(team=team,
+                                                           image=image,
+                                                           defaults={'collection':collection})
+    else:
+        markup,created = ImageMarkup.objects.get_or_create(creator=user,
+                                                           image=image,
+                                                           defaults={'collection':collection})
     return markup
 
 
@@ -5,6 +5,7 @@ from .collections import (
     collection_chooser,
     collection_explorer,
     collection_start,
+    collection_export_masks,
     collection_stats,
     collection_stats_detail,
     delete_collection,
@@ -38,7 +39,8 @@ from .markup import (
     collection_markup_image,
     collection_markup_text,
     markup_image,
-    markup_text
+    markup_text,
+    upload_markup_layer
 )
 
 from .describe import (
@@ -35,6 +35,8 @@ from docfish.apps.main.utils import *
 from docfish.apps.main.navigation import (
     get_next_to_annotate
 )
+from docfish.apps.main.leases import claim_next
+from docfish.apps.main.prefetch import prefetch_texts
 
 from docfish.apps.main.actions import (
     clear_annotations,
@@ -93,7 +95,8 @@ def collection_annotate_image(request,cid):
 
         annotations = get_annotations(user=request.user,
                                       instance=next_image,
-                                      return_dict=True)
+                                      return_dict=True,
+                                      collection=collection)
 
         allowed_annotations = collection.get_annotations()
 
@@ -155,7 +158,8 @@ def collection_annotate_text(request,cid):
 
         annotations = get_annotations(user=request.user,
                                       instance=next_text,
-                                      return_dict=True)
+                                      return_dict=True,
+                                      collection=collection)
 
         allowed_annotations = collection.get_annotations()
 
@@ -195,24 +199,28 @@ def team_annotate_text(request,cid,tid,uid=None):
         collaborate = True
         if uid is None:
             collaborate = False
-            text,next_text = get_next_to_annotate(user=request.user,
-                                                  collection=collection,
-                                                  get_images=False,
-                                                  team=team,
-                                                  N=2)
+            text,next_text = claim_next(user=request.user,
+                                        collection=collection,
+                                        team=team,
+                                        task="text_annotation",
+                                        N=2)
         else:
             collaborate = True
             text = get_text(uid) 
-            next_text = get_next_to_annotate(user=request.user,
-                                             collection=collection,
-                                             get_images=False,
-                                             team=team,
-                                             skip=text.id)
+            next_text = claim_next(user=request.user,
+                                   collection=collection,
+                                   team=team,
+                                   task="text_annotation",
+                                   skip=text.id)
         
+        # The next text is fetched while this one is worked on
+        prefetch_texts([next_text])
+
         annotations = get_annotations(user=None,
                                       instance=text,
                                       return_dict=True,
-                                      team=team)
+                                      team=team,
+                                      collection=collection)
 
         allowed_annotations = collection.get_annotations()
 
@@ -250,22 +258,25 @@ def team_annotate_image(request,cid,tid,uid=None):
         collaborate = True
         if uid is None:
             collaborate = False
-            image,next_image = get_next_to_annotate(user=request.user,
-                                                    collection=collection,
-                                                    team=team,
-                                                    N=2)
+            image,next_image = claim_next(user=request.user,
+                                          collection=collection,
+                                          team=team,
+                                          task="image_annotation",
+                                          N=2)
         else:
             image = get_image(uid)
-            next_image = get_next_to_annotate(user=request.user,
-                                              collection=collection,
-                                              team=team,
-                                              skip=image.id)
+            next_image = claim_next(user=request.user,
+                                    collection=collection,
+                                    team=team,
+                                    task="image_annotation",
+                                    skip=image.id)
         
         # Stopped here - this function isn't returning any annotations
         annotations = get_annotations(user=request.user,
                                       return_dict=True,
                                       instance=image,
-                                      team=team)
+                                      team=team,
+                                      collection=collection)
 
         allowed_annotations = collection.get_annotations()
 
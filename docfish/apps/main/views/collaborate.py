@@ -34,6 +34,7 @@ from docfish.apps.main.permission import (
 )
 
 from docfish.apps.main.utils import *
+from docfish.apps.main.schema import get_collection_schema
 from docfish.settings import DOMAIN_NAME
 from docfish.apps.users.utils import (
     get_user,
@@ -98,7 +99,7 @@ def team_portal(request,tid,cid,status=None):
             status[text_type]['active'] = False
 
     # We cannot annotate without labels
-    if collection.allowed_annotations.count() < 1:
+    if len(get_collection_schema(collection)) < 1:
         for needs_label in needs_labels:
             status[needs_label]['active'] = False
 
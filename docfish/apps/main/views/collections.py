@@ -39,9 +39,17 @@ from docfish.apps.main.permission import (
     get_permissions
 )
 
-from docfish.settings import DOMAIN_NAME
+from docfish.apps.main.exports import (
+    get_export_url,
+    is_export_current
+)
+from docfish.settings import (
+    DOMAIN_NAME,
+    PRIVATE_MEDIA_REDIRECT_HEADER
+)
 from docfish.apps.main.utils import *
 from docfish.apps.main.views.labels import view_label
+from docfish.apps.main.schema import get_collection_schema
 
 from docfish.apps.users.utils import (
     get_user
@@ -50,6 +58,7 @@ from docfish.apps.users.utils import (
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.models import User
 from django.contrib import messages
+from django.core.cache import cache
 from django.http import HttpResponse, JsonResponse
 from django.http.response import (
     HttpResponseRedirect, 
@@ -168,7 +177,7 @@ def my_collections(request):
 @login_required
 def view_collection(request,cid):
     collection = get_collection(cid)
-    entity_count = collection.entity_set.count()
+    entity_count = collection.entity_count
     context = {"collection":collection,
                "entity_count":entity_count,
                "domain":DOMAIN_NAME}
@@ -182,8 +191,10 @@ def collection_explorer(request,cid):
 
     collection = get_collection(cid)
     if has_collection_edit_permission(request,collection) or collection.private is False:
-        entity_count = collection.entity_set.count()
+        entity_count = collection.entity_count
+        entities = get_entity_storage(collection.entity_set.all())
         context = {"collection":collection,
+                   "entities":entities,
                    "entity_count":entity_count,
                    "nosidebar":"iloveparsnips",
                    "domain":DOMAIN_NAME}
@@ -201,9 +212,9 @@ def collection_stats(request,cid):
     '''return basic stats (counts) for collection
     '''
     collection = get_collection(cid)
-    entity_count = collection.entity_set.count()
-    image_count = Image.objects.filter(entity__collection=collection).count()
-    text_count = Text.objects.filter(entity__collection=collection).count()
+    entity_count = collection.entity_count
+    image_count = collection.image_count
+    text_count = collection.text_count
     counts = count_collection_annotations(collection)
     context = {"collection":collection,
                "entity_count":entity_count,
@@ -215,13 +226,37 @@ def collection_stats(request,cid):
     return render(request, 'collections/collection_stats.html', context)
 
 
+@login_required
+def collection_export_masks(request,cid):
+    '''collection_export_masks downloads the markup masks of a collection (see exports.py),
+    if the export was made from the markups as they are now, and otherwise asks the worker
+    to make it
+    '''
+    collection = get_collection(cid)
+    if not has_collection_edit_permission(request,collection):
+        messages.info(request, "You do not have permission to perform this action.")
+        return redirect('collection_details',cid=cid)
+
+    if is_export_current(collection):
+        response = HttpResponse(content_type='application/gzip')
+        response['Content-Disposition'] = 'attachment; filename="collection-%s-masks.tar.gz"' %(collection.id)
+        response[PRIVATE_MEDIA_REDIRECT_HEADER] = get_export_url(collection.id)
+        return response
+
+    if cache.add("export-masks-%s" %collection.id,True,60*60):
+        from docfish.apps.main.tasks import export_masks
+        export_masks.apply_async(kwargs={'cid':collection.id})
+    messages.info(request,"The markup masks are being exported. Check back soon to download them.")
+    return redirect('collection_details',cid=cid)
+
+
 def collection_stats_detail(request,cid,fieldtype):
     '''return detailed stats (counts) for collection fieldtype
     '''
     collection = get_collection(cid)
-    entity_count = collection.entity_set.count()
-    image_count = Image.objects.filter(entity__collection=collection).count()
-    text_count = Text.objects.filter(entity__collection=collection).count()
+    entity_count = collection.entity_count
+    image_count = collection.image_count
+    text_count = collection.text_count
     counts = count_task_annotations(collection,fieldtype)
     if counts is not None:
         context = {"collection":collection,
@@ -379,7 +414,7 @@ def collection_start(request,cid,status=None):
             status[text_type]['active'] = False
 
     # We cannot annotate without labels
-    if collection.allowed_annotations.count() < 1:
+    if len(get_collection_schema(collection)) < 1:
         for needs_label in needs_labels:
             status[needs_label]['active'] = False
 
@@ -32,6 +32,8 @@ from docfish.apps.main.models import (
 from docfish.apps.main.utils import *
 from docfish.apps.main.permission import has_collection_annotate_permission
 from docfish.apps.main.navigation import get_next_to_describe
+from docfish.apps.main.leases import claim_next
+from docfish.apps.main.prefetch import prefetch_texts
 
 from docfish.apps.users.utils import (
     get_team,
@@ -149,16 +151,18 @@ def describe_image(request,cid,uid=None,tid=None):
         if collection.has_images():
             if uid is None:
                 collaborate = False
-                image,next_image = get_next_to_describe(user=request.user,
-                                                        collection=collection,
-                                                        team=team,
-                                                        N=2)
+                image,next_image = claim_next(user=request.user,
+                                              collection=collection,
+                                              team=team,
+                                              task="image_describe",
+                                              N=2)
             else:   
                 image = get_image(uid)
-                next_image = get_next_to_describe(user=request.user,
-                                                  collection=collection,
-                                                  team=team,
-                                                  skip=image.id)
+                next_image = claim_next(user=request.user,
+                                        collection=collection,
+                                        team=team,
+                                        task="image_describe",
+                                        skip=image.id)
     
             description = get_description(user=request.user,
                                           instance=image,
@@ -260,18 +264,21 @@ def describe_text(request,cid,uid=None,tid=None):
         if collection.has_text():
             if uid == None:
                 collaborate = False
-                text, next_text = get_next_to_describe(user=request.user,
-                                                       collection=collection,
-                                                       team=team,
-                                                       N=2,
-                                                       get_images=False)
+                text, next_text = claim_next(user=request.user,
+                                             collection=collection,
+                                             team=team,
+                                             task="text_describe",
+                                             N=2)
             else:
                 text = get_text(uid)
-                next_text = get_next_to_describe(user=request.user,
-                                                 collection=collection,
-                                                 team=team,
-                                                 get_images=False,
-                                                 skip=text.id)
+                next_text = claim_next(user=request.user,
+                                       collection=collection,
+                                       team=team,
+                                       task="text_describe",
+                                       skip=text.id)
+
+            # The next text is fetched while this one is worked on
+            prefetch_texts([next_text])
 
             description = get_description(user=request.user,
                                           instance=text,
@@ -24,7 +24,10 @@ SOFTWARE.
 
 '''
 
-from docfish.apps.main.models import Entity
+from docfish.apps.main.models import (
+    Entity,
+    select_storage
+)
 from docfish.apps.main.permission import get_permissions
 
 from docfish.apps.main.utils import *
@@ -54,7 +57,12 @@ def view_entity(request,cid,eid):
     collection = get_collection(cid)
     entity = get_entity(eid)
 
+    images = select_storage(entity.image_entity.all())
+    texts = select_storage(entity.text_entity.all())
+
     context = {"entity":entity,
+               "images":images,
+               "texts":texts,
                "collection":collection}
 
     # Get all permissions, context must have collection as key
@@ -36,6 +36,7 @@ from django.http.response import (
 
 from docfish.apps.users.utils import get_team
 from docfish.apps.main.models import Annotation
+from docfish.apps.main.schema import invalidate_schema
 from docfish.apps.main.utils import get_collection
 from docfish.apps.main.permission import (
     has_collection_edit_permission
@@ -99,6 +100,7 @@ def create_label(request,cid,lid=None):
                     allowed_annotation = Annotation.objects.get(id=lid)
                     collection.allowed_annotations.add(allowed_annotation)
                     collection.save()
+                    invalidate_schema(collection.id)
                     label_name = "%s:%s" %(allowed_annotation.name,
                                            allowed_annotation.label)
                     response_text = {"result": "New annotation label %s added successfully." %(label_name)}
@@ -119,6 +121,7 @@ def create_label(request,cid,lid=None):
                                 allowed_annot.save()
                             collection.allowed_annotations.add(allowed_annot)
 
+                    invalidate_schema(collection.id)
                     messages.info(request,"Label generation successful.")
                 else:
                     messages.info(request,"An annotation name is required.")
@@ -141,6 +144,7 @@ def remove_label(request,cid,lid):
         allowed_annotation = Annotation.objects.get(id=lid)
         collection.allowed_annotations.remove(allowed_annotation)
         collection.save()
+        invalidate_schema(collection.id)
         messages.info(request,"Label removed successfully.")
     else:                
         messages.info(request, "You do not have permission to perform this action.")
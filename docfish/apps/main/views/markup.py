@@ -32,6 +32,20 @@ from docfish.apps.main.utils import *
 from docfish.apps.main.navigation import (
     get_next_to_markup
 )
+from docfish.apps.main.leases import claim_next
+from docfish.apps.main.prefetch import prefetch_texts
+from docfish.apps.main.uploads import (
+    get_received,
+    get_upload_path,
+    is_upload_id,
+    new_upload_id,
+    parse_content_range,
+    write_chunk
+)
+from docfish.settings import (
+    MARKUP_UPLOAD_MAX_BYTES,
+    MARKUP_UPLOAD_MAX_CHUNK
+)
 
 from docfish.apps.users.utils import (
     get_user,
@@ -47,7 +61,8 @@ from docfish.apps.main.permission import (
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.models import User
 from django.contrib import messages
-from django.http import HttpResponse
+from django.core.files import File
+from django.http import HttpResponse, JsonResponse
 from django.http.response import (
     HttpResponseRedirect, 
     HttpResponseForbidden, 
@@ -155,12 +170,13 @@ def markup_image(request,cid,uid=None,tid=None):
 
             # Otherwise, try to retrieve the already existing image
             else:
-                base_image = get_image_base(image)
+                markup.image_base = get_image_base(image,return_registry=True)
+                if markup.image_base is not None:
+                    markup.base = markup.image_base.base
                 markup = save_markup(markup=markup,overlay=png_data)
-                markup.base = base_image
-                markup.save()
 
-        else:
+        # Layers sent to upload_markup_layer are already saved
+        elif request.POST.get('uploaded',None) is None:
             messages.info(request, "No markup detected. Did you annotate the image?")
 
     if team is not None:  
@@ -168,16 +184,18 @@ def markup_image(request,cid,uid=None,tid=None):
         if collection.has_images():
             if uid is None:
                 collaborate = False
-                image,next_image = get_next_to_markup(user=request.user,
-                                                      collection=collection,
-                                                      team=team,
-                                                      N=2)
+                image,next_image = claim_next(user=request.user,
+                                              collection=collection,
+                                              team=team,
+                                              task="image_markup",
+                                              N=2)
             else:   
                 image = get_image(uid)
-                next_image = get_next_to_markup(user=request.user,
-                                                collection=collection,
-                                                team=team,
-                                                skip=image.id)
+                next_image = claim_next(user=request.user,
+                                        collection=collection,
+                                        team=team,
+                                        task="image_markup",
+                                        skip=image.id)
     
             markup = get_markup(user=request.user,
                                 instance=image,
@@ -213,6 +231,71 @@ def markup_image(request,cid,uid=None,tid=None):
 # Text ###############################################################################
 ######################################################################################
 
+@login_required
+def upload_markup_layer(request,cid,uid,tid=None):
+    '''upload_markup_layer receives a markup layer (the overlay or base png) as raw binary, in 
+    chunks (see uploads.py), and saves it to the markup of the image when it is complete. Each 
+    POST sends one chunk, with headers Content-Range, X-Markup-Layer (overlay or base), and 
+    X-Upload-Id (given in the response to the first chunk). A GET with the upload id returns 
+    the bytes received, to resume.
+    '''
+    team = get_team(tid,return_none=True)
+    collection = get_collection(cid)
+
+    if collection.private == True:
+        if not has_collection_annotate_permission(request,collection,team):
+            return JsonResponse({"error":"You do not have permission to annotate this collection."},status=403)
+
+    image = get_image(uid)
+    layer = request.META.get('HTTP_X_MARKUP_LAYER','overlay')
+    if layer not in ['overlay','base']:
+        return JsonResponse({"error":"The markup layer must be overlay or base."},status=400)
+
+    upload_id = request.META.get('HTTP_X_UPLOAD_ID',None)
+    if upload_id is None:
+        upload_id = new_upload_id()
+    elif not is_upload_id(upload_id):
+        return JsonResponse({"error":"Invalid upload id %s" %(upload_id)},status=400)
+
+    path = get_upload_path(request.user.id,upload_id)
+    received = get_received(path)
+    if request.method != "POST":
+        return JsonResponse({"upload_id":upload_id,"received":received})
+
+    content_range = parse_content_range(request.META.get('HTTP_CONTENT_RANGE',None))
+    if content_range is None:
+        return JsonResponse({"error":"A valid Content-Range header is required."},status=400)
+
+    start,end,total = content_range
+    length = end - start + 1
+    if total > MARKUP_UPLOAD_MAX_BYTES or length > MARKUP_UPLOAD_MAX_CHUNK:
+        return JsonResponse({"error":"The markup layer or chunk is too large."},status=413)
+
+    # The client resumes from what was received
+    if start != received:
+        return JsonResponse({"upload_id":upload_id,"received":received},status=409)
+
+    received = write_chunk(path,request,length)
+    if received < total:
+        return JsonResponse({"upload_id":upload_id,"received":received})
+
+    markup = get_markup_to_save(image=image,
+                                user=request.user,
+                                collection=collection,
+                                team=team)
+    with open(path,'rb') as filey:
+        if layer == "base":
+            markup = save_markup(markup=markup,base=File(filey))
+        else:
+            if markup.image_base is None:
+                markup.image_base = get_image_base(image,return_registry=True)
+                if markup.image_base is not None:
+                    markup.base = markup.image_base.base
+            markup = save_markup(markup=markup,overlay=filey)
+    os.remove(path)
+    return JsonResponse({"upload_id":upload_id,"received":received,"markup":markup.id})
+
+
 @login_required
 def collection_markup_text(request,cid):
     '''collection_markup_text will return a new text to markup
@@ -273,19 +356,22 @@ def markup_text(request,cid,uid=None,tid=None):
         if collection.has_text():
             if uid is None:
                 collaborate = False
-                text,next_text = get_next_to_markup(user=request.user,
-                                                    collection=collection,
-                                                    team=team,
-                                                    get_images=False,
-                                                    N=2)
+                text,next_text = claim_next(user=request.user,
+                                            collection=collection,
+                                            team=team,
+                                            task="text_markup",
+                                            N=2)
             else:   
                 text = get_text(uid)
-                next_text = get_next_to_markup(user=request.user,
-                                               collection=collection,
-                                               team=team,
-                                               get_images=False,
-                                               skip=text.id)
+                next_text = claim_next(user=request.user,
+                                       collection=collection,
+                                       team=team,
+                                       task="text_markup",
+                                       skip=text.id)
     
+            # The next text is fetched while this one is worked on
+            prefetch_texts([next_text])
+
             markup = get_markup(user=request.user,
                                 instance=text,
                                 team=team,
@@ -0,0 +1,421 @@
+'''
+
+Copyright (c) 2017 Vanessa Sochat
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+'''
+
+from django.core.cache import cache
+from django.contrib.auth.models import User
+from django.utils import timezone
+from django_redis import get_redis_connection
+
+from docfish.apps.main.models import (
+    Collection,
+    Image,
+    ImageAnnotation,
+    Text,
+    TextAnnotation,
+    TextMarkup
+)
+from docfish.apps.main.schema import get_collection_schema
+from docfish.settings import (
+    ANNOTATION_WRITE_BATCH,
+    ANNOTATION_WRITE_DELAY,
+    ANNOTATION_WRITE_PENDING_TIMEOUT
+)
+
+import datetime
+import json
+import logging
+import time
+import uuid
+
+logger = logging.getLogger(__name__)
+
+# With ANNOTATION_WRITE_BEHIND, annotations and text markup are not saved by the request.
+# The request checks the payload, appends the write to a list in redis (which is durable, and
+# shared by all processes), and returns. The worker saves the queued writes in batches, in the 
+# order they were queued (so in order for each annotator), and one batch at a time. Each write 
+# sets state (the labels of some names, or the markup), so applying a write again (if the worker 
+# stops before a batch is removed from the list) leaves the same result. Until a write is saved,
+# it is kept as "pending" in the cache, and added to what the annotator is shown. The pending
+# annotations record the write that last set each name, so a write only clears (or, on retry,
+# sets) the names that no newer write has set. A write that fails is logged, and kept (with 
+# its pending state, which doesn't expire) in a list of failed writes until it is retried or
+# discarded (see the annotation_writes command).
+
+WRITES_KEY = "annotation-writes"
+FAILED_KEY = "annotation-writes-failed"
+
+
+#############################################################################################
+# Pending
+#############################################################################################
+
+def get_item(instance):
+    '''get_item returns the kind (image or text) and id of an image or text'''
+    if isinstance(instance,Image):
+        return "image",instance.id
+    return "text",instance.id
+
+
+def get_pending_key(kind,item,item_id,cid,user_id=None,team_id=None):
+    '''get_pending_key returns the cache key of the pending write of an annotator
+    :param kind: the kind of write, annotations or text_markup
+    :param item: the kind of item, image or text
+    :param cid: the collection id
+    '''
+    if team_id is not None:
+        annotator = "team-%s" %(team_id)
+    else:
+        annotator = "user-%s" %(user_id)
+    return "pending-%s-%s-%s-%s-%s" %(kind,item,item_id,annotator,cid)
+
+
+def get_write_pending_key(write):
+    '''get_write_pending_key returns the cache key of the pending state of a queued write'''
+    return get_pending_key(kind=write['kind'],
+                           item=write['item'],
+                           item_id=write['item_id'],
+                           cid=write['cid'],
+                           user_id=write['user_id'],
+                           team_id=write['team_id'])
+
+
+def set_pending(key,pending):
+    '''set_pending caches the pending state of an annotator, without expiry while
+    it holds a failed write
+    '''
+    if len(pending.get('failed',[])) > 0:
+        cache.set(key,pending,None)
+    else:
+        cache.set(key,pending,ANNOTATION_WRITE_PENDING_TIMEOUT)
+
+
+def add_pending_annotations(summary,instance,collection,user=None,team=None):
+    '''add_pending_annotations adds unsaved annotations of a user (or team) in a collection
+    to a summary of their annotations (see summarize_annotations)
+    '''
+    item,item_id = get_item(instance)
+    key = get_pending_key("annotations",item,item_id,collection.id,
+                          user_id=getattr(user,'id',None),
+                          team_id=getattr(team,'id',None))
+    pending = cache.get(key)
+    if pending is not None:
+        for name,label in pending['labels'].items():
+            summary['labels'][name] = label
+            summary['counts'][name] = 1
+    return summary
+
+
+def add_pending_markup(markup,instance,user,collection,team=None):
+    '''add_pending_markup returns the text markup of a user (or team) with any unsaved
+    markup in place of the saved locations. An (unsaved) TextMarkup is returned if there 
+    is pending markup, but none saved.
+    '''
+    item,item_id = get_item(instance)
+    key = get_pending_key("text_markup",item,item_id,collection.id,
+                          user_id=getattr(user,'id',None),
+                          team_id=getattr(team,'id',None))
+    pending = cache.get(key)
+    if pending is not None:
+        if markup is None:
+            markup = TextMarkup(text=instance,
+                                team=team,
+                                collection=collection)
+            if team is None:
+                markup.creator = user
+        markup.locations = pending['locations']
+    return markup
+
+
+#############################################################################################
+# Queue
+#############################################################################################
+
+def new_write(kind,instance,user,cid,tid=None,**kwargs):
+    '''new_write returns a write to queue, a dictionary with a unique id, the
+    annotator and item, and the data of the write (kwargs)
+    '''
+    item,item_id = get_item(instance)
+    write = {"id": uuid.uuid4().hex,
+             "kind": kind,
+             "item": item,
+             "item_id": item_id,
+             "user_id": user.id,
+             "team_id": int(tid) if tid is not None else None,
+             "cid": int(cid),
+             "time": time.time()}
+    write.update(kwargs)
+    return write
+
+
+def push_write(write):
+    '''push_write appends a write to the queue, and schedules the worker to save
+    queued writes (unless it is already scheduled)
+    '''
+    from docfish.apps.main.tasks import save_annotation_writes
+    connection = get_redis_connection('default')
+    connection.rpush(WRITES_KEY,json.dumps(write))
+    if cache.add("%s-scheduled" %WRITES_KEY,True,ANNOTATION_WRITE_DELAY + 60):
+        save_annotation_writes.apply_async(countdown=ANNOTATION_WRITE_DELAY)
+
+
+def queue_annotations(user,instance,labels,cid,tid=None):
+    '''queue_annotations checks annotations of a user (or team) for an image or text against
+    the collection schema, and queues those allowed to be saved (see bulk_update_annotations). 
+    A dictionary of the result for each label is returned (queued, or not allowed).
+    :param user: the user
+    :param instance: the Image or Text instance
+    :param labels: a list of labels, each "name||label"
+    '''
+    results = dict()
+    allowed = []
+    schema = get_collection_schema(cid)
+    for label in labels:
+        if label in schema.ids:
+            results[label] = "queued"
+            allowed.append(label)
+        else:
+            results[label] = "not allowed"
+
+    if len(allowed) > 0:
+        write = new_write("annotations",instance,user,cid,tid,labels=allowed)
+        key = get_write_pending_key(write)
+        pending = cache.get(key) or {"labels":dict(),"names":dict()}
+        for name,label in [label.split('||',1) for label in allowed]:
+            pending['labels'][name] = label
+            pending['names'][name] = write['id']
+        pending['write'] = write['id']
+        set_pending(key,pending)
+        push_write(write)
+    return results
+
+
+def queue_text_markup(user,text,cid,locations,tid=None):
+    '''queue_text_markup queues the markup of a user (or team) for a text to be saved
+    :param locations: the markup locations, a dictionary with the text and markups
+    '''
+    write = new_write("text_markup",text,user,cid,tid,locations=locations)
+    cache.set(get_write_pending_key(write),
+              {"locations":locations,"write":write['id']},
+              ANNOTATION_WRITE_PENDING_TIMEOUT)
+    push_write(write)
+    return write
+
+
+#############################################################################################
+# Saving
+#############################################################################################
+
+def apply_write(write):
+    '''apply_write saves a queued write'''
+    from docfish.apps.main.actions import (
+        bulk_update_annotations,
+        save_text_markup
+    )
+    from docfish.apps.users.models import Team
+
+    user = User.objects.get(id=write['user_id'])
+    if write['item'] == "image":
+        instance = Image.objects.get(id=write['item_id'])
+    else:
+        instance = Text.objects.get(id=write['item_id'])
+
+    if write['kind'] == "annotations":
+        bulk_update_annotations(user=user,
+                                instance=instance,
+                                labels=write['labels'],
+                                cid=write['cid'],
+                                tid=write['team_id'])
+
+    elif write['kind'] == "text_markup":
+        team = None
+        if write['team_id'] is not None:
+            team = Team.objects.get(id=write['team_id'])
+        save_text_markup(user=user,
+                         text=instance,
+                         collection=Collection.objects.get(id=write['cid']),
+                         locations=write['locations'],
+                         team=team)
+
+
+def clear_pending(write):
+    '''clear_pending removes the pending state of a saved (or discarded) write: for 
+    annotations, the names it was the last to set, and for text markup, the markup, unless 
+    a newer write by the annotator (for the same item) has replaced it
+    '''
+    key = get_write_pending_key(write)
+    pending = cache.get(key)
+    if pending is None:
+        return
+    if write['kind'] == "annotations":
+        for name,write_id in list(pending['names'].items()):
+            if write_id == write['id']:
+                del pending['names'][name]
+                del pending['labels'][name]
+        if write['id'] in pending.get('failed',[]):
+            pending['failed'].remove(write['id'])
+
+        # A failed write is kept, so its retry knows what newer writes have set
+        if len(pending['names']) > 0 or len(pending.get('failed',[])) > 0:
+            set_pending(key,pending)
+            return
+    elif pending['write'] != write['id']:
+        return
+    cache.delete(key)
+
+
+def keep_pending(write):
+    '''keep_pending keeps the pending state of a failed write (what newer writes haven't
+    replaced) until the write is retried or discarded. If the pending state has expired,
+    it is set again from the write, as no newer write has been queued.
+    '''
+    key = get_write_pending_key(write)
+    pending = cache.get(key)
+    if pending is None:
+        if write['kind'] == "annotations":
+            labels = dict([label.split('||',1) for label in write['labels']])
+            pending = {"labels":labels,
+                       "names":dict([(name,write['id']) for name in labels]),
+                       "write":write['id']}
+        else:
+            pending = {"locations":write['locations'],"write":write['id']}
+    elif write['kind'] != "annotations" and pending['write'] != write['id']:
+        return
+    pending['failed'] = pending.get('failed',[]) + [write['id']]
+    set_pending(key,pending)
+
+
+def save_writes(batch_size=None):
+    '''save_writes saves queued writes, in order, a batch at a time, until the queue
+    is empty. A batch is removed from the queue only after it is saved, and writes that 
+    fail are logged and moved to a list (FAILED_KEY), so they don't block the queue.
+    Returns the number of writes saved.
+    '''
+    if batch_size is None:
+        batch_size = ANNOTATION_WRITE_BATCH
+    connection = get_redis_connection('default')
+    count = 0
+    while True:
+        batch = connection.lrange(WRITES_KEY,0,batch_size - 1)
+        if len(batch) == 0:
+            break
+        for entry in batch:
+            write = json.loads(entry.decode('utf-8'))
+            try:
+                apply_write(write)
+            except Exception as e:
+                logger.exception("Error saving queued %s write %s",write['kind'],write['id'])
+                write['error'] = str(e)
+                connection.rpush(FAILED_KEY,json.dumps(write))
+                keep_pending(write)
+                continue
+            clear_pending(write)
+            count += 1
+        connection.ltrim(WRITES_KEY,len(batch),-1)
+    return count
+
+
+def count_writes():
+    '''count_writes returns the number of writes waiting in the queue'''
+    return get_redis_connection('default').llen(WRITES_KEY)
+
+
+#############################################################################################
+# Failed
+#############################################################################################
+
+def get_failed_writes():
+    '''get_failed_writes returns the writes that failed, oldest first'''
+    connection = get_redis_connection('default')
+    return [json.loads(x.decode('utf-8')) for x in connection.lrange(FAILED_KEY,0,-1)]
+
+
+def get_saved_names(write,names):
+    '''get_saved_names returns the names (of those given) that the annotator of a write
+    has saved since the write was made, for a write without pending state
+    '''
+    if write['item'] == "image":
+        work = ImageAnnotation.objects.filter(image_id=write['item_id'])
+    else:
+        work = TextAnnotation.objects.filter(text_id=write['item_id'])
+    if write['team_id'] is not None:
+        work = work.filter(team_id=write['team_id'])
+    else:
+        work = work.filter(creator_id=write['user_id'])
+    since = datetime.datetime.fromtimestamp(write['time'],timezone.utc)
+    work = work.filter(collection_id=write['cid'],
+                       annotation__name__in=names,
+                       modify_date__gte=since)
+    return set(work.values_list('annotation__name',flat=True))
+
+
+def get_retry(write):
+    '''get_retry returns a failed write to queue again, with only what no newer write of the
+    annotator has replaced (the names it still sets, for annotations), or None if nothing is left
+    '''
+    pending = cache.get(get_write_pending_key(write))
+    if write['kind'] == "annotations":
+        labels = [label.split('||',1) for label in write['labels']]
+        if pending is not None:
+            names = [name for name,write_id in pending['names'].items() if write_id == write['id']]
+        else:
+            saved = get_saved_names(write,[name for name,label in labels])
+            names = [name for name,label in labels if name not in saved]
+        write['labels'] = ["%s||%s" %(name,label) for name,label in labels if name in names]
+        if len(write['labels']) == 0:
+            return None
+
+    elif pending is None or pending['write'] != write['id']:
+        return None
+    write.pop('error',None)
+    return write
+
+
+def retry_failed_writes():
+    '''retry_failed_writes queues the failed writes again, in order, without what a newer
+    write of the annotator has replaced (see get_retry), so a retry never undoes newer work.
+    Returns the number of writes queued.
+    '''
+    connection = get_redis_connection('default')
+    count = 0
+    entry = connection.lpop(FAILED_KEY)
+    while entry is not None:
+        write = json.loads(entry.decode('utf-8'))
+        key = get_write_pending_key(write)
+        pending = cache.get(key)
+        if pending is not None and write['id'] in pending.get('failed',[]):
+            pending['failed'].remove(write['id'])
+            set_pending(key,pending)
+        write = get_retry(write)
+        if write is not None:
+            push_write(write)
+            count += 1
+        entry = connection.lpop(FAILED_KEY)
+    return count
+
+
+def discard_failed_writes():
+    '''discard_failed_writes removes the failed writes, and their pending state'''
+    for write in get_failed_writes():
+        clear_pending(write)
+    get_redis_connection('default').delete(FAILED_KEY)
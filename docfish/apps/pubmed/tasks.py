@@ -73,7 +73,9 @@ def add_storage_articles(pmids,cid=None):
             image,created = ImageLink.objects.get_or_create(uid=ds_image['uid'],
                                                             entity=entity,
                                                             defaults={'metadata':metadata,
-                                                                      'url':ds_image['url']})
+                                                                      'url':ds_image['url'],
+                                                                      'content_type':get_content_type(ds_image['url'],
+                                                                                                      ds_image['storage_contentType'])})
             image.tags.add(ds_image['storage_contentType'])
             if ds_image['storage_contentType'].endswith('pdf'):
                 image.tags.add('pdf')
@@ -87,7 +89,9 @@ def add_storage_articles(pmids,cid=None):
             text,created = TextLink.objects.get_or_create(uid=ds_text['uid'],
                                                           entity=entity,
                                                           defaults={'metadata':metadata,
-                                                                    'original':ds_text['url']})
+                                                                    'original':ds_text['url'],
+                                                                    'content_type':get_content_type(ds_text['url'],
+                                                                                                    ds_text['storage_contentType'])})
             text.tags.add(ds_text['storage_contentType'])
             if ds_text['storage_contentType'].endswith('xml'):
                 text.tags.add('xml')
@@ -1,4 +1,5 @@
 from django.core.files import File
+from docfish.apps.main.blobs import put_blob
 from docfish.apps.main.models import *
 
 import tempfile
@@ -82,6 +83,7 @@ def update_entity(entity,images=None,texts=None):
             if not re.search('overlay',image_uid):
                 new_image,created = ImageFile.objects.get_or_create(uid=image_uid,
                                                                     entity=entity)
+                new_image.content_type = get_content_type(image_file)
                 if created == True:
                      new_image.save()
                 with open(image_file,'rb') as filey:
@@ -102,8 +104,9 @@ def update_entity(entity,images=None,texts=None):
             with open(text_file,'r') as filey:
                 content = filey.read()
             new_text,created = TextFile.objects.get_or_create(uid=text_id,
-                                                              original=content,
-                                                              entity=entity)
+                                                              blob=put_blob(content),
+                                                              entity=entity,
+                                                              defaults={'content_type':get_content_type(text_file)})
             if "metadata" in text:
                 metadata = json.load(open(text['metadata'],'r'))
                 new_text.metadata = metadata
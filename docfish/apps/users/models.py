@@ -24,7 +24,7 @@ SOFTWARE.
 
 from django.conf import settings
 from django.contrib.auth import get_user_model
-from django.db.models.signals import post_save
+from django.db.models.signals import m2m_changed, post_save
 from django.dispatch import receiver
 from rest_framework.authtoken.models import Token
 
@@ -85,9 +85,9 @@ class Team(models.Model):
     team_image = models.ImageField(upload_to=get_image_path, blank=True, null=True)    
     metrics_updated_at = models.DateTimeField('date of last calculation of rank and annotations',blank=True,null=True)
     ranking = models.PositiveIntegerField(blank=True,null=True,
-                                          verbose_name="team ranking based on total number of annotations, calculated once daily.")
+                                          verbose_name="team ranking based on total number of annotations.")
     annotation_count = models.IntegerField(blank=False,null=False,
-                                           verbose_name="team annotation count, calculated once daily.",
+                                           verbose_name="team annotation count, updated as annotations are made.",
                                            default=0)
     permission = models.CharField(choices=TEAM_TYPES, 
                                   default='open',
@@ -141,6 +141,46 @@ class Team(models.Model):
 
 
 
+def members_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    '''when users join or leave a team, their annotations are added to or removed from the 
+    team annotation count (the rest is counted as annotations are made, see main.models.count_teams),
+    and the cached membership of the team is looked up again (see main.permission)
+    '''
+    from docfish.apps.main.models import CollectionStat
+    from docfish.apps.main.permission import invalidate_team_permissions
+    if action == "post_clear" and not reverse:
+        invalidate_team_permissions(instance.id)
+    if action not in ["post_add","post_remove","pre_clear"]:
+        return
+
+    # The team (or user, if reverse) changed, and the users (or teams) added or removed
+    if reverse:
+        user_ids = [instance.id]
+        team_ids = pk_set
+        if action == "pre_clear":
+            team_ids = list(instance.team_members.values_list('id',flat=True))
+    else:
+        team_ids = [instance.id]
+        user_ids = pk_set
+        if action == "pre_clear":
+            user_ids = list(instance.members.values_list('id',flat=True))
+
+    # Cached membership of the teams is looked up again
+    for team_id in team_ids or []:
+        invalidate_team_permissions(team_id)
+
+    if not team_ids or not user_ids:
+        return
+
+    change = CollectionStat.objects.filter(creator_id__in=list(user_ids)).aggregate(total=models.Sum('count'))['total']
+    if change:
+        if action != "post_add":
+            change = -change
+        Team.objects.filter(id__in=list(team_ids)).update(annotation_count=models.F('annotation_count') + change)
+
+m2m_changed.connect(members_changed, sender=Team.members.through)
+
+
 class MembershipInvite(models.Model):
     '''An invitation to join a team.
     '''
@@ -49,26 +49,25 @@ app.autodiscover_tasks(lambda: settings.INSTALLED_APPS)
 
 @periodic_task(run_every=crontab(minute=0, hour=0))
 def update_team_rankings():
-    '''update team rankings will calculate ordered rank for all current teams, count annotations,
-    and update these fields (with the update date) once a day at midnight (see above)
+    '''update team rankings will recount annotations for all teams with one aggregate query, and
+    correct the annotation count and ranking of any team that has drifted (the counts are otherwise 
+    kept up to date as annotations are made). It runs once a day at midnight (see above)
     '''
-    teams = Team.objects.all()
-    rankings = summarize_teams_annotations(teams) # sorted list with [(teamid,count)]
+    rankings = summarize_teams_annotations() # sorted list with [(teamid,count)]
+    teams = Team.objects.in_bulk([group[0] for group in rankings])
 
     # Iterate through rankings, get team and annotation count
     for g in range(len(rankings)):
 
-        group = rankings[g]
-        team_id = group[0]
+        team_id,count = rankings[g]
         rank = g+1 # index starts at 0
 
-        try:
-            team = Team.objects.get(id=team_id)
-        except:
+        team = teams.get(team_id)
+        if team is None:
             # A team not obtainable will be skipped
             continue
 
-        team.annotation_count = group[1]
-        team.ranking = rank
-        team.metrics_updated_at = timezone.now()        
-        team.save()
+        if team.annotation_count != count or team.ranking != rank:
+            Team.objects.filter(id=team_id).update(annotation_count=count,
+                                                   ranking=rank,
+                                                   metrics_updated_at=timezone.now())
@@ -0,0 +1,124 @@
+'''
+
+Copyright (c) 2017 Vanessa Sochat
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+'''
+
+from datetime import datetime
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.test import (
+    TestCase,
+    override_settings
+)
+from django.utils import timezone
+
+from docfish.apps.main.models import (
+    Annotation,
+    Collection,
+    Entity,
+    ImageAnnotation,
+    ImageLink,
+    TextAnnotation,
+    TextLink
+)
+from docfish.apps.users.utils import get_annotation_histogram
+
+
+LOCAL_CACHES = {'default':{'BACKEND':'django.core.cache.backends.locmem.LocMemCache'}}
+
+def get_date(day,hour=12):
+    '''get_date returns an aware datetime (UTC) in March of 2017, or the end of February for 
+    days less than one, so tests can place annotations in known days and weeks
+    '''
+    return timezone.make_aware(datetime(2017,3,1,hour) + timezone.timedelta(days=day-1),timezone.utc)
+
+
+@override_settings(CACHES=LOCAL_CACHES)
+class HistogramTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username="user",password="user")
+        self.other = User.objects.create_user(username="other",password="other")
+        self.collection = Collection.objects.create(name="collection",owner=self.user)
+        self.annotation = Annotation.objects.create(name="FRACTURE",label="YES")
+        entity = Entity.objects.create(uid="entity")
+        self.image = ImageLink.objects.create(uid="entity/image.png",
+                                              entity=entity,
+                                              url="http://localhost/image.png",
+                                              content_type="image")
+        self.text = TextLink.objects.create(uid="entity/abstract.txt",
+                                            entity=entity,
+                                            original="abstract",
+                                            content_type="text")
+
+        # Tuesday 2/28, Wednesday 3/1 (twice) and Thursday 3/2 share the week of Monday 2/27,
+        # and Friday 3/10 is outside the window
+        self.annotate_image(self.user,get_date(0))
+        self.annotate_image(self.user,get_date(1))
+        self.annotate_text(self.user,get_date(1,hour=18))
+        self.annotate_text(self.user,get_date(2))
+        self.annotate_image(self.user,get_date(10))
+        self.annotate_image(self.other,get_date(1))
+
+        self.start = get_date(-1,hour=0)
+        self.end = get_date(6,hour=0)
+
+    def annotate_image(self,user,date):
+        annotation = ImageAnnotation.objects.create(image=self.image,collection=self.collection,
+                                                    creator=user,annotation=self.annotation)
+        # modify_date is auto_now, so it can only be set with an update
+        ImageAnnotation.objects.filter(id=annotation.id).update(modify_date=date)
+
+    def annotate_text(self,user,date):
+        annotation = TextAnnotation.objects.create(text=self.text,collection=self.collection,
+                                                   creator=user,annotation=self.annotation)
+        TextAnnotation.objects.filter(id=annotation.id).update(modify_date=date)
+
+    def test_day_buckets(self):
+        '''annotations across tables are counted in the day they were last modified'''
+        histogram = get_annotation_histogram(self.user,start=self.start,end=self.end)
+        self.assertEqual(list(histogram.items()),[(get_date(0,hour=0),1),
+                                                  (get_date(1,hour=0),2),
+                                                  (get_date(2,hour=0),1)])
+
+    def test_week_buckets(self):
+        '''a week bucket starts on its Monday and counts every day in it'''
+        histogram = get_annotation_histogram(self.user,interval="week",start=self.start,end=self.end)
+        self.assertEqual(list(histogram.items()),[(get_date(-1,hour=0),4)])
+
+    def test_window_bounds(self):
+        '''annotations outside of the window (or by other users) are not counted'''
+        histogram = get_annotation_histogram(self.user,start=get_date(1,hour=0),end=get_date(2,hour=0))
+        self.assertEqual(list(histogram.items()),[(get_date(1,hour=0),2)])
+
+        histogram = get_annotation_histogram(self.user,start=self.start,end=get_date(11,hour=0))
+        self.assertEqual(sum(histogram.values()),5)
+
+        histogram = get_annotation_histogram(self.other,start=self.start,end=self.end)
+        self.assertEqual(list(histogram.items()),[(get_date(1,hour=0),1)])
+
+    def test_invalid_interval(self):
+        '''only day and week buckets are supported'''
+        with self.assertRaises(ValueError):
+            get_annotation_histogram(self.user,interval="month",start=self.start,end=self.end)
@@ -35,8 +35,11 @@ from django.shortcuts import (
     redirect
 )
 from django.conf import settings
+from django.core.cache import cache
 from django.contrib.auth import get_user_model
 from docfish.apps.main.models import *
+from django.db import connection
+from django.db.models.aggregates import Sum
 import collections
 from datetime import datetime
 from datetime import timedelta
@@ -48,6 +51,7 @@ import os
 from django.utils import timezone
 
 from docfish.apps.users.models import Team
+from docfish.settings import ANNOTATION_HISTOGRAM_TIMEOUT
 
 def get_user(uid):
     '''get a single user, or return 404'''
@@ -102,15 +106,20 @@ def get_request(team,user):
 
 
 def summarize_member_annotations(members):
-    '''summarize_team_annotations will return a summary of annotations for a group of users, typically a team
+    '''summarize_team_annotations will return a summary of annotations for a group of users, typically a team.
+    The counts are read from the collection stats (kept up to date as annotations are made) in one query.
     :param members: a list or queryset of users
     '''
     counts = dict()
+    usernames = dict([(member.id,member.username) for member in members])
+    for username in usernames.values():
+        counts[username] = 0
+
+    stats = CollectionStat.objects.filter(creator_id__in=list(usernames.keys())).order_by()
+    stats = stats.values_list('creator').annotate(total=Sum('count'))
     total = 0
-    for member in members:
-        member_counts = count_user_annotations(member)
-        member_count = sum(member_counts.values())
-        counts[member.username] = member_count
+    for user_id,member_count in stats:
+        counts[usernames[user_id]] = member_count
         total += member_count
     counts['total'] = total
     return counts    
@@ -163,46 +172,103 @@ def count_team_annotations(team,summary=False):
 def count_annotations_bydate(user):
     '''return a list of dates and counts that a user has annotated, in the past year.
     '''
-    dates = dict()
     now = timezone.now()
     then = now + timezone.timedelta(days=-365)
-
-    # For each, get all annotation objects
-    annots = []
-    annots = chain(annots,ImageMarkup.objects.filter(creator=user).distinct())
-    annots = chain(annots,TextMarkup.objects.filter(creator=user).distinct())
-    annots = chain(annots,TextAnnotation.objects.filter(creator=user).distinct())
-    annots = chain(annots,ImageAnnotation.objects.filter(creator=user).distinct())
-    annots = chain(annots,TextDescription.objects.filter(creator=user).distinct())
-    annots = chain(annots,ImageDescription.objects.filter(creator=user).distinct())
-    annots = list(annots)
-    for annot in annots:
-        annotation_time = annot.modify_date
-        annotation_time = annotation_time.replace(hour=0, minute=0, second=0, microsecond=0)
-        if annotation_time > then and annotation_time < now:
-            if annotation_time not in dates:
-                dates[annotation_time] = 1
-            else:
-                dates[annotation_time] +=1
-    return dates
-
-
-def summarize_teams_annotations(teams,sort=True):
-    '''summarize_teams_annotations returns a sorted list with [(team:count)] 
-    :param members: a list or queryset of users
+    return get_annotation_histogram(user=user,start=then,end=now)
+
+
+def get_annotation_histogram(user,interval="day",start=None,end=None):
+    '''get_annotation_histogram returns an ordered dictionary of dates (the start of each day or
+    week) and the number of markups, annotations, and descriptions made by a user in it. The 
+    counting is done by the database over all six tables, and the result is cached briefly 
+    (ANNOTATION_HISTOGRAM_TIMEOUT) so timelines can be shown cheaply.
+    :param user: the user to count annotations for
+    :param interval: one of "day" or "week"
+    :param start: the earliest date to count (default is one year ago)
+    :param end: the latest date to count (default is now)
+    '''
+    if interval not in ["day","week"]:
+        raise ValueError("interval must be one of day or week, not %s" %(interval))
+
+    if end is None:
+        end = timezone.now()
+    if start is None:
+        start = end + timezone.timedelta(days=-365)
+
+    # Round the window to the minute, so nearby requests share a cache entry
+    start = start.replace(second=0,microsecond=0)
+    end = end.replace(second=0,microsecond=0)
+    key = "histogram-%s-%s-%s-%s" %(user.id,interval,
+                                    start.strftime('%Y%m%d%H%M'),
+                                    end.strftime('%Y%m%d%H%M'))
+    histogram = cache.get(key)
+    if histogram is not None:
+        return histogram
+
+    work = []
+    params = [interval]
+    for model in [ImageMarkup,TextMarkup,ImageAnnotation,TextAnnotation,ImageDescription,TextDescription]:
+        work.append('''SELECT modify_date FROM %s 
+                       WHERE creator_id = %%s AND modify_date > %%s AND modify_date < %%s''' %(model._meta.db_table))
+        params += [user.id,start,end]
+
+    query = '''SELECT date_trunc(%%s, work.modify_date) AS bucket, COUNT(*) FROM (%s) AS work
+                 GROUP BY bucket ORDER BY bucket''' %(" UNION ALL ".join(work))
+
+    with connection.cursor() as cursor:
+        cursor.execute(query,params)
+        histogram = collections.OrderedDict([(bucket,count) for bucket,count in cursor.fetchall()])
+
+    cache.set(key,histogram,ANNOTATION_HISTOGRAM_TIMEOUT)
+    return histogram
+
+
+def summarize_teams_annotations(teams=None,sort=True):
+    '''summarize_teams_annotations returns a sorted list with [(team:count)], where the count for
+    a team is its own annotations plus those of its members. All teams are counted with one
+    aggregate query over the annotation tables, so this is also a check of Team.annotation_count,
+    which is kept up to date as annotations are made.
+    :param teams: a list or queryset of teams (default is all teams)
     :param sort: sort the result (default is True)
     '''
-    sorted_teams = dict()
-    for team in teams:
-        individual_count = summarize_member_annotations(team.members.all())['total']
-        team_count = count_team_annotations(team,summary=True)
-        sorted_teams[team.id] = team_count + individual_count
+    members_table = Team.members.through._meta.db_table
+    work = []
+    for model in [ImageMarkup,TextMarkup,ImageAnnotation,TextAnnotation,ImageDescription,TextDescription]:
+        table = model._meta.db_table
+        work.append('''SELECT team_id, COUNT(*) AS total FROM %s 
+                       WHERE team_id IS NOT NULL GROUP BY team_id''' %(table))
+        work.append('''SELECT members.team_id, COUNT(*) AS total FROM %s AS work
+                       INNER JOIN %s AS members ON work.creator_id = members.user_id
+                       GROUP BY members.team_id''' %(table,members_table))
+
+    query = '''SELECT team.id, COALESCE(SUM(work.total),0) FROM %s AS team
+                 LEFT OUTER JOIN (%s) AS work ON work.team_id = team.id
+                 GROUP BY team.id''' %(Team._meta.db_table," UNION ALL ".join(work))
+
+    with connection.cursor() as cursor:
+        cursor.execute(query)
+        sorted_teams = dict([(team_id,int(count)) for team_id,count in cursor.fetchall()])
+
+    if teams is not None:
+        team_ids = [team.id for team in teams]
+        sorted_teams = dict([(team_id,count) for team_id,count in sorted_teams.items() if team_id in team_ids])
+
     if sort == True:
         sorted_teams = sorted(sorted_teams.items(), key=operator.itemgetter(1))
         sorted_teams.reverse() # ensure returns from most to least
     return sorted_teams
 
 
+def get_team_rankings():
+    '''get_team_rankings returns all teams ordered from most to least annotations, with the
+    ranking of each set from its (current) annotation count.
+    '''
+    teams = list(Team.objects.order_by('-annotation_count','id'))
+    for rank,team in enumerate(teams):
+        team.ranking = rank + 1 # index starts at 0
+    return teams
+
+
 
 ####################################################################################
 # TEAM FUNCTIONS ###################################################################
@@ -268,14 +334,15 @@ def has_same_institution(owner,requester):
     '''
 
     # Does the user have an institution login?
-    user_providers = [sa for sa in requester.social_auth.all() if sa.provider == 'saml']
-    if len(user_providers) == 0:
+    user_uids = requester.social_auth.filter(provider='saml').values_list('uid',flat=True)
+    user_institutions = set([uid.split(':')[0] for uid in user_uids])
+    if len(user_institutions) == 0:
         return False
 
     # Limit to those in user's institution
-    user_institutions = [sa.uid.split(':')[0] for sa in user_providers]
-    owner_institutions = [sa.uid.split(':')[0] for sa in owner.social_auth.all()]
-    shared_institution = set(user_institutions).intersection(set(owner_institutions))
+    owner_uids = owner.social_auth.values_list('uid',flat=True)
+    owner_institutions = set([uid.split(':')[0] for uid in owner_uids])
+    shared_institution = user_institutions.intersection(owner_institutions)
 
     if len(shared_institution) > 0:
         return True
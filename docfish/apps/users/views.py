@@ -129,7 +129,7 @@ def view_teams(request):
     '''view all teams (log in not required)
     :parma tid: the team id to edit or create. If none, indicates a new team
     '''
-    teams = Team.objects.all()
+    teams = get_team_rankings()
     context = {"teams": teams}
     user_team = get_user_team(request)
     context['user_team'] = user_team # returns None if not in team
@@ -225,12 +225,6 @@ SENDFILE_BACKEND = 'sendfile.backends.development'
 PRIVATE_MEDIA_REDIRECT_HEADER = 'X-Accel-Redirect'
 CRISPY_TEMPLATE_PACK = 'bootstrap3'
 
-CACHES = {
-            'default': {
-                'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
-            }
-}
-
 # Static files (CSS, JavaScript, Images)
 # https://docs.djangoproject.com/en/1.9/howto/static-files/
 
@@ -238,6 +232,49 @@ MEDIA_ROOT = '/var/www/images'
 MEDIA_URL = '/images/'
 STATIC_ROOT = '/var/www/static'
 STATIC_URL = '/static/'
+
+# Remote content (e.g., TextLink bodies) is cached on disk, with recently used bodies in memory
+CONTENT_CACHE_ROOT = '/var/www/cache/content'
+CONTENT_CACHE_MAX_BYTES = 1024*1024*1024 # the disk cache is pruned (oldest first) above this size
+CONTENT_CACHE_MEMORY_ITEMS = 256         # number of bodies kept in memory by each process
+CONTENT_CACHE_MAX_AGE = 60*60            # seconds a cached body is served without revalidating
+CONTENT_FETCH_TIMEOUT = 10               # seconds to wait on a remote server
+CONTENT_FETCH_POOL_SIZE = 10             # connections kept open per remote host
+CONTENT_PREFETCH_COUNT = 3               # upcoming items to fetch while an annotator works
+CONTENT_PREFETCH_WORKERS = 4             # threads (per process) fetching upcoming items
+
+# Text file bodies are stored gzipped, by hash, so each distinct body is stored once
+TEXT_BLOB_ROOT = '/var/www/blobs'
+
+# Image files are given derivatives (thumbnail, display size, and deep zoom tiles) in the worker
+IMAGE_THUMBNAIL_SIZE = 256        # largest side of a thumbnail
+IMAGE_DISPLAY_SIZE = 1600         # largest side of the image sent to the markup tools
+IMAGE_TILE_SIZE = 254             # deep zoom tile size (plus overlap, 256 in total)
+IMAGE_TILE_OVERLAP = 1
+IMAGE_MAX_PIXELS = 1024*1024*1024 # largest image (in pixels) that will be opened
+
+# PDF images are rendered (with pdftoppm, from poppler-utils) into page images in the worker
+PDF_PAGE_DPI = 150                # resolution of the rendered pages
+PDF_PAGE_LIMIT = 50               # pages rendered for each pdf
+PDF_RENDER_TIMEOUT = 300          # seconds to wait on the renderer for one pdf
+
+# Markup layers can be uploaded as binary chunks (see uploads.py), kept here until complete
+MARKUP_UPLOAD_ROOT = '/var/www/uploads'
+MARKUP_UPLOAD_MAX_BYTES = 512*1024*1024  # largest markup layer accepted
+MARKUP_UPLOAD_MAX_CHUNK = 8*1024*1024    # largest chunk accepted in one request
+MARKUP_UPLOAD_EXPIRES = 60*60*24         # seconds before an unfinished upload is removed
+
+# Markup masks of a collection are exported (see exports.py) for download, served by nginx
+EXPORT_ROOT = '/var/www/exports'
+EXPORT_URL = '/exports/'                 # internal location (X-Accel-Redirect) in nginx.conf
+EXPORT_SHARD_BYTES = 256*1024*1024       # mask bytes in each .npy shard
+EXPORT_WORKERS = 4                       # processes decoding masks
+
+# Request payloads (e.g., annotations) can be captured for debugging (see base/capture.py)
+REQUEST_CAPTURE_ENABLED = False
+REQUEST_CAPTURE_SAMPLE_RATE = 0.1        # fraction of requests captured, when enabled
+REQUEST_CAPTURE_SIZE = 200               # captures kept (the most recent)
+REQUEST_CAPTURE_MAX_BYTES = 64*1024      # larger payloads are recorded by size only
 PAGINATION_SIZE = 100
 SNACK_PRICE = 100
 
@@ -246,6 +283,43 @@ REDIS_PORT = 6379
 REDIS_DB = 0  
 REDIS_HOST = os.environ.get('REDIS_PORT_6379_TCP_ADDR', 'redis')
 
+# The cache is shared between uwsgi workers and the celery worker, so that
+# annotation queues (and other precomputed state) built in one are seen by all
+CACHES = {
+    'default': {
+        'BACKEND': 'django_redis.cache.RedisCache',
+        'LOCATION': 'redis://%s:%d/1' %(REDIS_HOST,REDIS_PORT),
+        'OPTIONS': {
+            'CLIENT_CLASS': 'django_redis.client.DefaultClient',
+        }
+    }
+}
+
+# Annotation work queues, per user or team, collection, and task
+ANNOTATION_QUEUE_SIZE = 500         # maximum number of item ids held in a queue
+ANNOTATION_QUEUE_REFILL = 25        # refill in the background when fewer remain
+ANNOTATION_QUEUE_TIMEOUT = 60*60*24 # seconds before an unused queue expires
+
+# Team members lease the item they are working on, for this many seconds
+ITEM_LEASE_SECONDS = 60*15
+
+# Annotation activity histograms (user timelines) are cached this many seconds
+ANNOTATION_HISTOGRAM_TIMEOUT = 60*5
+
+# Collection label schemas (see schema.py) are versioned, this is a backstop expiration
+ANNOTATION_SCHEMA_TIMEOUT = 60*60*24
+
+# Collection permissions and team membership of users (see permission.py) are versioned, 
+# this is a backstop expiration (e.g., for a new institution login)
+PERMISSION_CACHE_TIMEOUT = 60*10
+
+# Annotations and text markup can be written behind (see writes.py), checked and queued in
+# redis by the request, and saved in batches by the worker, for bursts of annotators
+ANNOTATION_WRITE_BEHIND = False
+ANNOTATION_WRITE_BATCH = 200              # queued writes read from redis at once
+ANNOTATION_WRITE_DELAY = 1                # seconds the worker waits, so writes are saved together
+ANNOTATION_WRITE_PENDING_TIMEOUT = 60*10  # seconds an unsaved write is shown to its annotator
+
 # CELERY SETTINGS
 CELERY_RESULT_BACKEND = 'djcelery.backends.database:DatabaseBackend'
 BROKER_URL = 'redis://redis:6379/0'
@@ -256,7 +330,8 @@ CELERY_DEFAULT_QUEUE = 'default'
 CELERY_QUEUES = (
     Queue('default', Exchange('default'), routing_key='default'),
 )
-CELERY_IMPORTS = ('docfish.apps.storage.tasks',
+CELERY_IMPORTS = ('docfish.apps.main.tasks',
+                  'docfish.apps.storage.tasks',
                   'docfish.apps.users.tasks',
                   'docfish.apps.pubmed.tasks' )
 
@@ -4,11 +4,14 @@ ftp_base = "ftp://ftp.ncbi.nlm.nih.gov/pub/pmc"
 file_list = "ftp://ftp.ncbi.nlm.nih.gov/pub/pmc/oa_file_list.txt"
 
 from django.core.files import File
+from docfish.apps.main.blobs import put_blob
 from docfish.apps.main.models import (
     Collection, 
     Image, 
     Text,
-    Entity
+    TextFile,
+    Entity,
+    get_content_type
 )
 from django.contrib.auth.models import User
 from glob import glob
@@ -60,17 +63,19 @@ def create_images(article,images):
                                      django_file,save=True)
         extension = image.split('.')[-1]
         new_image.tags.add(extension)
+        new_image.content_type = get_content_type(image_id)
         new_image.save()
      
 
 def create_text(xml_file,article):
     content = read_file(xml_file)
     text_name = os.path.basename(xml_file)
-    text,created = Text.objects.get_or_create(uid=text_name,
-                                              entity=article,
-                                              original=content)
+    text,created = TextFile.objects.get_or_create(uid=text_name,
+                                                  entity=article,
+                                                  blob=put_blob(content))
     text.tags.add("article")
     text.tags.add("xml")
+    text.content_type = "xml"
     text.save()
     return text
 